@@ -21,7 +21,7 @@ from fastapi import UploadFile, File
 # -------------- 业务模块 --------------
 
 from src.llm import generate
-from src.rag import write_page,plan_wiki_structure,write_page_from_dir
+from src.rag import write_page,plan_wiki_structure,write_page_from_dir,prefetch_page_contexts
 import os
 os.environ.pop('all_proxy', None)   # 小写
 os.environ.pop('ALL_PROXY', None)   # 大写（Unix 下常见）
@@ -131,6 +131,18 @@ def import_project(src_path: str) -> str:
 # 如你原来没定义，请加一行：
 # log = logging.getLogger("EWiki_mini")
 
+def _prefetch_contexts(pages, src: Path, source_code_stone: Path, java_callgraph_stone: Path) -> Dict[tuple, str]:
+    """批量取回所有页面的检索上下文；失败时返回空字典，各页面退回逐个检索"""
+    # 与逐页循环的解包方式保持一致，write_page 收到的 description 即此处的查询
+    queries = [description for _, title, description, _ in pages]
+    file_paths = [files for _, _, _, files in pages]
+    try:
+        return prefetch_page_contexts(queries, src, source_code_stone, java_callgraph_stone, file_paths)
+    except Exception:
+        log.exception("[build_wiki] prefetch page contexts failed, fall back to per-page retrieval")
+        return {}
+
+
 def build_wiki(project: str, language: str = "zh") -> None:
     """
     1. 拷贝到 repos/
@@ -197,13 +209,15 @@ def build_wiki(project: str, language: str = "zh") -> None:
         return
 
     log.info("[build_wiki] parsed %s pages", len(pages))
+    contexts = _prefetch_contexts(pages, src, source_code_stone, java_callgraph_stone)
 
     # ---------- 5. 逐页生成 markdown ----------
     module_docs: Dict[str, str] = {}
     for pid, title, description, file_paths in pages:
         log.info("[build_wiki] ---- generate page | id=%s title=%s files=%s", pid, title, file_paths)
         try:
-            md = write_page(title, description, file_paths, src, source_code_stone, java_callgraph_stone, language)
+            md = write_page(title, description, file_paths, src, source_code_stone, java_callgraph_stone, language,
+                            contexts)
             module_docs[pid] = md
             log.info("[build_wiki] page done | id=%s len=%s", pid, len(md))
         except Exception as e:
@@ -419,6 +433,15 @@ async def build_wiki_with_progress(project: str, language: str = "zh") -> None:
         })
         await asyncio.sleep(0.1)
 
+        # ---------- 1.5 代码向量索引（在当前事件循环中构建，期间仍能响应其他请求）----------
+        await manager.send_progress(project, {
+            "stage": "indexing",
+            "progress": 25,
+            "message": "构建代码向量索引..."
+        })
+        from src.embedding import build_vec_index_async
+        await build_vec_index_async(str(src), str(source_code_stone))
+
         # ---------- 2. 生成 wiki 结构 ----------
         try:
             await manager.send_progress(project, {
@@ -428,8 +451,8 @@ async def build_wiki_with_progress(project: str, language: str = "zh") -> None:
             })
             await asyncio.sleep(0.1)
 
-            plan_xml = plan_wiki_structure(project, file_tree, readme, src, source_code_stone, java_callgraph_stone,
-                                           language)
+            plan_xml = await asyncio.to_thread(plan_wiki_structure, project, file_tree, readme, src,
+                                               source_code_stone, java_callgraph_stone, language)
 
             await manager.send_progress(project, {
                 "stage": "parsing",
@@ -485,6 +508,7 @@ async def build_wiki_with_progress(project: str, language: str = "zh") -> None:
             "total_pages": len(pages)
         })
         await asyncio.sleep(0.1)
+        contexts = await asyncio.to_thread(_prefetch_contexts, pages, src, source_code_stone, java_callgraph_stone)
 
         # ---------- 4. 逐页生成 markdown ----------
         module_docs: Dict[str, str] = {}
@@ -501,7 +525,8 @@ async def build_wiki_with_progress(project: str, language: str = "zh") -> None:
 
             log.info("[build_wiki] ---- generate page | id=%s title=%s files=%s", pid, title, file_paths)
             try:
-                md = write_page(title, description, file_paths, src, source_code_stone, java_callgraph_stone, language)
+                md = await asyncio.to_thread(write_page, title, description, file_paths, src, source_code_stone,
+                                             java_callgraph_stone, language, contexts)
                 module_docs[pid] = md
                 log.info("[build_wiki] page done | id=%s len=%s", pid, len(md))
             except Exception as e:
@@ -541,12 +566,12 @@ async def build_wiki_with_progress(project: str, language: str = "zh") -> None:
             log.info("[build_wiki] generating PROJECT.md ...")
             try:
                 if language == "en":
-                    readme = write_page_from_dir("Project Overview", wiki_lines, out / "modules", src,
-                                                 source_code_stone,
-                                                 java_callgraph_stone, language)
+                    readme = await asyncio.to_thread(write_page_from_dir, "Project Overview", wiki_lines,
+                                                     out / "modules", src, source_code_stone,
+                                                     java_callgraph_stone, language)
                 else:
-                    readme = write_page_from_dir("项目总览", wiki_lines, out / "modules", src, source_code_stone,
-                                                 java_callgraph_stone, language)
+                    readme = await asyncio.to_thread(write_page_from_dir, "项目总览", wiki_lines, out / "modules", src,
+                                                     source_code_stone, java_callgraph_stone, language)
                 project_md.write_text(readme, encoding="utf-8")
                 log.info("[build_wiki] PROJECT.md done | len=%s", len(readme))
             except Exception as e:
@@ -629,8 +654,14 @@ async def upload_knowledge_file(
         }
         project_knowledge_bases[project].append(file.filename)
 
-        # 构建整个知识库目录的向量索引
-        await build_knowledge_index(project, str(kb_dir))  # 传入目录路径而不是文件路径
+        # 只对新文件分块和嵌入（同名文件视为修改，旧块先被删除）
+        rejected = await build_knowledge_index(project, str(kb_dir), added=[str(file_path)])
+        if rejected:
+            # 没有加入索引的文件不保留，避免文件列表中出现检索不到的文件
+            file_path.unlink(missing_ok=True)
+            project_knowledge_bases[project].remove(file.filename)
+            raise HTTPException(status_code=422,
+                                detail=f"文件未加入知识库索引: {file.filename}（{rejected[0]['reason']}）")
 
         return {
             "filename": file.filename,
@@ -638,6 +669,8 @@ async def upload_knowledge_file(
             "description": description
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         log.exception("知识库文件上传失败")
         raise HTTPException(status_code=500, detail=f"上传失败: {str(e)}")
@@ -684,22 +717,21 @@ async def delete_knowledge_file(project: str, filename: str):
         if project in project_knowledge_bases and filename in project_knowledge_bases[project]:
             project_knowledge_bases[project].remove(filename)
 
-        # 检查知识库目录中是否还有其他文件
+        # 检查知识库目录中是否还有其他文件（旧版索引文件与知识库文件在同一目录，排除在外）
+        from src.meta_store import store_files
+        from src.embedding import IndexHandle
+        index_names = ({'faiss.index', 'faiss.index.params', 'faiss.index.bm25'}
+                       | {Path(p).name for p in store_files(kb_dir / "meta.json").values()})
         remaining_files = [f for f in kb_dir.iterdir()
-                           if f.is_file() and f.name not in ['faiss.index', 'meta.json']]
+                           if f.is_file() and f.name not in index_names]
 
         if remaining_files:
-            # 如果还有文件，重新构建整个知识库的索引
-            await build_knowledge_index(project, str(kb_dir))
+            # 如果还有文件，只从索引中删除该文件的向量
+            await build_knowledge_index(project, str(kb_dir), removed=[str(file_path)])
             return {"message": "文件删除成功，知识库索引已更新"}
         else:
-            # 如果没有文件了，删除索引文件
-            index_file = kb_dir / "faiss.index"
-            meta_file = kb_dir / "meta.json"
-            if index_file.exists():
-                index_file.unlink()
-            if meta_file.exists():
-                meta_file.unlink()
+            # 如果没有文件了，删除索引
+            IndexHandle(str(kb_dir)).clear()
             return {"message": "文件删除成功，知识库已清空"}
 
     except Exception as e:
@@ -707,28 +739,26 @@ async def delete_knowledge_file(project: str, filename: str):
         raise HTTPException(status_code=500, detail=f"删除失败: {str(e)}")
 
 
-async def build_knowledge_index(project: str, kb_dir_path: str):
-    """为整个知识库目录构建向量索引"""
+async def build_knowledge_index(project: str, kb_dir_path: str, added=(), removed=()) -> list[dict]:
+    """更新知识库目录的向量索引：给出 added / removed 时只处理这些文件，否则重建整个目录；
+    返回 added 中没有加入索引的文件 [{"path", "reason"}]"""
     try:
-        from src.embedding import build_vec_index
+        from src.embedding import IndexHandle
         kb_dir = OUTPUT_BASE / project / "knowledge_base"
 
-        # 删除旧的索引文件（如果存在）
-        index_file = kb_dir / "faiss.index"
-        meta_file = kb_dir / "meta.json"
-        if index_file.exists():
-            index_file.unlink()
-        if meta_file.exists():
-            meta_file.unlink()
-
-        # 使用现有的 build_vec_index 方法
-        # 它会自动在指定路径创建 faiss.index 和 meta.json
-        build_vec_index(
-            project_root=kb_dir_path,  # 知识库目录作为项目根目录
-            out_path=str(kb_dir)  # 输出到知识库目录
-        )
+        # 知识库目录作为项目根目录，索引输出到知识库目录；向量带编号映射，上传 / 删除时按文件增减。
+        # 在当前事件循环中异步更新：新索引写进新的一代目录，完成后原子切换，
+        # 更新期间知识库查询继续使用旧索引，失败时旧索引保持不变
+        # 上传的文档不受代码仓库的大小上限和压缩 / 生成文件检测影响
+        handle = IndexHandle(str(kb_dir), kb_dir_path, id_mapped=True, source_filters=False)
+        rejected = []
+        if added or removed:
+            rejected = await handle.update_files_async(added, removed)
+        else:
+            await handle.build_async(rebuild=True)
 
         log.info(f"[build_knowledge_index] 知识库索引构建成功: {kb_dir_path}")
+        return rejected
 
     except Exception as e:
         log.error(f"[build_knowledge_index] 索引构建失败: {e}")
@@ -743,21 +773,15 @@ def query_knowledge_base(project: str, query: str, topk: int = 3) -> str:
             return ""
 
         # 检查索引文件是否存在
-        index_file = kb_dir / "faiss.index"
-        meta_file = kb_dir / "meta.json"
+        from src.embedding import IndexHandle
+        handle = IndexHandle(str(kb_dir))
 
-        if not (index_file.exists() and meta_file.exists()):
+        if not handle.exists():
             log.info(f"[query_knowledge_base] 知识库索引文件不存在")
             return ""
 
         try:
-            from src.embedding import search
-            # 临时设置索引文件路径
-            import src.embedding as emb
-            emb.INDEX_FILE = str(index_file)
-            emb.META_FILE = str(meta_file)
-
-            results = search(query, topk)
+            results = handle.search(query, topk)
 
             if not results:
                 return ""
@@ -778,6 +802,13 @@ def query_knowledge_base(project: str, query: str, topk: int = 3) -> str:
         log.error(f"[query_knowledge_base] 查询失败: {e}")
         return ""
 
+@app.get("/api/metrics/concurrency")
+def concurrency_metrics():
+    """嵌入与 LLM 调用当前的自适应并发窗口等指标"""
+    from src.embedding import EMBED_LIMITER
+    from src.llm import LLM_LIMITER
+    return {"embedding": EMBED_LIMITER.stats(), "llm": LLM_LIMITER.stats()}
+
 # ~~~~~~~~~~~~~~ 单个项目文档 ~~~~~~~~~~~~~~
 @app.get("/api/{project}/project")
 def get_project(project: str):
@@ -806,6 +837,11 @@ class ChatRequest(BaseModel):
     question: str
     topk: int = 5
     history: List[Dict[str, str]] = []
+    # 代码检索范围（相对仓库根目录）：文件、目录前缀、语言；filter_mode 为 restrict（只检索范围内）或 boost（范围内优先）
+    files: List[str] = []
+    prefixes: List[str] = []
+    languages: List[str] = []
+    filter_mode: str = "restrict"
 
 
 def build_chat_prompt(question: str, history: List[Dict[str, str]], contexts: List[str]) -> str:
@@ -892,6 +928,8 @@ async def chat(project: str, req: ChatRequest):
 
         if not repo_path.exists():
             raise HTTPException(status_code=404, detail="Source repository not found")
+        if req.filter_mode not in ("restrict", "boost"):
+            raise HTTPException(status_code=400, detail="filter_mode must be restrict or boost")
 
         # 1. 使用RAG检索相关代码片段
         search_query = req.question
@@ -908,7 +946,8 @@ async def chat(project: str, req: ChatRequest):
         all_contexts = []
 
         # 2. 查询知识库
-        knowledge_context = query_knowledge_base(project, search_query, topk=2)
+        # 检索在线程池中执行：各项目的 IndexHandle 互不干扰，检索期间事件循环可以处理其他请求
+        knowledge_context = await asyncio.to_thread(query_knowledge_base, project, search_query, 2)
         if knowledge_context:
             all_contexts.append(knowledge_context)
             log.info(f"[chat] Retrieved knowledge context, length: {len(knowledge_context)}")
@@ -923,10 +962,15 @@ async def chat(project: str, req: ChatRequest):
         # 检索主要代码
         try:
             from src.embedding import query_code
-            code_contexts = query_code(
+            from src.search_filter import SearchFilter
+            scope = SearchFilter(req.files, req.prefixes, req.languages, root=str(repo_path),
+                                 mode=req.filter_mode)
+            code_contexts = await asyncio.to_thread(
+                query_code,
                 query=search_query,
                 project_root=str(repo_path),
-                out_path=str(source_code_stone)
+                out_path=str(source_code_stone),
+                flt=scope
             )
             log.info(f"[chat] Retrieved code contexts, length: {len(code_contexts)}")
 
@@ -941,7 +985,8 @@ async def chat(project: str, req: ChatRequest):
         # 检索Java调用图信息
         try:
             from src.rag import get_java_callgraph
-            java_context = get_java_callgraph(
+            java_context = await asyncio.to_thread(
+                get_java_callgraph,
                 search_query,
                 str(repo_path),
                 str(java_callgraph_stone)
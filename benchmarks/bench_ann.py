@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近似索引 recall@k / 延迟评测
+
+以 Flat 精确检索结果为基准，比较 HNSW、IVF-PQ 等索引在不同检索参数下的召回率和单条查询延迟，
+用于调整 config.xml 中的 ANN_* / HNSW_* / IVF_* 参数。
+
+用法:
+    python -m benchmarks.bench_ann --n 200000 --dim 768            # 合成数据
+    python -m benchmarks.bench_ann --index output/<项目>/data/source_code_stone
+"""
+import os
+import time
+import json
+import argparse
+import numpy as np
+import faiss
+
+from src.index_factory import choose_spec, build_from_vectors, stored_vectors
+from src.index_generations import GenerationStore
+
+
+def synthetic_vectors(n: int, dim: int, clusters: int = 256, seed: int = 0) -> np.ndarray:
+    """带聚类结构的合成向量（比纯随机向量更接近真实嵌入分布）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype("float32")
+    labels = rng.integers(0, clusters, n)
+    vecs = centers[labels] + 0.6 * rng.standard_normal((n, dim)).astype("float32")
+    faiss.normalize_L2(vecs)
+    return vecs
+
+
+def vectors_from_index(index_file: str) -> np.ndarray:
+    if os.path.isdir(index_file):  # 索引输出目录：读取 CURRENT 指向的一代
+        index_file = os.path.join(GenerationStore(index_file).current() or index_file, "faiss.index")
+    # 去重后的索引带编号映射，向量存放在内层索引
+    vecs, _ = stored_vectors(faiss.read_index(index_file))
+    faiss.normalize_L2(vecs)
+    return vecs
+
+
+def recall_at_k(truth: np.ndarray, found: np.ndarray, k: int) -> float:
+    hits = sum(len(set(t[:k]) & set(f[:k])) for t, f in zip(truth, found))
+    return hits / (len(truth) * k)
+
+
+def timed_search(index, queries: np.ndarray, k: int):
+    # 单条查询逐个执行，模拟在线检索的延迟
+    lat = []
+    ids = np.empty((len(queries), k), dtype="int64")
+    for i, q in enumerate(queries):
+        t = time.perf_counter()
+        _, ids[i:i + 1] = index.search(q[None, :], k)
+        lat.append((time.perf_counter() - t) * 1000)
+    return ids, np.array(lat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="近似索引 recall@k / 延迟评测")
+    parser.add_argument("--index", type=str, help="从已有索引（输出目录或 faiss.index）读取向量（需为可还原的 Flat/HNSW 索引）")
+    parser.add_argument("--n", type=int, default=100000, help="合成向量数量")
+    parser.add_argument("--dim", type=int, default=768, help="合成向量维度")
+    parser.add_argument("--queries", type=int, default=200, help="查询数量")
+    parser.add_argument("--k", type=int, default=10, help="recall@k 的 k")
+    parser.add_argument("--out", type=str, help="评测结果 JSON 输出路径")
+    args = parser.parse_args()
+
+    vecs = vectors_from_index(args.index) if args.index else synthetic_vectors(args.n, args.dim)
+    n, dim = vecs.shape
+    rng = np.random.default_rng(1)
+    nq = min(args.queries, n)  # 已有索引的向量可能少于 --queries
+    # 查询取库内向量加噪声，避免与自身完全重合
+    queries = vecs[rng.choice(n, nq, replace=False)] + 0.05 * rng.standard_normal((nq, dim)).astype("float32")
+    queries = queries.astype("float32")
+    faiss.normalize_L2(queries)
+
+    flat = build_from_vectors(vecs, choose_spec(n, dim, {"ANN_HNSW_THRESHOLD": str(n + 1)}))
+    truth, flat_lat = timed_search(flat, queries, args.k)
+    report = [{"index": "Flat", "recall": 1.0, "p50_ms": float(np.percentile(flat_lat, 50)),
+               "p99_ms": float(np.percentile(flat_lat, 99)), "build_s": 0.0}]
+
+    candidates = [
+        ("hnsw", {"ANN_HNSW_THRESHOLD": "0", "ANN_IVFPQ_THRESHOLD": str(n + 1)}, "efSearch", [16, 32, 64, 128, 256]),
+        ("ivfpq", {"ANN_HNSW_THRESHOLD": "0", "ANN_IVFPQ_THRESHOLD": "0"}, "nprobe", [1, 4, 16, 64]),
+    ]
+    for name, opts, knob, values in candidates:
+        spec = choose_spec(n, dim, opts)
+        t = time.time()
+        try:
+            index = build_from_vectors(vecs, spec)
+        except RuntimeError as e:
+            # 小索引的向量数可能少于 IVF / PQ 需要的训练点数
+            print(f"[跳过] {spec['factory']}: 向量数 {n} 不足以训练 ({str(e).split('failed: ')[-1]})")
+            continue
+        build_s = time.time() - t
+        for v in values:
+            if knob == "efSearch":
+                faiss.downcast_index(index).hnsw.efSearch = v
+            else:
+                faiss.extract_index_ivf(index).nprobe = v
+            found, lat = timed_search(index, queries, args.k)
+            report.append({
+                "index": f"{spec['factory']} {knob}={v}",
+                "recall": recall_at_k(truth, found, args.k),
+                "p50_ms": float(np.percentile(lat, 50)),
+                "p99_ms": float(np.percentile(lat, 99)),
+                "build_s": build_s,
+            })
+
+    print(f"\n向量数: {n}  维度: {dim}  查询数: {nq}  k={args.k}")
+    print(f"{'索引':<28}{'recall@k':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'构建(s)':>10}")
+    for r in report:
+        print(f"{r['index']:<28}{r['recall']:>10.3f}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['build_s']:>10.1f}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as g:
+            json.dump({"n": n, "dim": dim, "queries": nq, "k": args.k, "results": report}, g, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文件扫描 + 分块吞吐评测（files/sec 随进程数的变化）
+
+对同一批文件分别用 1、2、4 … 个分块进程跑 FileChunker，记录耗时、files/sec、chunks/sec
+和相对单进程的加速比，并校验各进程数下的分块结果与单进程完全一致，用于设置 CHUNK_WORKERS。
+--mode 可对比 lines / syntax 两种分块方式产生的块数和 token 总量。
+
+用法:
+    python -m benchmarks.bench_chunking --root /path/to/repo
+    python -m benchmarks.bench_chunking --files 20000 --workers 1 2 4 8    # 合成仓库
+    python -m benchmarks.bench_chunking --root /path/to/repo --workers 1 --mode lines syntax
+"""
+import os
+import time
+import json
+import random
+import hashlib
+import argparse
+import tempfile
+
+from src.chunking import FileChunker
+from src.batching import TokenCounter
+
+
+def synthetic_repo(root: str, n_files: int, lines: int = 400, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    for i in range(n_files):
+        d = os.path.join(root, f"pkg{i % 50}")
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, f"mod{i}.py"), "w", encoding="utf-8") as g:
+            for j in range(lines // 2):
+                g.write(f"def fn_{i}_{j}(a, b):  # {rng.random():.6f}\n    return a * {j} + b\n")
+
+
+def walk(root: str) -> list[str]:
+    out = []
+    for dirpath, _, filenames in os.walk(root):
+        out.extend(os.path.join(dirpath, f) for f in filenames)
+    return sorted(out)
+
+
+def run(files: list[str], workers: int, mode: str, args) -> dict:
+    digest = hashlib.md5()
+    chunks = tokens = 0
+    started = time.perf_counter()
+    with FileChunker(workers, args.max_lines, args.max_tokens, args.tokenizer,
+                     counter=TokenCounter(args.tokenizer), mode=mode, syntax_max_lines=args.syntax_max_lines) as chunker:
+        for path, items in chunker.imap(files):
+            chunks += len(items)
+            for start, _, n, h, _, _ in items:
+                tokens += n
+                digest.update(f"{path}:{start}:{h}".encode("utf-8"))
+    elapsed = time.perf_counter() - started
+    return {
+        "mode": mode,
+        "workers": workers,
+        "seconds": round(elapsed, 3),
+        "files_per_s": round(len(files) / elapsed, 1),
+        "chunks_per_s": round(chunks / elapsed, 1),
+        "chunks": chunks,
+        "tokens": tokens,
+        "digest": digest.hexdigest(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="文件分块吞吐评测")
+    parser.add_argument("--root", type=str, help="待分块的目录（缺省时生成合成仓库）")
+    parser.add_argument("--files", type=int, default=5000, help="合成仓库文件数")
+    parser.add_argument("--workers", type=int, nargs="+", help="要测试的进程数（缺省 1,2,4… 直到 CPU 核数）")
+    parser.add_argument("--mode", type=str, nargs="+", default=["lines"], choices=["lines", "syntax"])
+    parser.add_argument("--max-lines", type=int, default=50)
+    parser.add_argument("--syntax-max-lines", type=int, default=120)
+    parser.add_argument("--max-tokens", type=int, default=8192)
+    parser.add_argument("--tokenizer", type=str, default=None, help="EMBED_TOKENIZER，缺省用字符估算")
+    parser.add_argument("--out", type=str, help="结果 JSON 输出路径")
+    args = parser.parse_args()
+
+    cpus = os.cpu_count() or 1
+    workers = args.workers or sorted({1, cpus} | {2 ** i for i in range(1, 8) if 2 ** i < cpus})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.root
+        if not root:
+            root = tmp
+            synthetic_repo(root, args.files)
+        files = walk(root)
+        results = [run(files, w, mode, args) for mode in args.mode for w in workers]
+
+    for mode in args.mode:
+        rows = [r for r in results if r["mode"] == mode]
+        for r in rows:
+            r["speedup"] = round(rows[0]["seconds"] / r["seconds"], 2)
+            r["same_as_serial"] = r["digest"] == rows[0]["digest"]
+    report = {"files": len(files), "cpus": cpus, "results": results}
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as g:
+            g.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+自适应并发控制验证：在同一事件循环中启动限流替身服务，跑真实的 async_smart_batch_embedding，
+按固定间隔采样并发窗口，输出窗口变化轨迹和限流/错误次数（JSON）。
+
+--warm-cache N 预先把前 N 条文本放进嵌入缓存（临时目录），验证全部命中的批次不会影响延迟基线和并发窗口。
+
+用法:
+    python -m benchmarks.bench_concurrency --capacity 8 --texts 2000
+    python -m benchmarks.bench_concurrency --latency-ms 150 --texts 500 --warm-cache 10
+"""
+import os
+import json
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+import numpy as np
+
+from benchmarks.mock_embed_server import add_server_args, server_from_args
+from src.embedders import create_embedder
+from src.embed_cache import EmbeddingCache
+
+
+async def run(args) -> dict:
+    import src.embedding as emb
+
+    server = server_from_args(args)
+    await server.start()
+    embedder = create_embedder("remote", dict(emb.cfg, EMBED_URL=server.base_url))
+    emb.use_embedder(embedder)
+    emb.EMBED_LIMITER.set_limit(args.initial)
+    meta = [{"text": f"def func_{i}(x):\n    return x * {i}\n"} for i in range(args.texts)]
+
+    cache_dir = None
+    emb.EMBED_CACHE = None  # 每次都真正发请求
+    if args.warm_cache:
+        cache_dir = tempfile.mkdtemp(prefix="bench_cache_")
+        emb.EMBED_CACHE = EmbeddingCache(os.path.join(cache_dir, "cache.sqlite3"), 1 << 30)
+        rng = np.random.default_rng(0)
+        emb.EMBED_CACHE.put_many(embedder.name, embedder.dim, {
+            emb.md5txt(m["text"]): rng.standard_normal(embedder.dim).astype("float32")
+            for m in meta[:args.warm_cache]})
+
+    trace = []
+
+    async def sample():
+        while True:
+            trace.append({"t": round(asyncio.get_running_loop().time() - t0, 2),
+                          "window": emb.EMBED_LIMITER.window,
+                          "inflight": emb.EMBED_LIMITER.inflight,
+                          "server_inflight": server.inflight})
+            await asyncio.sleep(args.sample_interval)
+
+    t0 = asyncio.get_running_loop().time()
+    sampler = asyncio.create_task(sample())
+    try:
+        vecs = await emb.async_smart_batch_embedding(meta)
+    finally:
+        sampler.cancel()
+        await emb.close_async_client()
+        await server.stop()
+        if cache_dir:
+            emb.EMBED_CACHE.close()
+            emb.EMBED_CACHE = None
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    elapsed = asyncio.get_running_loop().time() - t0
+    return {
+        "texts": args.texts,
+        "warm_cache": args.warm_cache,
+        "vectors": len(vecs),
+        "elapsed_s": round(elapsed, 2),
+        "vectors_per_s": round(len(vecs) / elapsed, 1),
+        "limiter": emb.EMBED_LIMITER.stats(),
+        "server": server.counters,
+        "trace": trace,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="自适应并发控制验证")
+    add_server_args(parser)
+    parser.add_argument("--texts", type=int, default=1000, help="嵌入文本数量")
+    parser.add_argument("--initial", type=int, default=2, help="初始并发窗口")
+    parser.add_argument("--warm-cache", type=int, default=0, help="预先放进嵌入缓存的文本条数")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="窗口采样间隔（秒）")
+    parser.add_argument("--out", type=str, help="结果 JSON 输出路径")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as g:
+            g.write(text)
+    summary = {k: v for k, v in report.items() if k != "trace"}
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Matryoshka 维度截断评测：recall@k / 延迟 / 内存
+
+以完整维度上的 Flat 精确检索结果为基准，把同一批向量截断到 768/512/256/128 维（重新归一化）后
+分别建索引，比较召回率、单条查询延迟和索引内存，用于选择 config.xml 中的 INDEX_DIM。
+
+合成向量没有 Matryoshka 结构（各维同等重要），截断后召回率会明显偏低；
+评估真实效果请用 --index 读取真实项目索引中的向量。
+
+用法:
+    python -m benchmarks.bench_dims --index output/<项目>/data/source_code_stone
+    python -m benchmarks.bench_dims --n 100000 --dim 768 --dims 768,512,256,128
+"""
+import time
+import json
+import argparse
+import numpy as np
+import faiss
+
+from benchmarks.bench_ann import synthetic_vectors, vectors_from_index, timed_search, recall_at_k
+from src.index_factory import choose_spec, build_from_vectors, truncate_vectors, index_memory_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Matryoshka 维度截断评测")
+    parser.add_argument("--index", type=str, help="从已有索引（输出目录或 faiss.index）读取向量（需为可还原的 Flat/HNSW 索引）")
+    parser.add_argument("--n", type=int, default=50000, help="合成向量数量")
+    parser.add_argument("--dim", type=int, default=768, help="合成向量维度")
+    parser.add_argument("--dims", type=str, default="768,512,256,128", help="要比较的索引维度，逗号分隔")
+    parser.add_argument("--queries", type=int, default=200, help="查询数量")
+    parser.add_argument("--k", type=int, default=10, help="recall@k 的 k")
+    parser.add_argument("--hnsw", action="store_true", help="使用 HNSW 索引（默认 Flat）")
+    parser.add_argument("--out", type=str, help="评测结果 JSON 输出路径")
+    args = parser.parse_args()
+
+    vecs = vectors_from_index(args.index) if args.index else synthetic_vectors(args.n, args.dim)
+    n, full = vecs.shape
+    rng = np.random.default_rng(1)
+    # 查询取库内向量加噪声，避免与自身完全重合
+    queries = vecs[rng.choice(n, min(args.queries, n), replace=False)]
+    queries = (queries + 0.05 * rng.standard_normal(queries.shape)).astype("float32")
+    faiss.normalize_L2(queries)
+
+    exact = faiss.IndexFlatIP(full)
+    exact.add(vecs)
+    truth, _ = timed_search(exact, queries, args.k)
+
+    opts = {"ANN_HNSW_THRESHOLD": "0", "ANN_IVFPQ_THRESHOLD": str(n + 1)} if args.hnsw \
+        else {"ANN_HNSW_THRESHOLD": str(n + 1)}
+    report = []
+    for d in sorted({int(x) for x in args.dims.split(",") if int(x) <= full}, reverse=True):
+        spec = choose_spec(n, d, opts)
+        t = time.time()
+        index = build_from_vectors(truncate_vectors(vecs, d), spec)
+        build_s = time.time() - t
+        found, lat = timed_search(index, truncate_vectors(queries, d), args.k)
+        report.append({
+            "dim": d,
+            "index": spec["factory"],
+            "recall": recall_at_k(truth, found, args.k),
+            "p50_ms": float(np.percentile(lat, 50)),
+            "p99_ms": float(np.percentile(lat, 99)),
+            "memory_mb": index_memory_bytes(index) / 1024 / 1024,
+            "build_s": build_s,
+        })
+
+    print(f"\n向量数: {n}  原始维度: {full}  查询数: {len(queries)}  k={args.k}")
+    print(f"{'维度':<8}{'索引':<10}{'recall@k':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'内存(MB)':>10}{'构建(s)':>10}")
+    for r in report:
+        print(f"{r['dim']:<8}{r['index']:<10}{r['recall']:>10.3f}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}"
+              f"{r['memory_mb']:>10.1f}{r['build_s']:>10.1f}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as g:
+            json.dump({"n": n, "dim": full, "k": args.k, "results": report}, g, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+嵌入吞吐基准：本地替身服务 + 真实索引构建路径
+
+在合成仓库（几种规模）上跑完整的 build_index_async（分块 → 去重 → 批量并发嵌入 → 建索引），
+嵌入请求发给同一事件循环中的 MockEmbeddingServer（可配置延迟、抖动、500 / 429 比例），
+对 BATCH_SIZE、初始并发窗口（MAX_CONCURRENT）、分块行数（MAX_LINES / SYNTAX_MAX_LINES）和服务延迟
+的每种组合输出 vectors/sec、批次延迟 p50/p99 和峰值 RSS（JSON），作为调参前后对比的基线。
+
+每种组合在独立的子进程中运行，峰值 RSS（ru_maxrss）互不影响；嵌入缓存关闭，每次都真正发请求。
+合成仓库的函数结构相似，默认关闭近似去重，避免大部分块被合并而测不到嵌入吞吐（--near-dup 打开）。
+替身服务与构建共用一个进程，延迟很低时批次耗时主要是本地 JSON 编解码，比较时应固定 --latency-ms。
+
+用法:
+    python -m benchmarks.bench_embedding --sizes 200 1000 5000 --out baseline.json
+    python -m benchmarks.bench_embedding --sizes 1000 --batch-sizes 6 10 25 --concurrency 5 10 --latencies 50 200
+    python -m benchmarks.bench_embedding --sizes 1000 --throttle-rate 0.05 --error-rate 0.01
+"""
+import os
+import time
+import json
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from benchmarks.mock_embed_server import MockEmbeddingServer, add_server_args
+from benchmarks.bench_chunking import synthetic_repo
+from src.config import load_config
+from src.embedders import Embedder
+
+
+class TimedEmbedder(Embedder):
+    """包装远程后端，记录每个成功批次的耗时和条数（失败重试的请求不计入）"""
+    backend = "remote"
+    remote = True
+
+    def __init__(self, inner: Embedder):
+        self.inner = inner
+        self.name = inner.name
+        self.dim = inner.dim
+        self.latencies = []
+        self.items = 0
+        self.first = None
+        self.last = None
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        return self.inner.embed(texts)
+
+    async def aembed(self, texts: list[str]) -> np.ndarray:
+        started = time.monotonic()
+        if self.first is None:
+            self.first = started
+        vecs = await self.inner.aembed(texts)
+        self.last = time.monotonic()
+        self.latencies.append(self.last - started)
+        self.items += len(texts)
+        return vecs
+
+    async def aclose(self) -> None:
+        await self.inner.aclose()
+
+    def describe(self) -> dict:
+        return self.inner.describe()
+
+
+def _peak_rss_mb() -> tuple[float, float]:
+    """(本进程峰值 RSS, 已结束子进程中的最大峰值 RSS)，Linux 上 ru_maxrss 单位为 KB"""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+async def _run_case(case: dict) -> dict:
+    import src.embedding as emb
+    from src.embedders import create_embedder
+
+    server = MockEmbeddingServer(port=case["port"], latency_ms=case["latency_ms"], jitter_ms=case["jitter_ms"],
+                                 error_rate=case["error_rate"], throttle_rate=case["throttle_rate"],
+                                 capacity=case["capacity"], retry_after=case["retry_after"])
+    await server.start()
+    emb.cfg.update(EMBED_BACKEND="remote", EMBED_BACKEND_BY_PROJECT="", INDEX_DIM_BY_PROJECT="")
+    timed = TimedEmbedder(create_embedder("remote", dict(emb.cfg, EMBED_URL=server.base_url)))
+    emb.use_embedder(timed)
+    emb.EMBED_CACHE = None
+    emb.NEAR_DUP = case["near_dup"]
+    emb.CHUNK_WORKERS = case["chunk_workers"]
+    emb.BATCH_SIZE = case["batch_size"]
+    emb.MAX_LINES = emb.SYNTAX_MAX_LINES = case["max_lines"]
+    if case["fixed_window"]:
+        emb.EMBED_LIMITER.max_limit = case["concurrency"]
+    emb.EMBED_LIMITER.set_limit(case["concurrency"])
+
+    handle = emb.IndexHandle(case["out"], case["root"])
+    started = time.monotonic()
+    try:
+        await handle.build_async()
+    finally:
+        await emb.close_async_client()
+        await server.stop()
+    elapsed = time.monotonic() - started
+
+    index, meta = handle.load()
+    lat = np.array(timed.latencies) * 1000
+    span = (timed.last - timed.first) if timed.latencies else 0.0
+    rss, child_rss = _peak_rss_mb()
+    return {
+        "chunks": len(meta),
+        "vectors": timed.items,
+        "indexed": index.ntotal,
+        "elapsed_s": round(elapsed, 3),
+        "embed_span_s": round(span, 3),
+        "vectors_per_s": round(timed.items / elapsed, 1) if elapsed else None,
+        "embed_vectors_per_s": round(timed.items / span, 1) if span else None,
+        "batches": len(lat),
+        "batch_p50_ms": round(float(np.percentile(lat, 50)), 2) if len(lat) else None,
+        "batch_p99_ms": round(float(np.percentile(lat, 99)), 2) if len(lat) else None,
+        "rss_peak_mb": round(rss, 1),
+        "chunk_worker_rss_peak_mb": round(child_rss, 1),
+        "server": dict(server.counters),
+        "limiter": emb.EMBED_LIMITER.stats(),
+    }
+
+
+def run_case(case: dict) -> dict:
+    """子进程入口：每种组合一个全新进程（独立的峰值 RSS、限流器和索引缓存）"""
+    return asyncio.run(_run_case(case))
+
+
+def main():
+    cfg = load_config()
+    parser = argparse.ArgumentParser(description="嵌入吞吐基准（本地替身服务）")
+    add_server_args(parser)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 1000], help="合成仓库的文件数")
+    parser.add_argument("--file-lines", type=int, default=400, help="合成文件的行数")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[int(cfg.get("BATCH_SIZE") or 6)],
+                        help="BATCH_SIZE（每个请求的最大条数）")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[int(cfg.get("MAX_CONCURRENT") or 5)],
+                        help="初始并发窗口（MAX_CONCURRENT）")
+    parser.add_argument("--max-lines", type=int, nargs="+", default=[int(cfg.get("SYNTAX_MAX_LINES") or 120)],
+                        help="分块行数（同时设置 MAX_LINES 和 SYNTAX_MAX_LINES）")
+    parser.add_argument("--latencies", type=float, nargs="+", help="服务延迟（毫秒），缺省使用 --latency-ms")
+    parser.add_argument("--fixed-window", action="store_true", help="并发窗口固定为 --concurrency，不自适应增长")
+    parser.add_argument("--chunk-workers", type=int, default=1, help="分块进程数（默认 1，只测嵌入路径）")
+    parser.add_argument("--near-dup", action="store_true", help="开启近似去重")
+    parser.add_argument("--workdir", type=str, help="合成仓库和索引的目录（默认临时目录，结束后删除）")
+    parser.add_argument("--out", type=str, help="结果 JSON 输出路径")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_embed_")
+    report = {"server": {"latency_ms": args.latencies or [args.latency_ms], "jitter_ms": args.jitter_ms,
+                         "error_rate": args.error_rate, "throttle_rate": args.throttle_rate,
+                         "capacity": args.capacity},
+              "cases": []}
+    try:
+        roots = {}
+        for size in args.sizes:
+            roots[size] = os.path.join(workdir, f"repo_{size}")
+            if not os.path.isdir(roots[size]):
+                synthetic_repo(roots[size], size, args.file_lines)
+
+        grid = itertools.product(args.sizes, args.batch_sizes, args.concurrency, args.max_lines,
+                                 args.latencies or [args.latency_ms])
+        for size, batch_size, concurrency, max_lines, latency in grid:
+            case = {"files": size, "batch_size": batch_size, "concurrency": concurrency, "max_lines": max_lines,
+                    "latency_ms": latency}
+            out = os.path.join(workdir, "index_" + "_".join(str(v) for v in case.values()))
+            shutil.rmtree(out, ignore_errors=True)
+            params = dict(case, root=roots[size], out=out, port=args.port, jitter_ms=args.jitter_ms,
+                          error_rate=args.error_rate, throttle_rate=args.throttle_rate, capacity=args.capacity,
+                          retry_after=args.retry_after, fixed_window=args.fixed_window,
+                          chunk_workers=args.chunk_workers, near_dup=args.near_dup)
+            print(f"[基准] {case}")
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                result = executor.submit(run_case, params).result()
+            report["cases"].append(dict(case, **result))
+            shutil.rmtree(out, ignore_errors=True)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\n{'文件':>6}{'批大小':>7}{'并发':>6}{'行数':>6}{'延迟ms':>8}{'向量':>8}{'vec/s':>9}"
+          f"{'p50ms':>9}{'p99ms':>9}{'RSS MB':>9}{'429':>6}{'5xx':>6}")
+    for r in report["cases"]:
+        print(f"{r['files']:>6}{r['batch_size']:>7}{r['concurrency']:>6}{r['max_lines']:>6}{r['latency_ms']:>8.0f}"
+              f"{r['vectors']:>8}{r['vectors_per_s'] or 0:>9.1f}{r['batch_p50_ms'] or 0:>9.1f}"
+              f"{r['batch_p99_ms'] or 0:>9.1f}{r['rss_peak_mb']:>9.1f}{r['server']['throttled']:>6}"
+              f"{r['server']['errors']:>6}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as g:
+            json.dump(report, g, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地 OpenAI 兼容的 /v1/embeddings 替身服务
+
+可配置延迟、抖动、随机 5xx、随机 429 以及并发容量（超过容量的请求直接返回 429 + Retry-After），
+用于在不消耗真实配额的情况下验证自适应并发控制和嵌入流水线。
+
+用法:
+    python -m benchmarks.mock_embed_server --port 18080 --latency-ms 80 --capacity 8
+    然后把 config.xml 的 EMBED_URL 指向 http://127.0.0.1:18080/v1
+"""
+import random
+import asyncio
+import hashlib
+import argparse
+import numpy as np
+from aiohttp import web
+
+
+class MockEmbeddingServer:
+    def __init__(self, port: int = 18080, latency_ms: float = 50, jitter_ms: float = 20,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, capacity: int = 0,
+                 retry_after: float = 1.0, max_items: int = 0):
+        self.port = port
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.capacity = capacity          # 0 表示不限并发
+        self.retry_after = retry_after
+        self.max_items = max_items        # 0 表示不限单请求条数
+        self.inflight = 0
+        self.counters = {"requests": 0, "ok": 0, "throttled": 0, "errors": 0, "items": 0}
+        self._runner = None
+
+    @staticmethod
+    def vector(text: str, dim: int) -> list:
+        # 同一文本总是得到同一向量，便于校验顺序和缓存
+        seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+        return np.random.default_rng(seed).standard_normal(dim).astype("float32").tolist()
+
+    def _throttle(self):
+        self.counters["throttled"] += 1
+        return web.json_response(
+            {"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}},
+            status=429, headers={"Retry-After": str(self.retry_after)})
+
+    async def handle_embeddings(self, request: web.Request):
+        self.counters["requests"] += 1
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dim = int(body.get("dimensions") or 768)
+
+        if self.capacity and self.inflight >= self.capacity:
+            return self._throttle()
+        if random.random() < self.throttle_rate:
+            return self._throttle()
+        if self.max_items and len(texts) > self.max_items:
+            return web.json_response({"error": {"message": "batch too large"}}, status=400)
+
+        self.inflight += 1
+        try:
+            delay = max(0.0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            await asyncio.sleep(delay)
+            if random.random() < self.error_rate:
+                self.counters["errors"] += 1
+                return web.json_response({"error": {"message": "internal error"}}, status=500)
+            self.counters["ok"] += 1
+            self.counters["items"] += len(texts)
+            data = [{"object": "embedding", "index": i, "embedding": self.vector(t, dim)}
+                    for i, t in enumerate(texts)]
+            return web.json_response({
+                "object": "list",
+                "data": data,
+                "model": body.get("model", "mock"),
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            })
+        finally:
+            self.inflight -= 1
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/embeddings", self.handle_embeddings)
+        app.router.add_post("/embeddings", self.handle_embeddings)
+        return app
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    async def start(self):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+def add_server_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency-ms", type=float, default=50, help="平均响应延迟")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="延迟抖动范围 (±)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="随机返回 500 的概率")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="随机返回 429 的概率")
+    parser.add_argument("--capacity", type=int, default=0, help="并发容量，超过后返回 429（0 不限）")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 响应的 Retry-After 秒数")
+
+
+def server_from_args(args) -> MockEmbeddingServer:
+    return MockEmbeddingServer(port=args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                               error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                               capacity=args.capacity, retry_after=args.retry_after)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容嵌入替身服务")
+    add_server_args(parser)
+    args = parser.parse_args()
+    server = server_from_args(args)
+    print(f"mock embedding server: {server.base_url}")
+    web.run_app(server.make_app(), host="127.0.0.1", port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按 token 数打包嵌入请求
+
+- TokenCounter：优先使用 tokenizers 加载的分词器计数（EMBED_TOKENIZER 可为本地 tokenizer.json
+  路径或 HuggingFace 模型名），加载失败时退化为保守的字符估算。
+- local_tokenizer：EMBED_TOKENIZER 为空时，在模型目录或 HuggingFace 本地缓存中查找嵌入模型自带的
+  tokenizer.json（不访问网络），找到时默认使用它。
+- split_chunk：超过单条 token 上限的文本块按行切分（单行过长时按字符切分），不再静默截断。
+- pack_batches：按原顺序贪心装箱，每个请求尽量填满条数上限和 token 上限，减少往返次数。
+"""
+import os
+
+
+def local_tokenizer(model: str) -> str:
+    """嵌入模型在本地的 tokenizer.json 路径（模型目录或 HuggingFace 缓存），找不到时返回 None"""
+    if not model:
+        return None
+    path = os.path.join(model, "tokenizer.json")
+    if os.path.isfile(path):
+        return path
+    try:
+        from huggingface_hub import try_to_load_from_cache
+        cached = try_to_load_from_cache(model, "tokenizer.json")
+    except Exception:  # 未安装 huggingface_hub，或模型名不是合法的仓库名（如本地路径）
+        return None
+    return cached if isinstance(cached, str) else None
+
+
+class TokenCounter:
+    def __init__(self, tokenizer_name: str = None):
+        self._tok = None
+        if tokenizer_name:
+            try:
+                from tokenizers import Tokenizer
+                if os.path.exists(tokenizer_name):
+                    self._tok = Tokenizer.from_file(tokenizer_name)
+                else:
+                    self._tok = Tokenizer.from_pretrained(tokenizer_name)
+            except Exception as e:
+                print(f"[分词器] 加载 {tokenizer_name} 失败，改用字符估算: {e}")
+
+    @property
+    def approximate(self) -> bool:
+        """是否按字符估算 token 数（没有可用的分词器）"""
+        return self._tok is None
+
+    @staticmethod
+    def estimate(text: str) -> int:
+        """保守估算：ASCII 约 3 字符一个 token，其余字符（中文等）各算一个 token"""
+        # 非 ASCII 字符在 UTF-8 中多占 1~3 个字节，按多 2 字节近似，避免逐字符循环
+        non_ascii = (len(text.encode("utf-8")) - len(text) + 1) // 2
+        ascii_chars = max(len(text) - non_ascii, 0)
+        return (ascii_chars + 2) // 3 + non_ascii
+
+    def count(self, texts: list[str]) -> list[int]:
+        if self._tok is None:
+            return [self.estimate(t) for t in texts]
+        encs = self._tok.encode_batch(texts, add_special_tokens=False)
+        return [len(e.ids) for e in encs]
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """截断到 max_tokens 以内（仅用于查询等无法切分的场景）"""
+        if len(text) <= max_tokens:
+            return text
+        if self._tok is not None:
+            enc = self._tok.encode(text, add_special_tokens=False)
+            if len(enc.ids) <= max_tokens:
+                return text
+            return text[:enc.offsets[max_tokens - 1][1]]
+        n = self.estimate(text)
+        while n > max_tokens:
+            text = text[:max(1, int(len(text) * max_tokens / n) - 1)]
+            n = self.estimate(text)
+        return text
+
+
+def _split_long_line(line: str, counter: TokenCounter, max_tokens: int) -> list[str]:
+    """单行超长（压缩代码等）时按字符切分"""
+    parts = []
+    while line:
+        piece = counter.truncate(line, max_tokens)
+        parts.append(piece)
+        line = line[len(piece):]
+    return parts
+
+
+def split_chunk(start: int, text: str, counter: TokenCounter, max_tokens: int) -> list[tuple]:
+    """把超过 max_tokens 的文本块切成若干 (起始行, 文本, token 数)，未超限时原样返回"""
+    total = counter.count([text])[0]
+    if total <= max_tokens:
+        return [(start, text, total)]
+
+    lines = text.splitlines(keepends=True)
+    line_tokens = counter.count(lines)
+    pieces, cur, cur_tokens, cur_start = [], [], 0, start
+    for offset, (line, n) in enumerate(zip(lines, line_tokens)):
+        if n > max_tokens:
+            if cur:
+                pieces.append((cur_start, "".join(cur), cur_tokens))
+                cur, cur_tokens = [], 0
+            parts = _split_long_line(line, counter, max_tokens)
+            pieces.extend((start + offset, p, n) for p, n in zip(parts, counter.count(parts)))
+            cur_start = start + offset + 1
+            continue
+        if cur and cur_tokens + n > max_tokens:
+            pieces.append((cur_start, "".join(cur), cur_tokens))
+            cur, cur_tokens, cur_start = [], 0, start + offset
+        cur.append(line)
+        cur_tokens += n
+    if cur:
+        pieces.append((cur_start, "".join(cur), cur_tokens))
+    return pieces
+
+
+def pack_batches(counts: list[int], max_items: int, max_tokens: int) -> list[list[int]]:
+    """按顺序把文本下标装入批次，每批不超过 max_items 条、max_tokens 个 token"""
+    batches, cur, cur_tokens = [], [], 0
+    for i, n in enumerate(counts):
+        if cur and (len(cur) >= max_items or cur_tokens + n > max_tokens):
+            batches.append(cur)
+            cur, cur_tokens = [], 0
+        cur.append(i)
+        cur_tokens += n
+    if cur:
+        batches.append(cur)
+    return batches
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分块进程池的子进程入口（见 chunking.FileChunker）
+
+spawn 启动的子进程按模块名导入这里的 init / chunk_files。本模块只依赖 chunking
+（batching、near_dup、tools.project_parser），导入时不读 config.xml、不加载 faiss、不打开嵌入缓存。
+"""
+from .batching import TokenCounter
+from . import chunking
+
+# 子进程内的分词器，由 init 创建，整个进程生命周期复用
+_counter = None
+
+
+def init(tokenizer_name: str) -> None:
+    global _counter
+    _counter = TokenCounter(tokenizer_name)
+
+
+def chunk_files(paths: list[str], max_lines: int, max_tokens: int, mode: str, syntax_max_lines: int,
+                fingerprint: bool) -> list[list[tuple]]:
+    """一次处理一组文件，摊薄进程间通信开销"""
+    return [chunking.chunk_file(p, max_lines, max_tokens, _counter, mode, syntax_max_lines, fingerprint)
+            for p in paths]
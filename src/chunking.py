@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文件分块（可在进程池中并行）
+
+构建索引时文件扫描和分块是纯 CPU 工作，单线程在大仓库上会成为嵌入开始前的瓶颈。
+FileChunker 把每个文件交给进程池中的 chunk_file 处理（读取、分块、超长切分、计数、md5），
+按提交顺序返回结果，保证元数据行号与单进程构建完全一致。待分块的文件总量不足 min_parallel_bytes
+时直接在当前进程内分块：spawn 进程池的启动开销（每个子进程约半秒）比小仓库的分块本身还长。
+
+分块方式（CHUNK_MODE）：
+    lines   固定行数窗口（MAX_LINES）
+    syntax  按 CodeParser.parse_code 识别出的类/函数起始行切分：相邻的小符号（不论是否属于同一个类）
+            依次合并到 SYNTAX_MAX_LINES 行以内，超长符号均匀拆成不超过该行数的几段，
+            合并后仍不足 SYNTAX_MAX_LINES / 8 行的块并入较短的相邻块；每个块记录所属符号。
+            非代码文件或解析失败时退回固定行数窗口
+
+开启近似去重时同时在子进程中计算每个块的 SimHash 指纹（见 near_dup）。
+
+本模块只依赖 batching、near_dup 和 tools.project_parser，子进程入口在 chunk_worker 中，导入时没有副作用。
+"""
+import os
+import hashlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from . import chunk_worker
+from .batching import TokenCounter, split_chunk
+from .near_dup import simhash
+from .tools.project_parser import CodeParser
+
+_parser = None
+
+# CodeParser 的正则会把 "return foo(x);"、"else if (...) {" 之类的语句也识别成函数，这里过滤掉
+_NOT_SYMBOLS = {"if", "for", "while", "switch", "catch", "return", "new", "else", "throw", "do", "try",
+                "synchronized", "sizeof", "elif", "with"}
+_LEADING_TRIVIA = ("@", "#", "//", "/*", "*", "///")
+
+
+def read_chunks(path: str, max_lines=50):
+    """
+       改进的文本分块函数
+
+       修复空行处理和行号计算问题，避免生成过小的文本块
+       """
+    skip_empty_lines = False  # 默认不跳过空行，避免行号计算错误
+    min_chunk_size = 10  # 最小块大小（字符数），避免过小的块
+
+    current_chunk = []
+    current_line_count = 0
+    start_line = 1
+
+    # 逐行流式读取并逐块产出，大文件不会整体载入内存
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        actual_line_num = 0
+        for line_num, line in enumerate(f, 1):
+            # 处理空行
+            if skip_empty_lines and not line.strip():
+                continue
+
+            actual_line_num += 1
+            current_chunk.append(line)
+            current_line_count += 1
+
+            # 达到最大行数时分割
+            if current_line_count >= max_lines:
+                chunk_text = "".join(current_chunk)
+                # 只有块达到最小大小才保存
+                if len(chunk_text.strip()) >= min_chunk_size:
+                    yield start_line, chunk_text
+                current_chunk = []
+                current_line_count = 0
+                start_line = actual_line_num + 1
+
+    # 处理剩余内容
+    if current_chunk:
+        chunk_text = "".join(current_chunk)
+        if len(chunk_text.strip()) >= min_chunk_size:
+            yield start_line, chunk_text
+
+
+def _code_parser() -> CodeParser:
+    global _parser
+    if _parser is None:
+        _parser = CodeParser()
+    return _parser
+
+
+def symbol_starts(path: str, lines: list[str]) -> list[tuple]:
+    """
+    CodeParser 识别出的类/函数起始行 [(行号, 符号名, 归属)]，方法名带类名前缀；
+    归属为最外层类名，模块级函数为空字符串。无法解析时返回空列表。
+    """
+    parser = _code_parser()
+    if parser.detect_language(path) == "unknown":
+        return []
+    result = parser.parse_code(path)
+    if "error" in result:
+        return []
+
+    found = []
+    for c in result.get("classes", []):
+        found.append((c["line_number"], c["name"], True))
+        found.extend((m["line_number"], m["name"], False) for m in c.get("methods", []))
+    found.extend((f["line_number"], f["name"], False)
+                 for f in result.get("functions", []) + result.get("methods", []))
+
+    out, cls, seen = [], None, set()
+    for line_no, name, is_class in sorted(found):
+        if line_no in seen or not 1 <= line_no <= len(lines):
+            continue
+        line = lines[line_no - 1]
+        stripped = line.strip()
+        if name in _NOT_SYMBOLS or stripped.endswith(";") or stripped.split(" ", 1)[0] in _NOT_SYMBOLS:
+            continue
+        seen.add(line_no)
+        # parse_code 不会在类结束时重置 current_class，用缩进判断是否仍在类内
+        indented = line[:1] in (" ", "\t")
+        if is_class:
+            cls = f"{cls}.{name}" if indented and cls else name
+            out.append((line_no, cls, cls.split(".")[0]))
+        elif indented and cls:
+            out.append((line_no, f"{cls}.{name}", cls.split(".")[0]))
+        elif indented:
+            continue  # 函数内部的嵌套函数，留在外层函数的块里
+        else:
+            cls = None
+            out.append((line_no, name, ""))
+    return out
+
+
+def _chunk_symbol(names: list[str]) -> str:
+    """合并块的符号：单个符号直接使用，同属一个类时用类名，否则列出前几个"""
+    names = [n for n in names if n]
+    if not names:
+        return ""
+    if len(set(names)) == 1:
+        return names[0]
+    owners = {n.split(".")[0] for n in names}
+    if len(owners) == 1:
+        return owners.pop()
+    return ", ".join(dict.fromkeys(names[:3])) + (" …" if len(names) > 3 else "")
+
+
+def syntax_chunks(path: str, max_lines: int):
+    """
+    按符号边界分块，产出 (起始行, 文本, 符号)。
+    返回 None 表示该文件无法按语法分块（非代码文件、解析失败或没有识别出符号）。
+    """
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        lines = f.readlines()
+    starts = symbol_starts(path, lines)
+    if not starts:
+        return None
+
+    # 符号上方紧邻的装饰器 / 注释归入该符号
+    bounds, prev = [], 0
+    for line_no, name, owner in starts:
+        s = line_no
+        while s - 1 > prev and lines[s - 2].strip().startswith(_LEADING_TRIVIA):
+            s -= 1
+        bounds.append((s, name, owner))
+        prev = s
+    segments = []
+    if bounds[0][0] > 1:
+        segments.append((1, bounds[0][0] - 1, "", ""))  # 文件头：import、模块注释等
+    for i, (s, name, owner) in enumerate(bounds):
+        e = bounds[i + 1][0] - 1 if i + 1 < len(bounds) else len(lines)
+        segments.append((s, e, name, owner))
+
+    # 超长符号均匀拆成几段（避免最后剩下一两行的碎块），其余相邻段依次合并到 max_lines 行以内
+    pieces = []
+    for s, e, name, _ in segments:
+        n = -(-(e - s + 1) // max_lines)
+        size = -(-(e - s + 1) // n)
+        pieces.extend((ws, min(e, ws + size - 1), name) for ws in range(s, e + 1, size))
+    merged = []
+    for s, e, name in pieces:
+        if merged and e - merged[-1][0] + 1 <= max_lines:
+            merged[-1] = (merged[-1][0], e, merged[-1][2] + [name])
+        else:
+            merged.append((s, e, [name]))
+
+    # 夹在两个大块之间的小块并入较短的一侧（合并后允许略超过 max_lines）
+    min_lines = max(1, max_lines // 8)
+    i = 0
+    while len(merged) > 1 and i < len(merged):
+        s, e, names = merged[i]
+        if e - s + 1 >= min_lines:
+            i += 1
+            continue
+        prev = merged[i - 1] if i > 0 else None
+        nxt = merged[i + 1] if i + 1 < len(merged) else None
+        if nxt is None or (prev is not None and prev[1] - prev[0] <= nxt[1] - nxt[0]):
+            merged[i - 1:i + 1] = [(prev[0], e, prev[2] + names)]
+            i -= 1
+        else:
+            merged[i:i + 2] = [(s, nxt[1], names + nxt[2])]
+
+    out = []
+    for s, e, names in merged:
+        text = "".join(lines[s - 1:e])
+        if len(text.strip()) >= 10:
+            out.append((s, text, _chunk_symbol(names)))
+    return out
+
+
+def chunk_file(path: str, max_lines: int, max_tokens: int, counter: TokenCounter = None,
+               mode: str = "lines", syntax_max_lines: int = 120, fingerprint: bool = False) -> list[tuple]:
+    """
+    单个文件的 [(起始行, 文本, token 数, md5, 符号, simhash)]；超过单条 token 上限的块已切成多个。
+    fingerprint=False 时 simhash 为 0。
+    """
+    counter = counter or TokenCounter()
+    out = []
+    try:
+        chunks = syntax_chunks(path, syntax_max_lines) if mode == "syntax" else None
+        if chunks is None:
+            chunks = ((start, text, "") for start, text in read_chunks(path, max_lines))
+        for start, text, symbol in chunks:
+            for piece_start, piece, tokens in split_chunk(start, text, counter, max_tokens):
+                out.append((piece_start, piece, tokens, hashlib.md5(piece.encode("utf-8")).hexdigest(), symbol,
+                            simhash(piece) if fingerprint else 0))
+    except OSError as e:
+        print(f"[分块] 读取失败，跳过 {path}: {e}")
+        return []
+    return out
+
+
+def resolve_workers(value) -> int:
+    """CHUNK_WORKERS 为空或 0 时使用全部 CPU 核"""
+    n = int(value or 0)
+    return n if n > 0 else (os.cpu_count() or 1)
+
+
+class FileChunker:
+    """
+    with FileChunker(workers, ...) as chunker:
+        for path, chunks in chunker.imap(paths): ...
+
+    workers <= 1，或文件总大小不足 min_parallel_bytes 时在当前进程内分块，不启动进程池。
+
+    注意 spawn 子进程除了导入 chunk_worker，还会按名字重新导入父进程的 __main__ 模块（以 __mp_main__
+    的名义执行其顶层代码）：以 python -m src.embedding 运行时，每个子进程都会再导入一遍 src.embedding，
+    包括 faiss、读取 config.xml 和 open_cache 打开嵌入缓存。这部分开销在大仓库上可以摊薄，
+    小仓库由 min_parallel_bytes 阈值避开。
+    """
+
+    def __init__(self, workers: int, max_lines: int, max_tokens: int, tokenizer_name: str = None,
+                 counter: TokenCounter = None, mode: str = "lines", syntax_max_lines: int = 120,
+                 fingerprint: bool = False, min_parallel_bytes: int = 0):
+        self.workers = max(1, workers)
+        self.max_lines = max_lines
+        self.max_tokens = max_tokens
+        self.mode = mode
+        self.syntax_max_lines = syntax_max_lines
+        self.fingerprint = fingerprint
+        self.min_parallel_bytes = min_parallel_bytes
+        self.tokenizer_name = tokenizer_name
+        self.counter = counter
+        # 每个任务处理一组小文件；只预取有限数量的任务，分块结果不会在内存中无限堆积
+        self.files_per_task = 16
+        self.window = self.workers * 4
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def _parallel(self, paths: list[str]) -> bool:
+        """是否值得启动进程池：文件总大小达到 min_parallel_bytes（累加到阈值即停止 stat）"""
+        if self.workers <= 1 or len(paths) <= 1:
+            return False
+        total = 0
+        for p in paths:
+            if total >= self.min_parallel_bytes:
+                return True
+            try:
+                total += os.path.getsize(p)
+            except OSError:
+                pass
+        return total >= self.min_parallel_bytes
+
+    def imap(self, paths):
+        """按输入顺序产出 (path, chunks)"""
+        paths = list(paths)
+        if self._pool is None and self._parallel(paths):
+            # spawn：父进程里有事件循环和连接池线程，fork 这样的进程不安全
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=chunk_worker.init, initargs=(self.tokenizer_name,))
+        if self._pool is None:
+            counter = self.counter or TokenCounter(self.tokenizer_name)
+            for p in paths:
+                yield p, chunk_file(p, self.max_lines, self.max_tokens, counter, self.mode, self.syntax_max_lines,
+                                    self.fingerprint)
+            return
+
+        pending, group = deque(), []
+
+        def submit():
+            pending.append((group, self._pool.submit(chunk_worker.chunk_files, group, self.max_lines,
+                                                     self.max_tokens, self.mode, self.syntax_max_lines,
+                                                     self.fingerprint)))
+
+        for p in paths:
+            group.append(p)
+            if len(group) >= self.files_per_task:
+                submit()
+                group = []
+            if len(pending) >= self.window:
+                done, fut = pending.popleft()
+                yield from zip(done, fut.result())
+        if group:
+            submit()
+        while pending:
+            done, fut = pending.popleft()
+            yield from zip(done, fut.result())
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+自适应并发控制（AIMD）
+
+- 请求成功且延迟健康：并发窗口加性增长（每个窗口的成功请求 +1）
+- 延迟明显升高（超过最近若干次请求延迟的低分位数 × latency_tolerance）：窗口小幅收缩。
+  基线随最近的延迟滚动更新，偶然一次极快的响应不会让之后的正常请求一直被当成变慢
+- 429 / 5xx / 超时：窗口乘性减半，有 Retry-After 时在该时间内暂停发出新请求
+
+同一个控制器既可在协程中使用（async with limiter.slot()），也可在线程中使用
+（with limiter.sync_slot()）。当前窗口等指标通过 stats() 暴露。
+"""
+import time
+import random
+import asyncio
+import threading
+import email.utils
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+class AdaptiveConcurrency:
+    BASELINE_WINDOW = 100      # 延迟基线取最近这么多次成功请求
+    BASELINE_QUANTILE = 0.1    # 基线取最近延迟的 10% 分位数
+    BASELINE_MIN_SAMPLES = 5   # 样本少于此数时不因延迟收缩窗口
+
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: int = 64,
+                 latency_tolerance: float = 2.0, decrease_factor: float = 0.5, name: str = ""):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.inflight = 0
+        self.paused_until = 0.0
+        self.successes = 0
+        self.throttled = 0
+        self.errors = 0
+        self._baseline = None            # 健康状态下的延迟基线（最近延迟的低分位数）
+        self._recent = deque(maxlen=self.BASELINE_WINDOW)
+        self._latencies = deque(maxlen=512)
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+    # ---------- 窗口调整 ----------
+    def set_limit(self, limit: int) -> None:
+        with self._cond:
+            self.limit = float(min(max(limit, self.min_limit), self.max_limit))
+            self._cond.notify_all()
+
+    def on_success(self, latency: float) -> None:
+        with self._cond:
+            self.successes += 1
+            self._latencies.append(latency)
+            self._recent.append(latency)
+            recent = sorted(self._recent)
+            self._baseline = recent[int(len(recent) * self.BASELINE_QUANTILE)]
+            if len(recent) < self.BASELINE_MIN_SAMPLES or latency <= self._baseline * self.latency_tolerance:
+                # 加性增长：约每完成一个窗口的请求，窗口 +1
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            else:
+                # 延迟明显升高，说明服务端开始排队，轻微收缩
+                self._decrease(0.9)
+            self._cond.notify_all()
+
+    def on_throttle(self, retry_after: float = None) -> None:
+        """收到 429：窗口减半，并按 Retry-After 暂停"""
+        with self._cond:
+            self.throttled += 1
+            self._decrease(self.decrease_factor)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def on_error(self) -> None:
+        """5xx / 超时等服务端错误：窗口减半"""
+        with self._cond:
+            self.errors += 1
+            self._decrease(self.decrease_factor)
+
+    def _decrease(self, factor: float) -> None:
+        # 同一批并发请求同时失败时只收缩一次，避免窗口瞬间跌到底
+        now = time.monotonic()
+        if now - self._last_decrease < 0.2:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * factor)
+
+    # ---------- 获取 / 释放 ----------
+    def _try_acquire(self) -> float:
+        """能进入时返回 0，否则返回建议等待的秒数"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.inflight < int(self.limit):
+            self.inflight += 1
+            return 0.0
+        return 0.01
+
+    def _release(self) -> None:
+        with self._cond:
+            self.inflight -= 1
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        # 控制器可能被不同事件循环及线程共享，这里用短轮询而不是绑定某个循环的 asyncio 原语
+        while True:
+            with self._lock:
+                wait = self._try_acquire()
+            if not wait:
+                break
+            await asyncio.sleep(min(wait, 1.0))
+        try:
+            yield
+        finally:
+            self._release()
+
+    @contextmanager
+    def sync_slot(self):
+        with self._cond:
+            while True:
+                wait = self._try_acquire()
+                if not wait:
+                    break
+                self._cond.wait(timeout=min(wait, 1.0))
+        try:
+            yield
+        finally:
+            self._release()
+
+    # ---------- 指标 ----------
+    @property
+    def window(self) -> int:
+        return int(self.limit)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lat = sorted(self._latencies)
+            pct = (lambda q: lat[min(len(lat) - 1, int(q * len(lat)))] if lat else None)
+            return {
+                "name": self.name,
+                "window": int(self.limit),
+                "inflight": self.inflight,
+                "successes": self.successes,
+                "throttled": self.throttled,
+                "errors": self.errors,
+                "paused_for": max(0.0, self.paused_until - time.monotonic()),
+                "latency_p50": pct(0.5),
+                "latency_p99": pct(0.99),
+            }
+
+
+# ---------- 错误分类 ----------
+def status_code(exc: Exception):
+    """从 openai / httpx 异常中取出 HTTP 状态码"""
+    code = getattr(exc, "status_code", None)
+    if code is None and getattr(exc, "response", None) is not None:
+        code = getattr(exc.response, "status_code", None)
+    return code
+
+
+def retry_after_seconds(exc: Exception):
+    """解析 Retry-After / retry-after-ms 响应头，没有时返回 None"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    ms = headers.get("retry-after-ms")
+    if ms:
+        try:
+            return float(ms) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value)
+        return max(0.0, parsed.timestamp() - time.time()) if parsed else None
+
+
+def classify(exc: Exception) -> str:
+    """throttle（429）、server（5xx/超时/连接错误）或 client（其他，通常不值得重试）"""
+    code = status_code(exc)
+    if code == 429:
+        return "throttle"
+    if code is None or code >= 500 or code == 408:
+        return "server"
+    return "client"
+
+
+def backoff_delay(attempt: int, base: float, retry_after: float = None, cap: float = 60.0) -> float:
+    """优先使用服务端给出的 Retry-After，否则指数退避加随机抖动"""
+    if retry_after is not None:
+        return min(retry_after, cap)
+    return min(cap, base * (2 ** attempt)) * (0.5 + random.random() / 2)
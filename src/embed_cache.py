@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+跨项目的本地嵌入缓存（SQLite）
+
+键为 (模型名, 向量维度, 文本 md5)，值为 float32 向量。
+不同项目中相同的代码块（vendored 代码、生成代码、fork 仓库）只需嵌入一次。
+缓存总大小超过上限时按最近使用时间（LRU）淘汰。命中时的 last_used 先记在内存里，
+下次写入、淘汰、关闭或攒够一批时再一起写回，检索时的查询向量命中缓存不产生写事务。
+"""
+import os
+import time
+import sqlite3
+import threading
+import numpy as np
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model     TEXT    NOT NULL,
+    dim       INTEGER NOT NULL,
+    hash      TEXT    NOT NULL,
+    vec       BLOB    NOT NULL,
+    last_used REAL    NOT NULL,
+    PRIMARY KEY (model, dim, hash)
+);
+CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used);
+"""
+
+# SQLite 单条语句中变量个数有上限，批量查询时分段
+_QUERY_CHUNK = 500
+# 攒够这么多条命中记录再写回 last_used
+_TOUCH_BATCH = 1000
+
+
+class EmbeddingCache:
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        # 估算的总字节数（覆盖写入时会偏大，淘汰前重新精确统计）
+        self._approx_bytes = self.size_bytes()
+        self._touched = {}  # (model, dim, hash) -> 尚未写回的 last_used
+
+    def get_many(self, model: str, dim: int, hashes: list[str]) -> dict:
+        """批量查询，返回 {hash: 向量}，未命中的 hash 不出现在结果中"""
+        found = {}
+        keys = list(dict.fromkeys(hashes))
+        if not keys:
+            return found
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(keys), _QUERY_CHUNK):
+                part = keys[i:i + _QUERY_CHUNK]
+                marks = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT hash, vec FROM embeddings WHERE model=? AND dim=? AND hash IN ({marks})",
+                    (model, dim, *part),
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype="float32").copy()
+                    self._touched[(model, dim, h)] = now
+            if len(self._touched) >= _TOUCH_BATCH:
+                self._flush_touched()
+                self._conn.commit()
+        return found
+
+    def _flush_touched(self) -> None:
+        """把攒下的 last_used 写回（调用方持有锁并负责 commit）"""
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used=? WHERE model=? AND dim=? AND hash=?",
+                [(t, *k) for k, t in self._touched.items()],
+            )
+            self._touched = {}
+
+    def put_many(self, model: str, dim: int, items: dict) -> None:
+        """批量写入 {hash: 向量}"""
+        if not items:
+            return
+        now = time.time()
+        rows = [(model, dim, h, np.asarray(v, dtype="float32").tobytes(), now) for h, v in items.items()]
+        with self._lock:
+            self._flush_touched()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, dim, hash, vec, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+            self._approx_bytes += sum(len(r[3]) for r in rows)
+            if self._approx_bytes > self.max_bytes > 0:
+                self._evict()
+
+    def size_bytes(self) -> int:
+        row = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()
+        return int(row[0])
+
+    def _evict(self) -> None:
+        """超过上限时按 last_used 从旧到新删除，直到降到上限的 90%"""
+        if self.max_bytes <= 0:
+            return
+        total = self._approx_bytes = self.size_bytes()
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        removed = 0
+        cursor = self._conn.execute(
+            "SELECT rowid, LENGTH(vec) FROM embeddings ORDER BY last_used ASC"
+        )
+        victims = []
+        for rowid, size in cursor:
+            if total - removed <= target:
+                break
+            victims.append((rowid,))
+            removed += size
+        self._conn.executemany("DELETE FROM embeddings WHERE rowid=?", victims)
+        self._conn.commit()
+        self._approx_bytes = total - removed
+        print(f"[嵌入缓存] 淘汰 {len(victims)} 条向量，释放 {removed / 1024 / 1024:.1f} MB")
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+            self._conn.close()
+
+
+def open_cache(cfg: dict):
+    """按配置打开嵌入缓存，EMBED_CACHE=off 时返回 None"""
+    if str(cfg.get("EMBED_CACHE", "on")).lower() in ("off", "false", "0", "no"):
+        return None
+    path = cfg.get("EMBED_CACHE_PATH") or os.path.expanduser(os.path.join("~", ".ewiki", "embed_cache.sqlite3"))
+    max_bytes = int(float(cfg.get("EMBED_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+    try:
+        return EmbeddingCache(path, max_bytes)
+    except (sqlite3.Error, OSError) as e:
+        print(f"[嵌入缓存] 无法打开 {path}，不使用缓存: {e}")
+        return None
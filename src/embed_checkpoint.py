@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+嵌入阶段的断点续传
+
+每个批次完成后立即把向量写入检查点目录（默认 <index>.ckpt/），文件名为
+    b<批次序号>-<批次指纹>.npy
+批次指纹由模型、维度和该批全部 chunk 哈希计算，分块或模型变化后旧检查点不会被误用。
+构建中断（崩溃、Ctrl-C、批次重试耗尽）后重新运行时，已完成的批次直接从检查点读取，
+索引成功写入后整个目录被删除。
+"""
+import os
+import shutil
+import hashlib
+import numpy as np
+
+
+class EmbeddingCheckpoint:
+    def __init__(self, path: str, salt: str = ""):
+        self.path = str(path)
+        self.salt = salt
+        self.loaded = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def batch_key(self, hashes: list[str]) -> str:
+        h = hashlib.md5(self.salt.encode("utf-8"))
+        for x in hashes:
+            h.update(x.encode("ascii"))
+        return h.hexdigest()[:16]
+
+    def _file(self, batch_idx: int, key: str) -> str:
+        return os.path.join(self.path, f"b{batch_idx:06d}-{key}.npy")
+
+    def load(self, batch_idx: int, key: str, n: int):
+        """读取已完成批次的向量，不存在或条数不符时返回 None"""
+        f = self._file(batch_idx, key)
+        if not os.path.exists(f):
+            return None
+        try:
+            vecs = np.load(f)
+        except Exception:
+            return None
+        if len(vecs) != n:
+            return None
+        self.loaded += 1
+        return vecs
+
+    def save(self, batch_idx: int, key: str, vecs: np.ndarray) -> None:
+        # 先写临时文件再原子替换，进程中途被杀也不会留下半个检查点
+        f = self._file(batch_idx, key)
+        tmp = f + ".tmp"
+        with open(tmp, "wb") as g:
+            np.save(g, np.asarray(vecs, dtype="float32"))
+        os.replace(tmp, f)
+
+    def count(self) -> int:
+        return sum(1 for f in os.listdir(self.path) if f.endswith(".npy"))
+
+    def clear(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
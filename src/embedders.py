@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+可替换的嵌入后端
+
+    remote   OpenAI 兼容的嵌入接口（默认，DashScope text-embedding-v3），keep-alive 连接池
+    local    本地 CPU 推理（sentence-transformers，未安装时用 transformers 均值池化），
+             按批推理，线程数由 LOCAL_EMBED_THREADS 控制，隔离网络的构建机也能建索引
+    hashing  确定性的特征哈希向量，不依赖模型和网络，用于测试
+
+后端在 config.xml 中选择：EMBED_BACKEND 为默认值，EMBED_BACKEND_BY_PROJECT 按项目覆盖
+（"项目名=后端" 逗号分隔，项目名与项目根目录或索引目录路径中的任一目录名匹配）。
+不同后端的向量互不兼容，构建时所用的后端记录在索引参数中，检索时按记录选择。
+"""
+import os
+import asyncio
+import threading
+import weakref
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+from openai import OpenAI, AsyncOpenAI
+
+BACKENDS = ("remote", "local", "hashing")
+
+
+class Embedder:
+    """嵌入后端接口：embed / aembed 返回 float32 矩阵（未归一化也可以，调用方统一归一化）"""
+    backend = ""
+    remote = False  # 是否经过网络（决定是否使用自适应并发窗口和重试）
+
+    name: str
+    dim: int
+    model_name = ""  # 模型名或本地模型目录，用于查找同名分词器（hashing 后端为空）
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    async def aembed(self, texts: list[str]) -> np.ndarray:
+        return await asyncio.get_running_loop().run_in_executor(None, self.embed, texts)
+
+    async def aclose(self) -> None:
+        """释放当前事件循环上的资源（临时事件循环结束前调用）"""
+
+    def describe(self) -> dict:
+        """写入索引参数的后端标识"""
+        return {"backend": self.backend, "name": self.name, "dim": self.dim}
+
+
+class RemoteEmbedder(Embedder):
+    backend = "remote"
+    remote = True
+
+    def __init__(self, model: str, base_url: str, api_key: str, dim: int, timeout: float = 30,
+                 max_connections: int = 32, keepalive_expiry: float = 60):
+        self.name = model
+        self.model_name = model
+        self.dim = dim
+        self.base_url = base_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self._client = None
+        self._client_lock = threading.Lock()
+        # 异步客户端绑定事件循环，每个循环一个连接池
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=self.max_connections,
+                            keepalive_expiry=self.keepalive_expiry)
+
+    def _timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.timeout, connect=min(10, self.timeout))
+
+    def client(self) -> OpenAI:
+        """进程内共享的同步客户端（keep-alive 连接池）"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = OpenAI(api_key=self.api_key, base_url=self.base_url,
+                                          http_client=httpx.Client(limits=self._limits(), timeout=self._timeout()))
+        return self._client
+
+    def async_client(self) -> AsyncOpenAI:
+        """当前事件循环共享的异步客户端（重试由调用方控制）"""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                                 http_client=httpx.AsyncClient(limits=self._limits(), timeout=self._timeout()))
+            self._async_clients[loop] = client
+        return client
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        resp = self.client().embeddings.create(model=self.name, input=texts, dimensions=self.dim,
+                                               encoding_format="float")
+        return np.array([item.embedding for item in resp.data], dtype="float32")
+
+    async def aembed(self, texts: list[str]) -> np.ndarray:
+        resp = await self.async_client().embeddings.create(model=self.name, input=texts, dimensions=self.dim,
+                                                           encoding_format="float")
+        return np.array([item.embedding for item in resp.data], dtype="float32")
+
+    async def aclose(self) -> None:
+        client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+
+class LocalEmbedder(Embedder):
+    backend = "local"
+
+    def __init__(self, model: str, batch_size: int = 32, threads: int = 0, max_length: int = 512):
+        self.model_name = model
+        self.name = f"local:{model}"
+        self.batch_size = max(1, batch_size)
+        self.threads = threads
+        self.max_length = max_length
+        self._model = None
+        self._tokenizer = None  # 仅 transformers 回退路径使用
+        self._dim = None
+        self._lock = threading.Lock()
+        # 推理串行执行，并行度交给 torch 的算子内线程（threads）
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="local-embed")
+
+    def _load(self) -> None:
+        if self._model is not None:
+            return
+        import torch
+        if self.threads > 0:
+            torch.set_num_threads(self.threads)
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            SentenceTransformer = None
+        print(f"[本地嵌入] 加载模型 {self.model_name}")
+        if SentenceTransformer is not None:
+            model = SentenceTransformer(self.model_name, device="cpu")
+            model.max_seq_length = min(model.max_seq_length or self.max_length, self.max_length)
+            self._dim = model.get_sentence_embedding_dimension()
+        else:
+            from transformers import AutoModel, AutoTokenizer
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            model = AutoModel.from_pretrained(self.model_name).eval()
+            self._dim = model.config.hidden_size
+        self._model = model
+
+    @property
+    def dim(self) -> int:
+        if self._dim is None:
+            with self._lock:
+                self._load()
+        return self._dim
+
+    def _encode_transformers(self, texts: list[str]) -> np.ndarray:
+        import torch
+        out = []
+        for i in range(0, len(texts), self.batch_size):
+            enc = self._tokenizer(texts[i:i + self.batch_size], padding=True, truncation=True,
+                                  max_length=self.max_length, return_tensors="pt")
+            with torch.inference_mode():
+                hidden = self._model(**enc).last_hidden_state
+            mask = enc["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            out.append(((hidden * mask).sum(1) / mask.sum(1).clamp(min=1)).numpy())
+        return np.concatenate(out).astype("float32") if out else np.empty((0, self._dim), dtype="float32")
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        with self._lock:
+            self._load()
+            if self._tokenizer is not None:
+                return self._encode_transformers(texts)
+            return np.asarray(self._model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                                 show_progress_bar=False), dtype="float32")
+
+    async def aembed(self, texts: list[str]) -> np.ndarray:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.embed, texts)
+
+
+class HashingEmbedder(Embedder):
+    """标识符感知分词后做带符号的特征哈希，同样的文本总是得到同样的向量"""
+    backend = "hashing"
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.name = f"hashing:{dim}"
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        from .lexical_index import tokenize
+        out = np.zeros((len(texts), self.dim), dtype="float32")
+        for i, text in enumerate(texts):
+            hashes = np.fromiter((zlib.crc32(t.encode("utf-8")) for t in tokenize(text)), dtype=np.uint32)
+            if not len(hashes):
+                out[i, 0] = 1.0
+                continue
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype("float32")
+            np.add.at(out[i], (hashes % self.dim).astype(np.int64), signs)
+        return out
+
+
+def create_embedder(backend: str, cfg: dict) -> Embedder:
+    backend = (backend or "remote").lower()
+    if backend == "remote":
+        return RemoteEmbedder(cfg["EMBED_NAME"], cfg["EMBED_URL"], cfg["API_KEY"], int(cfg.get("EMBED_DIM") or 768),
+                              timeout=float(cfg.get("EMBED_TIMEOUT") or 30),
+                              max_connections=int(cfg.get("EMBED_MAX_CONNECTIONS") or 32),
+                              keepalive_expiry=float(cfg.get("EMBED_KEEPALIVE_EXPIRY") or 60))
+    if backend == "local":
+        return LocalEmbedder(cfg.get("LOCAL_EMBED_MODEL") or "BAAI/bge-small-zh-v1.5",
+                             batch_size=int(cfg.get("LOCAL_EMBED_BATCH") or 32),
+                             threads=int(cfg.get("LOCAL_EMBED_THREADS") or 0))
+    if backend == "hashing":
+        return HashingEmbedder(int(cfg.get("EMBED_DIM") or 768))
+    raise ValueError(f"未知的嵌入后端: {backend}（可选 {', '.join(BACKENDS)}）")
+
+
+@lru_cache(maxsize=1024)
+def _path_parts(p: str) -> tuple:
+    """解析后的路径各级目录名（每次检索都会创建 IndexHandle，避免重复 resolve 的 lstat）"""
+    return Path(p).resolve().parts
+
+
+def project_value(cfg: dict, key: str, *paths) -> str:
+    """
+    按项目覆盖的配置项：cfg[key] 形如 "项目名=值, 项目名=值"，项目名与 paths 中任一目录名匹配时
+    返回对应的值，否则返回 None
+    """
+    mapping = {}
+    for item in (cfg.get(key) or "").split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            mapping[name.strip()] = value.strip()
+    for p in paths:
+        if not p:
+            continue
+        for part in reversed(_path_parts(os.path.abspath(p))):
+            if part in mapping:
+                return mapping[part]
+    return None
+
+
+def project_backend(cfg: dict, *paths) -> str:
+    """按 EMBED_BACKEND_BY_PROJECT 为项目选择后端，未配置时使用 EMBED_BACKEND"""
+    return (project_value(cfg, "EMBED_BACKEND_BY_PROJECT", *paths) or cfg.get("EMBED_BACKEND") or "remote").lower()
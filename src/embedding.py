@@ -7,22 +7,44 @@ author: kimi
 """
 import os
 import re
+import copy
 import json
+import shutil
 import argparse
 import hashlib
+import time
 import asyncio
+import threading
+from array import array
 import aiohttp
 import numpy as np
 import faiss
 from tqdm import tqdm
 from pathlib import Path
 import xml.etree.ElementTree as ET
-from openai import OpenAI
+from contextlib import contextmanager
 from concurrent.futures import ThreadPoolExecutor
 
 from .config import load_config
-import nest_asyncio
-nest_asyncio.apply()
+from .embed_cache import open_cache
+from .embed_checkpoint import EmbeddingCheckpoint
+from .vector_buffer import VectorBuffer
+from . import chunking
+from .chunking import FileChunker, resolve_workers
+from .near_dup import SimHashIndex
+from .lexical_index import LexicalIndex, LexicalIndexWriter, looks_like_identifier, rrf_fuse, merge_lexical
+from .repo_walker import walk_files
+from .batching import TokenCounter, local_tokenizer, pack_batches
+from .embedders import Embedder, create_embedder, project_backend, project_value
+from .concurrency import AdaptiveConcurrency, classify, retry_after_seconds, backoff_delay
+from .index_registry import IndexRegistry
+from .index_generations import GenerationStore
+from .index_factory import (choose_spec, build_from_vectors, apply_search_params, save_spec, load_spec, is_lossy,
+                            index_memory_bytes, convert_index, truncate_vectors, filtered_search, params_file,
+                            stored_vectors, STORAGE_TYPES)
+from .search_filter import SearchFilter, allowed_rows, allowed_groups
+from .meta_store import (MetaWriter, ChunkMeta, open_meta, meta_exists, meta_marker, remove_meta, store_files,
+                         chunk_hashes, chunk_keys, dup_rows, write_manifest, read_manifest)
 cfg = load_config()
 
 # ---------- 配置参数 ----------
@@ -36,319 +58,1387 @@ META_FILE = cfg["META_FILE"]
 MAX_LINES = int(cfg["MAX_LINES"])
 BATCH_SIZE = int(cfg["BATCH_SIZE"])
 DEFAULT_TOPK = int(cfg["TOP_K"])
+EMBED_DIM = int(cfg.get("EMBED_DIM", "768"))  # 嵌入向量维度
+INDEX_DIM = int(cfg.get("INDEX_DIM") or 0)  # 默认索引维度（Matryoshka 截断），0 表示与嵌入维度相同
+EMBED_MAX_ITEM_TOKENS = int(cfg.get("EMBED_MAX_ITEM_TOKENS", "8192"))  # 单条文本 token 上限
+EMBED_MAX_BATCH_TOKENS = int(cfg.get("EMBED_MAX_BATCH_TOKENS", "65536"))  # 单个请求 token 上限
 
 # 异步并发配置
-MAX_CONCURRENT = int(cfg.get("MAX_CONCURRENT", "5"))  # 最大并发数
-EMBED_TIMEOUT = int(cfg.get("EMBED_TIMEOUT", "30"))  # 嵌入超时时间
+MAX_CONCURRENT = int(cfg.get("MAX_CONCURRENT", "5"))  # 初始并发数
+MAX_CONCURRENT_LIMIT = int(cfg.get("MAX_CONCURRENT_LIMIT", str(MAX_CONCURRENT * 4)))  # 自适应并发上限
+BUILD_QUEUE_SIZE = int(cfg.get("BUILD_QUEUE_SIZE", "64"))  # 分块→嵌入之间最多缓冲的批次数
+CHUNK_WORKERS = resolve_workers(cfg.get("CHUNK_WORKERS"))  # 分块进程数，0 表示使用全部 CPU 核
+CHUNK_PARALLEL_MIN_KB = int(cfg.get("CHUNK_PARALLEL_MIN_KB", "8192"))  # 文件总大小不足该值时不启动分块进程池
+CHUNK_MODE = cfg.get("CHUNK_MODE") or "syntax"  # syntax：按类/函数边界分块；lines：固定行数
+SYNTAX_MAX_LINES = int(cfg.get("SYNTAX_MAX_LINES", "120"))  # 语法分块时单块最大行数
+NEAR_DUP = (cfg.get("NEAR_DUP") or "on").lower() not in ("off", "false", "0", "no")  # 近似重复块只嵌入代表块
+NEAR_DUP_DISTANCE = int(cfg.get("NEAR_DUP_DISTANCE", "3"))  # SimHash 海明距离阈值（0~3）
+HYBRID_SEARCH = (cfg.get("HYBRID_SEARCH") or "on").lower() not in ("off", "false", "0", "no")  # 向量 + BM25 混合检索
+LEXICAL_FAST_PATH = (cfg.get("LEXICAL_FAST_PATH") or "on").lower() not in ("off", "false", "0", "no")  # 标识符查询只走 BM25
+RRF_K = int(cfg.get("RRF_K", "60"))  # 倒数排名融合常数
+BOOST_FETCH_FACTOR = int(cfg.get("BOOST_FETCH_FACTOR", "8"))  # boost 范围检索时向量候选的放大倍数
 
 CODE_EXT = [".py", ".js", ".ts", ".java", ".cpp", ".c", ".h", ".hpp", ".go", ".rs",
             ".jsx", ".tsx", ".html", ".css", ".php", ".swift", ".cs"]
 DOC_EXT = [".md", ".txt", ".rst", ".json", ".yaml", ".yml", ".xml", ".csv"]
 KNOWLEDGE_EXT = [".pdf", ".doc", ".docx", ".xls", ".xlsx"] + DOC_EXT + CODE_EXT
 
+# 嵌入请求的自适应并发窗口（AIMD，遇到 429/5xx 收缩并遵守 Retry-After）
+EMBED_LIMITER = AdaptiveConcurrency(MAX_CONCURRENT, max_limit=MAX_CONCURRENT_LIMIT, name="embedding")
+
+# 嵌入后端（remote / local / hashing），构建时按项目选择，检索时使用索引记录的后端
+EMBEDDER = create_embedder(cfg.get("EMBED_BACKEND"), cfg)
+_EMBEDDERS = {EMBEDDER.backend: EMBEDDER}
+_EMBEDDERS_LOCK = threading.Lock()
+
+# 嵌入请求的 token 计数（用于切分超长文本块和按 token 装箱）；
+# EMBED_TOKENIZER 为空时使用本地能找到的嵌入模型分词器，都没有时按字符估算
+EMBED_TOKENIZER = cfg.get("EMBED_TOKENIZER") or local_tokenizer(EMBEDDER.model_name)
+TOKEN_COUNTER = TokenCounter(EMBED_TOKENIZER)
+if TOKEN_COUNTER.approximate and not cfg.get("EMBED_TOKENIZER"):
+    print(f"[分词器] 本地找不到嵌入模型 {EMBEDDER.name} 的分词器，token 数按字符估算"
+          "（可在 config.xml 的 EMBED_TOKENIZER 中指定 tokenizer.json 路径或模型名）")
+
+# 跨项目的嵌入缓存 (模型, 维度, 文本哈希) -> 向量
+EMBED_CACHE = open_cache(cfg)
+
+# 已加载索引的进程内缓存，按文件 mtime/size 失效，超出内存预算按 LRU 淘汰
+INDEX_REGISTRY = IndexRegistry(int(float(cfg.get("INDEX_CACHE_MB", "1024")) * 1024 * 1024))
+
+# 索引快照保留的代数（含当前代），构建期间读者继续使用旧一代，见 index_generations
+INDEX_KEEP_GENERATIONS = int(cfg.get("INDEX_KEEP_GENERATIONS", "2"))
+INDEX_GENERATION_GRACE = float(cfg.get("INDEX_GENERATION_GRACE", "300"))  # 被替换的一代至少保留的秒数
+# 检索时复用多少秒内读到的 CURRENT（本进程内的切换立即可见，其他进程的构建最多晚这么久生效）
+INDEX_POINTER_TTL = float(cfg.get("INDEX_POINTER_TTL", "1"))
+
 
 def md5txt(text: str) -> str:
     return hashlib.md5(text.encode("utf-8")).hexdigest()
 
 
-def list_files(root: str):
+def list_files(root: str, source_filters: bool = True, exclude=()):
+    """待索引文件：遵守 .gitignore/.ewikiignore 和默认排除；source_filters=True（代码仓库）时
+    还跳过超大、压缩和生成文件，知识库文档、调用图 JSON 这类本身就要检索的文件不做这两项过滤。
+    exclude 为额外的忽略规则（语法同 .gitignore）"""
     root_path = Path(root)
     if root_path.is_file():
         yield str(root_path)
+    elif source_filters:
+        yield from walk_files(root, KNOWLEDGE_EXT, extra_excludes=exclude)
     else:
-        root = os.path.abspath(root)
-        for dirpath, _, filenames in os.walk(root):
-            for f in filenames:
-                ext = os.path.splitext(f)[1].lower()
-                if ext in KNOWLEDGE_EXT:
-                    yield os.path.join(dirpath, f)
+        yield from walk_files(root, KNOWLEDGE_EXT, max_file_bytes=0, detect_generated=False, extra_excludes=exclude)
 
 
 def read_chunks(path: str, max_lines=MAX_LINES):
-    """
-       改进的文本分块函数
+    """按固定行数分块，见 chunking.read_chunks"""
+    return chunking.read_chunks(path, max_lines)
 
-       修复空行处理和行号计算问题，避免生成过小的文本块
-       """
-    skip_empty_lines = False  # 默认不跳过空行，避免行号计算错误
-    min_chunk_size = 10  # 最小块大小（字符数），避免过小的块
 
-    chunks = []
-    current_chunk = []
-    current_line_count = 0
-    start_line = 1
+# ---------- 嵌入后端 ----------
+def get_embedder(backend: str) -> Embedder:
+    """同一后端在进程内只创建一次（本地模型只加载一次）"""
+    embedder = _EMBEDDERS.get(backend)
+    if embedder is None:
+        with _EMBEDDERS_LOCK:
+            embedder = _EMBEDDERS.get(backend)
+            if embedder is None:
+                embedder = _EMBEDDERS[backend] = create_embedder(backend, cfg)
+    return embedder
 
-    with open(path, encoding="utf-8", errors="ignore") as f:
-        lines = list(f)  # 一次性读取所有行
 
-    actual_line_num = 0
-    for line_num, line in enumerate(lines, 1):
-        # 处理空行
-        if skip_empty_lines and not line.strip():
-            continue
+def use_embedder(embedder: Embedder) -> None:
+    """替换某个后端的实例（并设为默认后端），之后创建的 IndexHandle 都使用它"""
+    global EMBEDDER
+    EMBEDDER = _EMBEDDERS[embedder.backend] = embedder
 
-        actual_line_num += 1
-        current_chunk.append(line)
-        current_line_count += 1
 
-        # 达到最大行数时分割
-        if current_line_count >= max_lines:
-            chunk_text = "".join(current_chunk)
-            # 只有块达到最小大小才保存
-            if len(chunk_text.strip()) >= min_chunk_size:
-                chunks.append((start_line, chunk_text))
-            current_chunk = []
-            current_line_count = 0
-            start_line = actual_line_num + 1
+def index_embedder(index_file: str = None) -> Embedder:
+    """索引构建时使用的后端（记录在索引参数中）；旧索引没有记录，视为远程接口"""
+    return spec_embedder(load_spec(index_file or INDEX_FILE))
 
-    # 处理剩余内容
-    if current_chunk:
-        chunk_text = "".join(current_chunk)
-        if len(chunk_text.strip()) >= min_chunk_size:
-            chunks.append((start_line, chunk_text))
 
-    return chunks
+def spec_embedder(spec: dict) -> Embedder:
+    """索引参数 spec 中记录的构建后端（见 index_embedder）"""
+    info = spec.get("embedder") or {"backend": "remote", "name": EMBED_NAME}
+    embedder = get_embedder(info["backend"])
+    if embedder.name != info.get("name"):
+        print(f"[嵌入] 警告: 索引由 {info.get('name')} 构建，当前配置为 {embedder.name}，检索结果可能不准确")
+    return embedder
 
 
-def embed_batch(texts: list[str]) -> np.ndarray:
+async def close_async_client():
+    """关闭当前事件循环上的嵌入客户端（临时事件循环结束前调用）"""
+    for embedder in list(_EMBEDDERS.values()):
+        await embedder.aclose()
+
+
+def _lookup_cache(texts: list[str], embedder: Embedder):
+    """查询嵌入缓存，返回 (文本哈希列表, 命中的 {hash: 向量}, 未命中文本的下标)"""
+    keys = [md5txt(t) for t in texts]
+    hits = EMBED_CACHE.get_many(embedder.name, embedder.dim, keys) if EMBED_CACHE else {}
+    missing = [i for i, k in enumerate(keys) if k not in hits]
+    return keys, hits, missing
+
+
+def _merge_cache(keys: list[str], hits: dict, missing: list[int], vecs: np.ndarray, embedder: Embedder) -> np.ndarray:
+    """把新嵌入的向量写回缓存，并按原顺序拼出完整结果"""
+    fresh = {keys[i]: v for i, v in zip(missing, vecs)}
+    if EMBED_CACHE and fresh:
+        EMBED_CACHE.put_many(embedder.name, embedder.dim, fresh)
+    hits.update(fresh)
+    return np.array([hits[k] for k in keys], dtype="float32")
+
+
+def embed_batch(texts: list[str], embedder: Embedder = None) -> np.ndarray:
     """同步嵌入批处理（用于查询时的单批次处理）"""
-    processed_texts = []
-    for text in texts:
-        if len(text) > 8192:
-            text = text[:8192]
-        processed_texts.append(text)
-
-    client = OpenAI(
-        api_key=API_KEY,
-        base_url=DASHSCOPE_EMBED_URL
-    )
-    resp = client.embeddings.create(
-        model=EMBED_NAME,
-        input=processed_texts,
-        dimensions=768,
-        encoding_format="float"
-    )
-    vecs = [item.embedding for item in resp.data]
-    return np.array(vecs, dtype="float32")
-
-
-async def async_embed_batch(texts: list[str]) -> np.ndarray:
+    embedder = embedder or EMBEDDER
+    processed_texts = [TOKEN_COUNTER.truncate(text, EMBED_MAX_ITEM_TOKENS) for text in texts]
+
+    keys, hits, missing = _lookup_cache(processed_texts, embedder)
+    if not missing:
+        return _merge_cache(keys, hits, missing, np.empty((0, embedder.dim), dtype="float32"), embedder)
+
+    vecs = embedder.embed([processed_texts[i] for i in missing])
+    return _merge_cache(keys, hits, missing, vecs, embedder)
+
+
+async def async_embed_batch(texts: list[str], embedder: Embedder = None) -> np.ndarray:
     """异步嵌入批处理"""
-    processed_texts = []
-    for text in texts:
-        if len(text) > 8192:
-            text = text[:8192]
-        processed_texts.append(text)
-
-    client = OpenAI(
-        api_key=API_KEY,
-        base_url=DASHSCOPE_EMBED_URL
-    )
-
-    # 使用异步调用
-    resp = await asyncio.to_thread(
-        client.embeddings.create,
-        model=EMBED_NAME,
-        input=processed_texts,
-        dimensions=768,
-        encoding_format="float"
-    )
-
-    vecs = [item.embedding for item in resp.data]
-    return np.array(vecs, dtype="float32")
-
-
-async def async_embed_batch_with_retry(texts: list[str], max_retries=3, retry_delay=1):
-    """带重试机制的异步嵌入"""
+    embedder = embedder or EMBEDDER
+    processed_texts = [TOKEN_COUNTER.truncate(text, EMBED_MAX_ITEM_TOKENS) for text in texts]
+
+    keys, hits, missing = _lookup_cache(processed_texts, embedder)
+    if not missing:
+        return _merge_cache(keys, hits, missing, np.empty((0, embedder.dim), dtype="float32"), embedder)
+
+    vecs = await embedder.aembed([processed_texts[i] for i in missing])
+    return _merge_cache(keys, hits, missing, vecs, embedder)
+
+
+async def async_embed_batch_with_retry(texts: list[str], max_retries=5, retry_delay=1, embedder: Embedder = None):
+    """带重试机制的异步嵌入：受自适应并发窗口控制，429 时遵守 Retry-After，其余错误指数退避
+
+    本地 / 哈希后端不经过网络，直接计算，不占用并发窗口也不重试。
+    """
+    embedder = embedder or EMBEDDER
+    if not embedder.remote:
+        return await async_embed_batch(texts, embedder)
+    # 缓存在进入并发窗口之前查询：全部命中的批次不发请求，只有真正的网络请求才计入延迟
+    processed_texts = [TOKEN_COUNTER.truncate(text, EMBED_MAX_ITEM_TOKENS) for text in texts]
+    keys, hits, missing = _lookup_cache(processed_texts, embedder)
+    if not missing:
+        return _merge_cache(keys, hits, missing, np.empty((0, embedder.dim), dtype="float32"), embedder)
+    pending = [processed_texts[i] for i in missing]
     for attempt in range(max_retries):
         try:
-            return await async_embed_batch(texts)
+            async with EMBED_LIMITER.slot():
+                started = time.monotonic()
+                vecs = await embedder.aembed(pending)
+            EMBED_LIMITER.on_success(time.monotonic() - started)
+            return _merge_cache(keys, hits, missing, vecs, embedder)
         except Exception as e:
-            if attempt == max_retries - 1:
+            kind = classify(e)
+            retry_after = retry_after_seconds(e)
+            if kind == "throttle":
+                EMBED_LIMITER.on_throttle(retry_after)
+            elif kind == "server":
+                EMBED_LIMITER.on_error()
+            if kind == "client" or attempt == max_retries - 1:
                 raise
-            print(f"嵌入失败，第{attempt + 1}次重试: {e}")
-            await asyncio.sleep(retry_delay * (attempt + 1))
+            delay = backoff_delay(attempt, retry_delay, retry_after)
+            print(f"嵌入失败({kind})，{delay:.1f}s 后第{attempt + 1}次重试，当前并发窗口 {EMBED_LIMITER.window}: {e}")
+            await asyncio.sleep(delay)
 
 
-async def async_smart_batch_embedding(meta, batch_size=BATCH_SIZE, max_length=8192, max_concurrent=MAX_CONCURRENT):
-    """并发批处理embedding"""
-    all_vecs = []
-    truncation_count = 0
-    semaphore = asyncio.Semaphore(max_concurrent)  # 控制并发数
+class EmbeddingBatchError(RuntimeError):
+    """部分批次重试后仍失败（已完成的批次保留在检查点中）"""
 
-    async def process_batch(batch_meta, batch_idx):
-        async with semaphore:
-            try:
-                batch_texts = []
-                for m in batch_meta:
-                    text = m["text"]
-                    if len(text) > max_length:
-                        text = text[:max_length]
-                        nonlocal truncation_count
-                        truncation_count += 1
-                    batch_texts.append(text)
-
-                print(f"处理批次 {batch_idx} ({len(batch_texts)}个文本)")
-                return await async_embed_batch_with_retry(batch_texts)
-            except Exception as e:
-                print(f"批次 {batch_idx} 处理失败: {e}")
-                return None
 
-    # 创建所有批次任务
-    tasks = []
-    batch_idx = 0
-    for i in range(0, len(meta), batch_size):
-        batch_meta = meta[i:i + batch_size]
-        tasks.append(process_batch(batch_meta, batch_idx))
-        batch_idx += 1
+async def async_smart_batch_embedding(meta, batch_size=BATCH_SIZE, batch_tokens=EMBED_MAX_BATCH_TOKENS,
+                                      max_concurrent=None, checkpoint: EmbeddingCheckpoint = None,
+                                      embedder: Embedder = None):
+    """并发批处理embedding：按 token 数装箱，每个请求不超过 batch_size 条、batch_tokens 个 token
+
+    并发数由 EMBED_LIMITER 自适应调整，max_concurrent 仅用于指定初始窗口。
+    返回与 meta 一一对应的向量矩阵；传入 checkpoint 时每个完成的批次立即落盘，重新运行时跳过。
+    任一批次最终失败则抛出异常（已完成的批次仍保留在检查点中），不会返回错位的结果。
+    """
+    if max_concurrent:
+        EMBED_LIMITER.set_limit(max_concurrent)
+
+    # 分块阶段已记录 token 数的直接使用，其余现场计数
+    texts = [m["text"] for m in meta]
+    counts = [m.get("tokens", 0) for m in meta]
+    uncounted = [i for i, m in enumerate(meta) if "tokens" not in m]
+    for i, n in zip(uncounted, TOKEN_COUNTER.count([texts[i] for i in uncounted])):
+        counts[i] = n
+    truncation_count = sum(1 for n in counts if n > EMBED_MAX_ITEM_TOKENS)
+
+    batches = pack_batches(counts, batch_size, batch_tokens)
+    results = [None] * len(batches)
+    keys = [None] * len(batches)
+    if checkpoint is not None:
+        for batch_idx, batch in enumerate(batches):
+            keys[batch_idx] = checkpoint.batch_key([meta[i].get("hash") or md5txt(texts[i]) for i in batch])
+            results[batch_idx] = checkpoint.load(batch_idx, keys[batch_idx], len(batch))
+        if checkpoint.loaded:
+            print(f"[断点续传] 从检查点恢复 {checkpoint.loaded}/{len(batches)} 个批次")
+
+    async def process_batch(batch_texts, batch_idx):
+        try:
+            print(f"处理批次 {batch_idx} ({len(batch_texts)}个文本)")
+            vecs = await async_embed_batch_with_retry(batch_texts, embedder=embedder)
+            if checkpoint is not None:
+                checkpoint.save(batch_idx, keys[batch_idx], vecs)
+            return batch_idx, vecs
+        except Exception as e:
+            print(f"批次 {batch_idx} 处理失败: {e}")
+            return batch_idx, None
+
+    # 只为没有检查点的批次创建任务
+    tasks = [process_batch([texts[i] for i in batch], batch_idx)
+             for batch_idx, batch in enumerate(batches) if results[batch_idx] is None]
 
     # 并发执行并显示进度
-    print(f"开始处理 {len(tasks)} 个批次，最大并发数: {max_concurrent}")
-    batch_results = []
-    for i, task in enumerate(tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="嵌入处理")):
-        result = await task
-        batch_results.append(result)
-
-    # 处理结果
-    valid_vecs = []
-    failed_batches = 0
-
-    for i, result in enumerate(batch_results):
-        if result is None:
-            print(f"批次 {i} 失败")
-            failed_batches += 1
+    print(f"开始处理 {len(tasks)} 个批次 (平均 {len(meta) / max(len(batches), 1):.1f} 条/批)，"
+          f"初始并发窗口: {EMBED_LIMITER.window}")
+    failed_batches = []
+    for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="嵌入处理"):
+        batch_idx, vecs = await task
+        if vecs is None:
+            failed_batches.append(batch_idx)
         else:
-            valid_vecs.append(result)
+            results[batch_idx] = vecs
 
     if truncation_count > 0:
-        print(f"警告: {truncation_count} 个文本被截断到 {max_length} 字符")
+        print(f"警告: {truncation_count} 个文本超过 {EMBED_MAX_ITEM_TOKENS} tokens，已被截断")
 
-    if failed_batches > 0:
-        print(f"有 {failed_batches} 个批次处理失败")
+    stats = EMBED_LIMITER.stats()
+    print(f"并发窗口: {stats['window']}，限流 {stats['throttled']} 次，服务端错误 {stats['errors']} 次")
 
-    return valid_vecs
+    if failed_batches:
+        hint = "，已完成的批次已写入检查点，重新运行即可续传" if checkpoint is not None else ""
+        raise EmbeddingBatchError(f"有 {len(failed_batches)} 个批次处理失败: {sorted(failed_batches)[:10]}{hint}")
 
+    # 按 meta 顺序组装（批次完成顺序与提交顺序无关）
+    if not batches:
+        return np.empty((0, (embedder or EMBEDDER).dim), dtype="float32")
+    dim = results[0].shape[1]
+    out = np.empty((len(meta), dim), dtype="float32")
+    for batch, vecs in zip(batches, results):
+        out[batch] = vecs
+    return out
 
-def build_index(project_root: str):
-    """构建向量索引（修复异步处理问题）"""
-    import time
-    start_time = time.time()
 
-    # 文件扫描和分块
-    files = list(list_files(project_root))
-    meta, all_vecs = [], []
+def load_reusable_vectors(handle: "IndexHandle"):
+    """读取已有索引，返回 (index, {chunk hash: 行号})，供增量构建按需还原向量
 
-    print(f"扫描到 {len(files)} 个文件，开始分块处理...")
-    file_start = time.time()
-    for fp in tqdm(files, desc="文件分块"):
-        for start, text in read_chunks(fp):
-            meta.append({"path": fp, "start": start, "text": text})
-    file_time = time.time() - file_start
+    只保存行号而不是向量，复用时用 index.reconstruct 逐条取出（索引编号即元数据行号）。
+    重复块在旧索引中没有向量，只登记代表块。
+    """
+    if not handle.exists():
+        return None, {}
+    spec = load_spec(handle.index_file)
+    old_embedder = (spec.get("embedder") or {}).get("name", EMBED_NAME)
+    if old_embedder != handle.embedder.name:
+        print(f"[增量] 旧索引由 {old_embedder} 构建，当前为 {handle.embedder.name}，向量不兼容，全部重新嵌入")
+        return None, {}
+    if is_lossy(spec):
+        # 量化索引无法精确还原向量，未变化的块交给嵌入缓存命中
+        print("[增量] 旧索引为量化索引，不从索引还原向量")
+        return None, {}
+    try:
+        with handle.loaded() as (index, old_meta):
+            dup = dup_rows(old_meta)
+            hashes = chunk_hashes(old_meta)
+        n_reps = int((dup < 0).sum())
+        if index.ntotal != n_reps:
+            print(f"[增量] 旧索引与元数据数量不一致 ({index.ntotal} != {n_reps})，放弃复用")
+            return None, {}
+        if index.d < handle.dim:
+            print(f"[增量] 旧索引维度 {index.d} 小于当前索引维度 {handle.dim}，放弃复用")
+            return None, {}
+    except Exception as e:
+        print(f"[增量] 读取旧索引失败，放弃复用: {e}")
+        return None, {}
+
+    rows = {}
+    for i, h in enumerate(hashes):
+        if dup[i] < 0:
+            rows.setdefault(h, i)
+    return index, rows
+
+
+def _produce_batches(project_root: str, writer: MetaWriter, vbuf: VectorBuffer, reuse, old_keys, put, stats: dict,
+                     lexical: LexicalIndexWriter = None, files=None):
+    """
+    生产者：遍历文件 → 分块 → 去重 → 写元数据 → 复用 → 按 token 装箱，
+    每凑满一个批次就通过 put() 交给嵌入阶段（队列满时阻塞，内存有上界）。
 
-    print(f"分块完成: {len(meta)} 个文本块, 耗时: {file_time:.2f}s")
+    完全相同（md5）或近似重复（SimHash）的块只嵌入第一次出现的代表块，其余行在元数据中
+    记录 dup_of，不进入向量索引；进入索引的行号收集在 stats["reps"]。
+    lexical 不为空时所有行（包括重复块）同时写入 BM25 倒排索引。
+    files 为待索引文件（见 IndexHandle.list_files），为空时遍历 project_root。
+    """
+    old_index, reuse_rows = reuse
+    first_row = {}  # 本次构建中每个 hash 对应的代表块行号
+    simidx = SimHashIndex(NEAR_DUP_DISTANCE) if NEAR_DUP else None
+    batch, batch_tokens = [], 0
+    # 分块在进程池中并行，结果按文件顺序合并，行号与单进程构建一致
+    with FileChunker(CHUNK_WORKERS, MAX_LINES, EMBED_MAX_ITEM_TOKENS, EMBED_TOKENIZER,
+                     counter=TOKEN_COUNTER, mode=CHUNK_MODE, syntax_max_lines=SYNTAX_MAX_LINES,
+                     fingerprint=NEAR_DUP, min_parallel_bytes=CHUNK_PARALLEL_MIN_KB * 1024) as chunker:
+        for fp, chunks in tqdm(chunker.imap(list_files(project_root) if files is None else files), desc="文件分块", unit="file"):
+            stats["files"] += 1
+            for start, text, tokens, h, symbol, fingerprint in chunks:
+                row = writer.count
+                if stats["same"] and (row >= len(old_keys) or old_keys[row] != (fp, start, h)):
+                    stats["same"] = False
+
+                rep = first_row.get(h, -1)
+                if rep < 0 and simidx is not None:
+                    rep = simidx.find_or_add(fingerprint, row)
+                    if rep >= 0:
+                        stats["near_dups"] += 1
+                writer.add(fp, start, text, h, symbol, dup_of=rep)
+                if lexical is not None:
+                    lexical.add(row, text)
+                if rep >= 0:
+                    first_row.setdefault(h, rep)
+                    stats["dups"] += 1
+                    continue
+                first_row[h] = row
+                stats["reps"].append(row)
+                if h in reuse_rows:
+                    # 旧索引维度可能更大（调小了 INDEX_DIM），截断后复用
+                    vbuf.write([row], truncate_vectors(old_index.reconstruct(reuse_rows[h])[None, :], vbuf.dim))
+                    stats["reused"] += 1
+                    continue
+
+                if batch and (len(batch) >= BATCH_SIZE or batch_tokens + tokens > EMBED_MAX_BATCH_TOKENS):
+                    put(batch)
+                    batch, batch_tokens = [], 0
+                batch.append((row, text, h))
+                batch_tokens += tokens
+                stats["pending"] += 1
+    if batch:
+        put(batch)
+
+
+async def _embed_stream(project_root: str, writer: MetaWriter, vbuf: VectorBuffer, reuse, old_keys,
+                        checkpoint: EmbeddingCheckpoint, stats: dict, lexical: LexicalIndexWriter = None,
+                        embedder: Embedder = None, files=None):
+    """
+    流式构建的主循环：生产者线程分块装箱，本协程按到达顺序并发嵌入，结果按行号写入 vbuf。
+    队列和在途批次数都有上限，内存占用与仓库大小无关。
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=BUILD_QUEUE_SIZE)
+    max_inflight = MAX_CONCURRENT_LIMIT * 2
+    failed = []
 
-    if len(meta) == 0:
-        print("警告: 没有找到可处理的文本块")
-        return
+    stop = threading.Event()
 
-    # 向量化处理 - 修复版本
-    print("开始向量化处理...")
-    embed_start = time.time()
+    def put(item):
+        if stop.is_set():
+            raise asyncio.CancelledError()
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
 
-    try:
-        # 检查是否已有运行的事件循环
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            # 在运行的事件循环中，使用同步方式等待异步任务完成
-            async def run_embedding():
-                return await async_smart_batch_embedding(meta)
-
-            # 创建新的事件循环来运行异步任务
-            new_loop = asyncio.new_event_loop()
+    def producer():
+        try:
+            _produce_batches(project_root, writer, vbuf, reuse, old_keys, put, stats, lexical, files)
+        except BaseException as e:
+            stats["error"] = e
+        finally:
+            if not stop.is_set():
+                put(None)
+
+    async def run(batch_idx, batch):
+        rows = [r for r, _, _ in batch]
+        key = checkpoint.batch_key([h for _, _, h in batch])
+        vecs = checkpoint.load(batch_idx, key, len(batch))
+        if vecs is None:
             try:
-                all_vecs = new_loop.run_until_complete(run_embedding())
-            finally:
-                new_loop.close()
-        else:
-            # 如果没有运行的事件循环，使用 asyncio.run
-            all_vecs = asyncio.run(async_smart_batch_embedding(meta))
-    except RuntimeError as e:
-        # 如果上述方法都失败，回退到同步版本
-        print(f"异步处理失败: {e}，使用同步处理模式...")
-        all_vecs = sync_smart_batch_embedding(meta)
+                vecs = await async_embed_batch_with_retry([t for _, t, _ in batch], embedder=embedder)
+            except Exception as e:
+                print(f"批次 {batch_idx} 处理失败: {e}")
+                failed.append(batch_idx)
+                return
+            checkpoint.save(batch_idx, key, vecs)
+        # 检查点 / 缓存中是完整维度的向量，写入前截断到索引维度并归一化
+        vbuf.write(rows, truncate_vectors(np.asarray(vecs, dtype="float32"), vbuf.dim))
+        stats["embedded"] += len(rows)
+
+    def reap(done):
+        # 嵌入失败已记入 failed；截断、写入向量或检查点时出错说明这些行没有写入，整个构建失败
+        errors = [t.exception() for t in done if not t.cancelled() and t.exception() is not None]
+        if errors:
+            raise errors[0]
+
+    producer_done = loop.run_in_executor(None, producer)
+    tasks, batch_idx = set(), 0
+    try:
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                break
+            if len(tasks) >= max_inflight:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                reap(done)
+            tasks.add(asyncio.create_task(run(batch_idx, batch)))
+            batch_idx += 1
+        if tasks:
+            done, tasks = await asyncio.wait(tasks)
+            reap(done)
+    except BaseException:
+        # 被取消或出错时通知生产者尽快退出，并腾出队列避免其阻塞
+        stop.set()
+        for t in tasks:
+            t.cancel()
+        while not queue.empty():
+            queue.get_nowait()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        await producer_done
+
+    if checkpoint.loaded:
+        print(f"[断点续传] 从检查点恢复 {checkpoint.loaded}/{batch_idx} 个批次")
+    if "error" in stats:
+        raise stats["error"]
+    if failed:
+        raise EmbeddingBatchError(f"有 {len(failed)} 个批次处理失败: {sorted(failed)[:10]}，"
+                                  f"已完成的批次已写入检查点，重新运行即可续传")
+
+
+def _previous_index(handle: "IndexHandle", incremental: bool):
+    """增量构建时读取旧索引（handle 固定在当前一代）：返回 (可复用向量, 旧分块键)；
+    旧分块键为 None 表示必须重新写出索引"""
+    if not incremental:
+        return (None, {}), None
+    reuse = load_reusable_vectors(handle)
+    index_file, embedder = handle.index_file, handle.embedder
+    # 开启混合检索但旧索引没有 BM25 文件、或嵌入后端变了时，即使文本块没有变化也要重新写出
+    same_embedder = (Path(index_file).exists() and index_embedder(index_file).name == embedder.name
+                     and load_spec(index_file).get("dim", embedder.dim) == handle.dim)
+    old_keys = None
+    if same_embedder and (not HYBRID_SEARCH or Path(handle.lexical_file).exists()):
+        try:
+            with handle.loaded() as (_, meta):
+                old_keys = chunk_keys(meta)
+        except Exception:
+            old_keys = None
+    return reuse, old_keys
 
+
+def _write_index(old: "IndexHandle", target: "IndexHandle", writer: MetaWriter, vbuf: VectorBuffer,
+                 lexical: LexicalIndexWriter, stats: dict, incremental: bool) -> int:
+    """训练索引，把索引、索引参数、BM25 和元数据写进新一代目录 target，返回索引中的向量数"""
+    index_file = target.index_file
+    try:
+        total = writer.count
+        vecs = vbuf.finish(total)
+        print(f"向量维度: {vecs.shape[1]}")
+        reps = np.frombuffer(stats["reps"], dtype="int64") if len(stats["reps"]) < total else None
+
+        # 根据向量规模选择索引类型（Flat / HNSW / IVF-PQ）
+        # 增量更新时沿用旧索引的存储格式（可能已被 --convert 转换过）
+        old_storage = load_spec(old.index_file).get("storage") if incremental and old.exists() else None
+        spec = choose_spec(len(stats["reps"]), vecs.shape[1], dict(cfg, INDEX_STORAGE=old_storage) if old_storage else cfg)
+        spec["embedder"] = target.embedder.describe()
+        print(f"索引类型: {spec['factory']}")
+        # 有重复块时只有代表块进入索引，索引编号仍是元数据行号；
+        # 需要按文件增量更新的索引（id_mapped）即使没有重复块也带编号映射，之后可以按编号删除
+        if reps is None and target.id_mapped and spec["type"] == "flat":
+            reps = np.arange(total, dtype="int64")
+        index = build_from_vectors(vecs, spec, ids=reps)
+        del vecs
+
+        # 保存索引、索引参数和元数据（紧凑的分列格式，文本单独打包）
+        save_spec(index_file, spec)
+        faiss.write_index(index, index_file)
+        if lexical is not None:
+            lexical.save(target.lexical_file)
+        writer.close()
+        write_manifest(target.meta_file)
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        vbuf.close()
+    return index.ntotal
+
+
+async def build_index_async(handle: "IndexHandle", incremental: bool = False) -> None:
+    """构建向量索引（流式：文件遍历 → 分块 → 嵌入 → 写索引/元数据，内存占用有上界）
+
+    索引写到 handle 的路径，使用 handle 的嵌入后端和索引维度，源目录为 handle.project_root。
+    incremental=True 时按 chunk 内容哈希复用旧索引中的向量，只对新增/修改的块做嵌入，
+    已删除块的向量自然被丢弃。
+
+    在调用方的事件循环中运行（FastAPI 处理函数直接 await）：嵌入请求在当前循环上并发，
+    分块在生产者线程 / 进程池中进行，读取旧索引、训练和写出索引放到线程池，
+    构建期间事件循环仍能处理其他请求。
+
+    新索引写进新一代目录，落盘后原子切换 CURRENT（见 index_generations）：构建期间检索继续使用旧一代，
+    构建失败时旧索引保持不变。
+    """
+    start_time = time.time()
+
+    project_root, embedder = handle.project_root, handle.embedder
+    old = handle.snapshot()
+    # 增量构建沿用旧索引的维度（与下面的存储格式一样，可能已被 --convert / --dim 转换过）
+    dim = handle.recorded_dim(old) if incremental else None
+    if dim:
+        print(f"[增量] 沿用旧索引的维度 {dim}（重新构建或显式指定维度时才改变）")
+        handle, old = handle._with_dim(dim), old._with_dim(dim)
+    reuse, old_keys = await asyncio.to_thread(_previous_index, old, incremental)
+
+    # 元数据、向量边产生边落盘；每个完成的批次写入检查点，中断后重新运行不会重复嵌入
+    checkpoint = EmbeddingCheckpoint(handle.checkpoint_file, salt=f"{embedder.name}:{embedder.dim}")
+    target = handle.stage()
+    try:
+        ntotal = await _build_generation(project_root, old, target, reuse, old_keys, checkpoint, incremental,
+                                         start_time)
+        if ntotal is not None and not await asyncio.to_thread(handle.commit, target):
+            print("[索引] 构建期间已有更晚开始的构建提交了新一代，放弃本次结果")
+            ntotal = None
+        if ntotal is None:
+            handle.discard(target)
+    except BaseException:
+        handle.discard(target)
+        raise
+    if ntotal is not None:
+        checkpoint.clear()
+        print(f"[索引] 已切换到新一代: {os.path.dirname(target.index_file)}")
+
+
+async def _build_generation(project_root: str, old: "IndexHandle", target: "IndexHandle", reuse, old_keys,
+                            checkpoint: EmbeddingCheckpoint, incremental: bool, start_time: float):
+    """分块、嵌入并把新索引写进 target 所在的一代目录，返回向量数；没有需要写出的内容时返回 None"""
+    embedder = target.embedder
+    writer = MetaWriter(target.meta_file)
+    vbuf = VectorBuffer(target.index_file + ".vecs.tmp", target.dim)
+    lexical = LexicalIndexWriter() if HYBRID_SEARCH else None
+    stats = {"files": 0, "pending": 0, "reused": 0, "embedded": 0, "dups": 0, "near_dups": 0,
+             "reps": array("q"), "same": old_keys is not None}
+
+    print("开始流式分块与向量化...")
+    embed_start = time.time()
+    try:
+        await _embed_stream(project_root, writer, vbuf, reuse, old_keys, checkpoint, stats, lexical, embedder,
+                            target.list_files())
+    except BaseException:
+        writer.abort()
+        vbuf.close()
+        raise
     embed_time = time.time() - embed_start
 
-    if not all_vecs:
-        raise RuntimeError("所有批处理都失败了，无法构建索引")
+    total = writer.count
+    print(f"分块完成: {stats['files']} 个文件, {total} 个文本块")
+    if stats["dups"]:
+        print(f"重复块: {stats['dups']} 个（其中近似重复 {stats['near_dups']} 个），只嵌入代表块")
+    if incremental:
+        print(f"[增量] 复用 {len(stats['reps']) - stats['pending']} 个文本块，嵌入 {stats['pending']} 个")
+    if total == 0 or (stats["same"] and stats["pending"] == 0 and total == len(old_keys)):
+        writer.abort()
+        vbuf.close()
+        checkpoint.clear()
+        if total == 0:
+            print("警告: 没有找到可处理的文本块")
+        else:
+            print("[增量] 文本块没有变化，跳过索引写入")
+        return None
 
-    # 索引构建（后续代码保持不变）
+    # 索引构建（HNSW / IVF 训练可能耗时较长，不占用事件循环）
     print("构建FAISS索引...")
     index_start = time.time()
-    all_vecs = np.vstack(all_vecs)
-
-    # 检查向量维度一致性
-    vector_dim = all_vecs.shape[1]
-    print(f"向量维度: {vector_dim}")
-
-    # 根据实际向量维度创建索引
-    index = faiss.IndexFlatIP(vector_dim)
-    faiss.normalize_L2(all_vecs)
-    index.add(all_vecs)
-
-    # 保存索引和元数据
-    faiss.write_index(index, INDEX_FILE)
-    with open(META_FILE, "w", encoding="utf-8") as g:
-        json.dump(meta, g, ensure_ascii=False, indent=2)
+    ntotal = await asyncio.to_thread(_write_index, old, target, writer, vbuf, lexical, stats, incremental)
     index_time = time.time() - index_start
 
     total_time = time.time() - start_time
 
     # 性能统计
     print(f"\n=== 性能统计 ===")
-    print(f"文件分块: {file_time:.2f}s ({file_time / total_time * 100:.1f}%)")
-    print(f"向量化: {embed_time:.2f}s ({embed_time / total_time * 100:.1f}%)")
+    print(f"分块+向量化: {embed_time:.2f}s ({embed_time / total_time * 100:.1f}%)")
     print(f"索引构建: {index_time:.2f}s ({index_time / total_time * 100:.1f}%)")
     print(f"总耗时: {total_time:.2f}s")
-    print(f"索引大小: {index.ntotal} 个向量")
-    print(f"平均速度: {index.ntotal / total_time:.1f} 向量/秒")
+    print(f"索引大小: {ntotal} 个向量")
+    print(f"平均速度: {ntotal / total_time:.1f} 向量/秒")
+    return ntotal
+
+
+def build_index(handle: "IndexHandle", incremental: bool = False) -> None:
+    """build_index_async 的同步版本（命令行和同步代码使用），在临时事件循环中运行
+
+    当前线程已有运行中的事件循环（同步函数被异步代码直接调用）时改在新线程中运行，
+    不嵌套事件循环；异步代码应直接 await build_index_async。
+    """
+    async def run():
+        try:
+            await build_index_async(handle, incremental)
+        finally:
+            # 临时事件循环即将关闭，释放该循环上的连接池
+            await close_async_client()
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(run())
+    with ThreadPoolExecutor(1, thread_name_prefix="build-index") as executor:
+        return executor.submit(asyncio.run, run()).result()
+
+
+def _chunk_files(paths: list[str]) -> list[tuple]:
+    """对少量文件分块，返回 [(路径, chunks)]（按文件更新时使用，与完整构建的分块参数相同）"""
+    if not paths:
+        return []
+    with FileChunker(min(CHUNK_WORKERS, len(paths)), MAX_LINES, EMBED_MAX_ITEM_TOKENS, EMBED_TOKENIZER,
+                     counter=TOKEN_COUNTER, mode=CHUNK_MODE, syntax_max_lines=SYNTAX_MAX_LINES,
+                     fingerprint=NEAR_DUP, min_parallel_bytes=CHUNK_PARALLEL_MIN_KB * 1024) as chunker:
+        return list(chunker.imap(paths))
+
+
+def _update_plan(old: "IndexHandle", meta, removed: set, eligible: set):
+    """
+    按文件删除旧行，返回更新计划；旧索引不支持按编号删除时返回 None（改为增量构建）。
+    meta 是 old.acquire() 占住的元数据，写完新一代之前不能释放。
+    索引中已不在 eligible 里的文件（已删除或被排除，如迁移前误收录的旧版 meta.json）同样删除。
+
+    索引是一份私有副本（缓存中的索引可能正在被检索）：删除行的向量被移除，其余向量的编号改为新行号。
+    被删除的代表块如果还有重复块保留下来，第一个保留的重复块接替为代表块，沿用原来的向量。
+    """
+    spec = load_spec(old.index_file)
+    if spec.get("type") != "flat":
+        print(f"[更新] {spec.get('type')} 索引不支持按编号删除")
+        return None
+    if (spec.get("embedder") or {}).get("name") != old.embedder.name or spec.get("dim", old.embedder.dim) != old.dim:
+        print("[更新] 嵌入后端或索引维度已变化")
+        return None
+    if not isinstance(meta, ChunkMeta):
+        print("[更新] 旧版 meta.json 元数据")
+        return None
+    stale = {meta.paths[i] for i in np.unique(meta.rows["path"]).tolist()} - eligible - removed
+    if stale:
+        print(f"[更新] {len(stale)} 个文件已不在待索引范围内，一并删除: {', '.join(sorted(stale)[:3])}")
+        removed = removed | stale
+    lexical = old.load_lexical()
+    if HYBRID_SEARCH and lexical is None:
+        print("[更新] 旧索引没有 BM25 文件")
+        return None
+
+    index = faiss.read_index(old.index_file)
+    outer = faiss.downcast_index(index)
+    dup = dup_rows(meta).astype("int64")
+    if not isinstance(outer, faiss.IndexIDMap2):
+        if is_lossy(spec):
+            print("[更新] 量化索引没有编号映射，无法精确还原向量")
+            return None
+        # 没有重复块的索引编号就是行号，加上编号映射（不重新嵌入）
+        vecs, _ = stored_vectors(index)
+        index = build_from_vectors(vecs, spec, ids=np.flatnonzero(dup < 0), compact=True)
+        outer = faiss.downcast_index(index)
+    if outer.ntotal != int((dup < 0).sum()):
+        print(f"[更新] 旧索引与元数据数量不一致 ({outer.ntotal} != {int((dup < 0).sum())})")
+        return None
+
+    gone = np.zeros(len(meta), dtype=bool)
+    manifest = read_manifest(old.meta_file)
+    if manifest is None:
+        pids = [i for i, p in enumerate(meta.paths) if p in removed]
+        gone = np.isin(np.asarray(meta.rows["path"]), pids)
+    else:
+        for p in removed:
+            for start, n in manifest.get(p, {}).get("rows", []):
+                gone[start:start + n] = True
+    keep = ~gone
+    remap = np.full(len(meta), -1, dtype="int64")
+    remap[keep] = np.arange(int(keep.sum()))
+
+    rep_of = dup.copy()
+    promoted = {}  # 被删除的代表块 -> 接替它的行（旧行号）
+    for r in np.flatnonzero(keep & (dup >= 0) & gone[np.maximum(dup, 0)]).tolist():
+        new_rep = promoted.setdefault(int(dup[r]), r)
+        rep_of[r] = -1 if new_rep == r else new_rep
+    moved = np.stack([outer.reconstruct(r) for r in promoted]) if promoted else None
+
+    if gone.any():
+        outer.remove_ids(np.flatnonzero(gone & (dup < 0)).astype("int64"))
+        ids = faiss.vector_to_array(outer.id_map).astype("int64")
+        faiss.copy_array_to_vector(remap[ids], outer.id_map)
+        outer.construct_rev_map()
+    if promoted:
+        outer.add_with_ids(moved, remap[list(promoted.values())])
+
+    kept_reps = np.flatnonzero(keep & (rep_of < 0))
+    hashes = np.asarray(meta.rows["hash"][kept_reps])
+    return {"spec": spec, "index": index, "meta": meta, "lexical": lexical, "remap": remap,
+            "removed": int(gone.sum()), "promoted": len(promoted),
+            "dup_of": np.where(rep_of >= 0, remap[np.maximum(rep_of, 0)], -1)[keep],
+            "reps": dict(zip((h.tobytes().hex() for h in hashes), remap[kept_reps].tolist()))}
+
+
+def _write_update(target: "IndexHandle", plan: dict, files: list[tuple], vectors: dict) -> int:
+    """把保留的行和新文件的块写进新一代目录 target，返回总行数；完全相同的块（md5）只保留一份向量"""
+    meta, remap = plan["meta"], plan["remap"]
+    reps = dict(plan["reps"])
+    base = int((remap >= 0).sum())
+    writer = MetaWriter(target.meta_file)
+    lexical = LexicalIndexWriter() if HYBRID_SEARCH else None
+    try:
+        writer.extend(meta, np.flatnonzero(remap >= 0), plan["dup_of"])
+        rows, vecs = [], []
+        for fp, chunks in files:
+            for start, text, tokens, h, symbol, fingerprint in chunks:
+                row = writer.count
+                rep = reps.get(h, -1)
+                writer.add(fp, start, text, h, symbol, dup_of=rep)
+                if lexical is not None:
+                    lexical.add(row - base, text)
+                if rep < 0:
+                    reps[h] = row
+                    rows.append(row)
+                    vecs.append(vectors[h])
+        total = writer.count
+        if total == 0:
+            writer.abort()
+            return 0
+        index = faiss.downcast_index(plan["index"])
+        if rows:
+            index.add_with_ids(np.stack(vecs), np.asarray(rows, dtype="int64"))
+        save_spec(target.index_file, plan["spec"])
+        faiss.write_index(plan["index"], target.index_file)
+        if lexical is not None:
+            merge_lexical(plan["lexical"], remap, lexical, target.lexical_file)
+        writer.close()
+        write_manifest(target.meta_file)
+    except BaseException:
+        writer.abort()
+        raise
+    print(f"[更新] 删除 {plan['removed']} 行（{plan['promoted']} 个重复块接替为代表块），"
+          f"新增 {total - base} 行（嵌入 {len(rows)} 个），共 {total} 行")
+    return total
+
+
+def _rejection_reason(path: str) -> str:
+    """文件没有被 list_files 选中的原因（用于提示上传失败）"""
+    if not os.path.isfile(path):
+        return "文件不存在"
+    if Path(path).suffix.lower() not in KNOWLEDGE_EXT:
+        return f"不支持的文件类型 {Path(path).suffix or '(无扩展名)'}"
+    return "被忽略规则或文件过滤排除"
+
+
+async def update_index_async(handle: "IndexHandle", added=(), removed=()) -> list[dict]:
+    """
+    按文件增量更新索引：只对 added 中的文件分块和嵌入，removed 中的文件只删除其向量
+    （IndexIDMap2.remove_ids），其余文件的向量、元数据和 BM25 直接沿用（行号重新编号），
+    耗时与变化的文件大小成正比。已在索引中的 added 文件视为修改，旧块先被删除。
+
+    返回 added 中没有加入索引的文件 [{"path", "reason"}]（不支持的类型、被忽略规则排除等），
+    这些文件在索引中的旧块同样被删除。
+
+    结果写进新一代目录，只在当前代仍是更新开始时的那一代时切换（两个更新同时进行时，
+    后提交的一方基于新的当前代重试，已嵌入的向量不会重复请求）。
+    索引不存在时完整构建；索引不支持按编号删除（HNSW / IVF、嵌入后端变化、旧版元数据）时
+    改为按内容哈希的增量构建。更新时只做完全相同（md5）的去重，近似去重在下次完整构建时生效。
+    """
+    requested = sorted({os.path.abspath(p) for p in added})
+    eligible = set(await asyncio.to_thread(lambda: list(handle.list_files())))
+    rejected = [{"path": p, "reason": _rejection_reason(p)} for p in requested if p not in eligible]
+    for r in rejected:
+        print(f"[更新] 未加入索引: {r['path']}（{r['reason']}）")
+    await _update_files(handle, [p for p in requested if p in eligible],
+                        {os.path.abspath(p) for p in removed} | set(requested), eligible)
+    return rejected
+
+
+async def _update_files(handle: "IndexHandle", added: list[str], removed: set, eligible: set) -> None:
+    """update_index_async 的主体（added 已经过 list_files 过滤，eligible 为当前的全部待索引文件）"""
+    start_time = time.time()
+    files = await asyncio.to_thread(_chunk_files, added)
+    vectors = {}  # chunk hash -> 截断后的向量，重试时复用
+    for _ in range(3):
+        old = handle.snapshot()
+        if not old.exists():
+            return await build_index_async(handle)
+        dim = handle.recorded_dim(old)
+        if dim:
+            handle, old = handle._with_dim(dim), old._with_dim(dim)
+        _, meta = await asyncio.to_thread(old.acquire)
+        try:
+            plan = await asyncio.to_thread(_update_plan, old, meta, removed, eligible)
+            if plan is None:
+                print("[更新] 改为增量构建")
+                break
+            if not plan["removed"] and not files:
+                print("[更新] 没有需要更新的文件")
+                return
+            need = {}
+            for fp, chunks in files:
+                for start, text, tokens, h, symbol, fingerprint in chunks:
+                    if h not in plan["reps"] and h not in vectors:
+                        need.setdefault(h, {"text": text, "hash": h, "tokens": tokens})
+            if need:
+                vecs = await async_smart_batch_embedding(list(need.values()), embedder=handle.embedder)
+                vectors.update(zip(need, truncate_vectors(vecs, handle.dim)))
+
+            target = handle.stage()
+            try:
+                total = await asyncio.to_thread(_write_update, target, plan, files, vectors)
+                if total == 0:
+                    handle.discard(target)
+                    await asyncio.to_thread(handle.clear)
+                    print("[更新] 所有文件已删除，索引已清空")
+                    return
+                committed = await asyncio.to_thread(handle.commit, target, old)
+            except BaseException:
+                handle.discard(target)
+                raise
+            if committed:
+                print(f"[更新] 已切换到新一代: {os.path.dirname(target.index_file)}，耗时 {time.time() - start_time:.2f}s")
+                return
+            handle.discard(target)
+            print("[更新] 更新期间索引已被其他构建替换，基于新索引重试")
+        finally:
+            release_meta(meta)
+    else:
+        print("[更新] 多次与其他构建冲突，改为增量构建")
+    await build_index_async(handle, incremental=True)
+
+
+def update_index(handle: "IndexHandle", added=(), removed=()) -> list[dict]:
+    """update_index_async 的同步版本（见 build_index）"""
+    async def run():
+        try:
+            return await update_index_async(handle, added, removed)
+        finally:
+            await close_async_client()
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(run())
+    with ThreadPoolExecutor(1, thread_name_prefix="update-index") as executor:
+        return executor.submit(asyncio.run, run()).result()
+
+
+def _read_index(index_file: str, meta_file: str):
+    """从磁盘读取索引和元数据，并恢复构建时记录的检索参数；返回 (index, meta, spec)，
+    spec 随索引一起缓存，检索时不再读取索引参数文件"""
+    index = faiss.read_index(index_file)
+    spec = load_spec(index_file)
+    apply_search_params(index, spec)
+    return index, open_meta(meta_file), spec
+
+
+def _index_memory(loaded) -> int:
+    """估算已加载索引占用的内存：向量（按实际存储格式）+ 元数据（旧版 meta.json 的文本全部常驻内存）"""
+    index, meta, _ = loaded
+    vec_bytes = index_memory_bytes(index)
+    if isinstance(meta, ChunkMeta):
+        return vec_bytes + meta.memory_bytes()
+    text_bytes = sum(len(m["text"]) for m in meta) * 2 + len(meta) * 400
+    return vec_bytes + text_bytes
+
+
+class IndexHandle:
+    """
+    一个项目的向量索引：自己持有索引 / 元数据路径、嵌入后端和索引维度，不读写模块级状态，
+    不同项目的构建和检索可以在线程池中并行。已加载的索引和元数据在 INDEX_REGISTRY 中共享
+    （按文件签名失效），同一目录创建多个 IndexHandle 不会重复加载。
+
+        handle = IndexHandle(out_path, project_root)
+        handle.build(incremental=True)
+        results = handle.search(query, top_k)
+
+    嵌入后端按 EMBED_BACKEND_BY_PROJECT、索引维度按 INDEX_DIM_BY_PROJECT 以 project_root / out_path 匹配；
+    检索时使用索引参数中记录的后端。out_path 为空时使用 config.xml 中的 INDEX_FILE / META_FILE。
+
+    索引文件位于 out_path/.ewiki-index/ 下 CURRENT 指向的一代目录（见 index_generations），
+    index_file / meta_file 每次访问时解析；还没有按代构建过的旧索引直接读取 out_path 下的文件。
+
+    id_mapped=True 时 Flat 索引总是带编号映射，可以用 update_files 按文件增减（知识库上传 / 删除）。
+    source_filters=False 时遍历不做单文件大小上限和压缩 / 生成文件检测（知识库、调用图）。
+    dim 显式指定索引维度；不指定时增量构建和按文件更新沿用旧索引记录的维度（可能已被 --dim 截断），
+    完整重建使用配置的维度。
+    """
+
+    def __init__(self, out_path: str = None, project_root: str = None, id_mapped: bool = False,
+                 source_filters: bool = True, dim: int = None):
+        self.out_path = str(out_path) if out_path else None
+        self.id_mapped = id_mapped
+        self.source_filters = source_filters
+        self.project_root = str(project_root) if project_root else None
+        self.legacy_files = ((self.out_path + "/faiss.index", self.out_path + "/meta.json") if self.out_path
+                             else (INDEX_FILE, META_FILE))
+        self.store = GenerationStore(os.path.dirname(self.legacy_files[0]) or ".", INDEX_KEEP_GENERATIONS,
+                                     INDEX_GENERATION_GRACE)
+        self.files = None  # 固定的 (index_file, meta_file)，None 表示跟随 CURRENT
+        self.embedder = get_embedder(project_backend(cfg, self.project_root, self.out_path))
+        self.dim_explicit = bool(dim)
+        self.dim_setting = int(dim or project_value(cfg, "INDEX_DIM_BY_PROJECT", self.project_root, self.out_path)
+                               or INDEX_DIM)
+
+    def __repr__(self) -> str:
+        return f"IndexHandle({self.index_file!r}, backend={self.embedder.backend})"
+
+    def _resolve(self) -> tuple:
+        if self.files:
+            return self.files
+        gen = self.store.current(INDEX_POINTER_TTL)
+        return self._in(gen) if gen else self.legacy_files
+
+    def _immutable(self, path: str) -> bool:
+        """path 是否在某一代目录中（写完提交后不再改变，缓存命中时不必 stat 检查）"""
+        return os.path.dirname(os.path.dirname(path)) == self.store.dir
+
+    def _cached(self, index_file: str, meta_file: str):
+        """按代存放的索引已在缓存中时直接返回 (index, meta, spec)，不读盘也不 stat；否则返回 None"""
+        if not self._immutable(index_file):
+            return None
+        return INDEX_REGISTRY.cached((index_file, store_files(meta_file)["rows"]))
+
+    def _in(self, gen_dir: str) -> tuple:
+        return tuple(os.path.join(gen_dir, os.path.basename(f)) for f in self.legacy_files)
+
+    def _pinned(self, files: tuple) -> "IndexHandle":
+        handle = copy.copy(self)
+        handle.files = files
+        return handle
+
+    def _with_dim(self, dim: int) -> "IndexHandle":
+        handle = copy.copy(self)
+        handle.dim_setting = dim
+        return handle
+
+    def recorded_dim(self, old: "IndexHandle"):
+        """old（当前一代的 snapshot）记录的索引维度与本次构建不同、应当沿用时返回该维度，否则返回 None：
+        显式指定了 dim、旧索引不存在或嵌入后端已变化（向量不能复用）时不沿用"""
+        if self.dim_explicit or not old.exists():
+            return None
+        spec = load_spec(old.index_file)
+        if (spec.get("embedder") or {}).get("name", EMBED_NAME) != self.embedder.name:
+            return None
+        dim = int(spec.get("dim") or 0)
+        return dim if dim and dim != self.dim else None
+
+    @property
+    def index_file(self) -> str:
+        return self._resolve()[0]
+
+    @property
+    def meta_file(self) -> str:
+        return self._resolve()[1]
+
+    @property
+    def lexical_file(self) -> str:
+        return self.index_file + ".bm25"
+
+    @property
+    def checkpoint_file(self) -> str:
+        """嵌入检查点目录（跨代共用，中断后重新构建可以续传）"""
+        return self.store.path(os.path.basename(self.legacy_files[0]) + ".ckpt")
+
+    def snapshot(self) -> "IndexHandle":
+        """固定到当前一代的副本：一次检索或构建中读到的索引、元数据和 BM25 来自同一代"""
+        return self._pinned(self._resolve())
+
+    def stage(self) -> "IndexHandle":
+        """分配新一代目录，返回固定到该目录的副本；构建写入这里，commit 之前读者看不到"""
+        return self._pinned(self._in(self.store.new()))
+
+    def commit(self, staged: "IndexHandle", base: "IndexHandle" = None) -> bool:
+        """新一代落盘后原子切换为当前索引，回收旧代和旧版平铺文件；
+        给出 base（更新开始时的 snapshot）时，当前代已不是 base 所在的一代则不切换，返回 False；
+        构建期间已有更晚开始的构建提交时同样不切换（见 GenerationStore.commit）"""
+        current = os.path.dirname(staged.index_file)
+        if base is None:
+            removed = self.store.commit(current)
+        else:
+            # base 是旧版平铺文件时，要求此时仍没有任何一代
+            gen = os.path.dirname(base.index_file)
+            expected = os.path.basename(gen) if os.path.dirname(gen) == self.store.dir else None
+            removed = self.store.commit(current, expected)
+        if removed is None:
+            return False
+        for d in removed + [self.store.path(g) for g in self.store.generations()]:
+            if d != current:
+                INDEX_REGISTRY.invalidate_prefix(d + os.sep)
+        self._remove_legacy()
+        return True
+
+    def discard(self, staged: "IndexHandle") -> None:
+        """放弃未提交的一代（构建失败或内容没有变化）"""
+        self.store.discard(os.path.dirname(staged.index_file))
+
+    def clear(self) -> None:
+        """删除索引：CURRENT 被移除后读者立即看到索引不存在，已加载的旧索引不受影响"""
+        for d in self.store.clear():
+            INDEX_REGISTRY.invalidate_prefix(d + os.sep)
+        self._remove_legacy(force=True)
+
+    def _remove_legacy(self, force: bool = False) -> None:
+        """删除旧版平铺在 out_path 下的索引文件；与被替换的一代一样，切换后先保留 grace 秒"""
+        index_file, meta_file = self.legacy_files
+        if not (os.path.exists(index_file) or meta_exists(meta_file)):
+            return
+        marker = self.store.path("legacy.retired")
+        if not force:
+            if not os.path.exists(marker):
+                open(marker, "w").close()
+                return
+            if time.time() - os.stat(marker).st_mtime < self.store.grace:
+                return
+        INDEX_REGISTRY.invalidate_prefix(index_file)
+        for f in (index_file, params_file(index_file), index_file + ".bm25"):
+            if os.path.exists(f):
+                os.remove(f)
+        remove_meta(meta_file)
+        if os.path.exists(marker):
+            os.remove(marker)
+
+    def list_files(self):
+        """project_root 下的待索引文件；索引与源文件在同一目录（知识库、调用图）时，
+        排除其中还没回收的旧版平铺索引文件（meta.json 等本身也是可索引的扩展名）"""
+        root = os.path.abspath(self.project_root)
+        index_file, meta_file = self.legacy_files
+        exclude = []
+        for f in [index_file, params_file(index_file), index_file + ".bm25"] + list(store_files(meta_file).values()):
+            rel = os.path.relpath(os.path.abspath(f), root)
+            if not rel.startswith(".."):
+                exclude.append("/" + rel.replace(os.sep, "/"))
+        return list_files(self.project_root, self.source_filters, exclude)
+
+    @property
+    def dim(self) -> int:
+        """构建使用的索引维度：INDEX_DIM（按项目覆盖）不超过嵌入维度，未设置时等于嵌入维度"""
+        return min(self.dim_setting, self.embedder.dim) if self.dim_setting > 0 else self.embedder.dim
+
+    def exists(self) -> bool:
+        index_file, meta_file = self._resolve()
+        if self._cached(index_file, meta_file) is not None:
+            return True
+        return Path(index_file).exists() and meta_exists(meta_file)
+
+    def _should_build(self, incremental: bool, rebuild: bool) -> bool:
+        if self.exists():
+            if rebuild:
+                print(f"[重建] 索引已存在，重新构建（完成前继续使用旧索引）: {self.index_file}")
+            elif not incremental:
+                print(f"[跳过] 索引已存在: {self.index_file}, 如需重建请使用 --rebuild 或增量模式")
+                return False
+            else:
+                print(f"[增量] 索引已存在，增量更新: {self.index_file}")
+        if self.out_path:
+            Path(self.out_path).mkdir(parents=True, exist_ok=True)
+        print(f"[嵌入] 后端: {self.embedder.backend} ({self.embedder.name})，索引维度: {self.dim}")
+        return True
+
+    def build(self, incremental: bool = False, rebuild: bool = False) -> None:
+        """incremental=False 时索引已存在则跳过；incremental=True 时按内容哈希增量更新已有索引；
+        rebuild=True 时全部重新嵌入。新索引写完后才替换旧索引，构建期间检索不受影响"""
+        if self._should_build(incremental, rebuild):
+            build_index(self, incremental=incremental and not rebuild)
+
+    async def build_async(self, incremental: bool = False, rebuild: bool = False) -> None:
+        """build 的异步版本，在当前事件循环中构建（见 build_index_async）"""
+        if self._should_build(incremental, rebuild):
+            await build_index_async(self, incremental=incremental and not rebuild)
+
+    def update_files(self, added=(), removed=()) -> list[dict]:
+        """按文件增量更新：只嵌入 added 中的文件，删除 removed 中文件的向量；
+        返回没有加入索引的文件（见 update_index_async）"""
+        if self.out_path:
+            Path(self.out_path).mkdir(parents=True, exist_ok=True)
+        return update_index(self, added, removed)
+
+    async def update_files_async(self, added=(), removed=()) -> list[dict]:
+        """update_files 的异步版本，在当前事件循环中更新"""
+        if self.out_path:
+            Path(self.out_path).mkdir(parents=True, exist_ok=True)
+        return await update_index_async(self, added, removed)
+
+    def load(self):
+        """加载索引和元数据（命中进程内缓存时不读盘）"""
+        return self._load()[:2]
+
+    def _load(self):
+        """(index, meta, spec)；按代存放的索引命中缓存时连 stat 也不做"""
+        index_file, meta_file = self._resolve()
+        loaded = self._cached(index_file, meta_file)
+        if loaded is not None:
+            return loaded
+        if not (Path(index_file).exists() and meta_exists(meta_file)):
+            raise FileNotFoundError(f"索引文件不存在: {index_file} 或 {meta_file}")
+        return INDEX_REGISTRY.get((index_file, meta_marker(meta_file)),
+                                  lambda index_file, _: _read_index(index_file, meta_file),
+                                  size_of=_index_memory)
+
+    def acquire(self):
+        """load() 并占住元数据，直到 release_meta(meta)：期间缓存淘汰或旧一代回收不会关闭它的 mmap"""
+        return self._acquire()[:2]
+
+    def _acquire(self):
+        while True:
+            loaded = self._load()
+            meta = loaded[1]
+            # 刚被淘汰关闭的元数据已不在缓存中，重新 load 会得到新打开的一份
+            if not isinstance(meta, ChunkMeta) or meta.acquire():
+                return loaded
+
+    @contextmanager
+    def loaded(self):
+        """with handle.loaded() as (index, meta): ...  见 acquire"""
+        index, meta = self.acquire()
+        try:
+            yield index, meta
+        finally:
+            release_meta(meta)
+
+    def load_lexical(self):
+        """加载索引旁的 BM25 倒排索引；未开启混合检索或旧索引没有该文件时返回 None"""
+        if not HYBRID_SEARCH:
+            return None
+        lexical_file = self.lexical_file
+        if self._immutable(lexical_file):
+            lexical = INDEX_REGISTRY.cached((lexical_file,))
+            if lexical is not None:
+                return lexical
+        if not Path(lexical_file).exists():
+            return None
+        return INDEX_REGISTRY.get((lexical_file,), LexicalIndex, size_of=LexicalIndex.memory_bytes)
+
+    def search(self, query: str, top_k=DEFAULT_TOPK, flt: SearchFilter = None) -> list[dict]:
+        """见模块函数 search"""
+        return self.search_many([query], top_k, flt)[0]
+
+    def search_many(self, queries: list[str], top_k=DEFAULT_TOPK, filters=None) -> list[list[dict]]:
+        """批量检索，返回与 queries 一一对应的结果列表（每条与 search 单独调用相同）
+
+        索引只加载一次；需要向量检索的查询一起嵌入（每个请求不超过 BATCH_SIZE 条），
+        过滤条件相同的查询共用一次 index.search。
+        filters 为 None、所有查询共用的一个 SearchFilter，或与 queries 一一对应的列表。
+        """
+        top_k = int(top_k)
+        if self.files is None:
+            return self.snapshot().search_many(queries, top_k, filters)
+        index, meta, spec = self._acquire()
+        try:
+            return self._search_many(index, meta, spec, queries, top_k, filters)
+        finally:
+            release_meta(meta)
+
+    def _search_many(self, index, meta, spec: dict, queries: list[str], top_k: int, filters) -> list[list[dict]]:
+        lexical = self.load_lexical()
+        dup = dup_rows(meta)
+        if not isinstance(filters, (list, tuple)):
+            filters = [filters] * len(queries)
+        scopes = {}
+        for flt in filters:
+            if flt and flt.key() not in scopes:
+                allowed = allowed_rows(meta, flt)
+                scopes[flt.key()] = (flt.mode, allowed, allowed_groups(allowed, dup))
+        query_scopes = [scopes[flt.key()] if flt else None for flt in filters]
+
+        results = [None] * len(queries)
+        lex_hits = [None] * len(queries)
+        dense_queries = []
+        for i, query in enumerate(queries):
+            scope = query_scopes[i]
+            if lexical is not None:
+                results[i] = _lexical_lookup(meta, lexical, dup, query, top_k, scope)
+                if results[i] is not None:
+                    continue
+                lex_hits[i] = [lexical.search(query, top_k * 2, scope[1])] if scope else []
+                if not scope or scope[0] == "boost":
+                    lex_hits[i].append(lexical.search(query, top_k * 2))
+            dense_queries.append(i)
+        if not dense_queries:
+            return results
+
+        # 查询向量化（使用构建该索引时的嵌入后端）
+        embedder = spec_embedder(spec)
+        texts = [queries[i] for i in dense_queries]
+        qvecs = np.concatenate([embed_batch(texts[j:j + BATCH_SIZE], embedder)
+                                for j in range(0, len(texts), BATCH_SIZE)])
+        qvecs = truncate_vectors(qvecs, index.d)  # 索引可能是截断后的低维向量
+
+        # 搜索相似向量（近似索引结果不足时返回 -1）：不限范围与 boost 的查询合并为一次检索，
+        # boost 多取 BOOST_FETCH_FACTOR 倍候选，从中挑出范围内的命中；只有 restrict 按范围分组检索
+        n = min(top_k * 2 if lexical is not None else top_k, index.ntotal)
+        dense = {i: [] for i in dense_queries}
+        groups = {}
+        unscoped = []
+        for qi, i in enumerate(dense_queries):
+            if query_scopes[i] and query_scopes[i][0] == "restrict":
+                groups.setdefault(filters[i].key(), []).append(qi)
+            else:
+                unscoped.append(qi)
+        if unscoped:
+            boosted = any(query_scopes[dense_queries[qi]] for qi in unscoped)
+            fetch = min(n * BOOST_FETCH_FACTOR, index.ntotal) if boosted else n
+            scores, ids = index.search(qvecs[unscoped], fetch)
+            for row, qi in enumerate(unscoped):
+                i = dense_queries[qi]
+                hits = [(int(r), float(s)) for s, r in zip(scores[row], ids[row]) if 0 <= r < len(meta)]
+                if query_scopes[i]:
+                    dense[i].append([h for h in hits if query_scopes[i][2][h[0]]][:n])
+                dense[i].append(hits[:n])
+        for key, qis in groups.items():
+            scores, ids = filtered_search(index, qvecs[qis], n, scopes[key][2])
+            for row, qi in enumerate(qis):
+                hits = [(int(r), float(s)) for s, r in zip(scores[row], ids[row]) if 0 <= r < len(meta)]
+                dense[dense_queries[qi]].append(hits)
+        for i in dense_queries:
+            results[i] = _fuse(meta, dup, dense[i], lex_hits[i], top_k, query_scopes[i])
+        return results
+
+
+def release_meta(meta) -> None:
+    """释放 IndexHandle.acquire 占住的元数据（旧版 list 元数据无需释放）"""
+    if isinstance(meta, ChunkMeta):
+        meta.release()
 
 
 def load_index():
-    """加载索引和元数据"""
-    if not Path(INDEX_FILE).exists() or not Path(META_FILE).exists():
-        raise FileNotFoundError(f"索引文件不存在: {INDEX_FILE} 或 {META_FILE}")
+    """
+    加载 config.xml 中 INDEX_FILE / META_FILE 指向的默认索引并占住元数据（见 IndexHandle.acquire）。
+    调用方用完后必须 release_meta(meta)，否则元数据的 mmap 一直不会关闭；
+    只在一个代码块内使用时改用 with IndexHandle().loaded() as (index, meta)。
+    """
+    return IndexHandle().acquire()
+
 
-    index = faiss.read_index(INDEX_FILE)
-    with open(META_FILE, encoding="utf-8") as g:
-        meta = json.load(g)
-    return index, meta
+def load_lexical_index():
+    return IndexHandle().load_lexical()
 
 
-def search(query: str, top_k=DEFAULT_TOPK):
-    """搜索相似代码片段"""
-    top_k = int(top_k)
-    index, meta = load_index()
+def search(query: str, top_k=DEFAULT_TOPK, flt: SearchFilter = None, handle: IndexHandle = None):
+    """搜索相似代码片段（handle 为空时检索默认索引）
+
+    有 BM25 索引时向量结果与词法结果按倒数排名融合（match="hybrid"），score 归一化到 0~1；
+    查询是明确的标识符 / 字面量查找且词法命中时直接返回（match="lexical"），不请求嵌入接口；
+    没有 BM25 索引时 score 为余弦相似度（match="dense"）。
+    近似重复的块合并为一条结果，附带其余位置。
+    flt 限定检索范围（restrict）或提升范围内结果的排名（boost），见 search_filter。
+    """
+    return (handle or IndexHandle()).search(query, top_k, flt)
 
-    # 查询向量化
-    qvec = embed_batch([query])
-    faiss.normalize_L2(qvec)
 
-    # 搜索相似向量
-    scores, ids = index.search(qvec, min(top_k, index.ntotal))
+def search_many(queries: list[str], top_k=DEFAULT_TOPK, filters=None, handle: IndexHandle = None) -> list[list[dict]]:
+    """批量检索，见 IndexHandle.search_many"""
+    return (handle or IndexHandle()).search_many(queries, top_k, filters)
 
-    results = []
-    for score, idx in zip(scores[0], ids[0]):
-        if idx < len(meta):  # 确保索引有效
-            m = meta[idx]
-            results.append({
-                "path": m["path"],
-                "start": m["start"],
-                "text": m["text"],
-                "score": float(score)
-            })
 
-    return results
+def _lexical_lookup(meta, lexical: LexicalIndex, dup: np.ndarray, query: str, top_k: int, scope=None):
+    """标识符 / 字面量查询的快速路径：有行真正包含该字面量时直接返回结果，否则返回 None"""
+    literal = looks_like_identifier(query) if LEXICAL_FAST_PATH else ""
+    if not literal:
+        return None
+    restrict = scope is not None and scope[0] == "restrict"
+    hits = lexical.search(literal, max(top_k * 4, 50), scope[1] if restrict else None)
+    exact = _literal_hits(meta, hits, literal)
+    if scope is not None and not restrict:
+        exact.sort(key=lambda r: not scope[1][r])  # boost：范围内的命中排在前面
+    if not exact:
+        return None
+    lex_scores = dict(hits)
+    return [_result(meta, row, g, (RRF_K + 1) / (RRF_K + rank), None, lex_scores.get(row), "lexical")
+            for rank, (g, row) in enumerate(_rank_groups(exact, dup)[:top_k], 1)]
+
+
+def _fuse(meta, dup: np.ndarray, dense: list[list[tuple[int, float]]], lex_hits, top_k: int, scope=None) -> list[dict]:
+    """向量结果与 BM25 结果做倒数排名融合
+
+    dense / lex_hits 各是若干个排名列表（限定范围的列表在前）；lex_hits 为 None（没有 BM25 索引）
+    且只有一个向量排名时直接返回向量结果。
+    """
+    dense_scores = {}
+    for hits in reversed(dense):
+        dense_scores.update(hits)
+    dense_groups = [_rank_groups([r for r, _ in hits], dup) for hits in dense]
+    if lex_hits is None and len(dense) == 1:
+        return [_result(meta, _in_scope(meta, g, row, scope), g, dense_scores[row], dense_scores[row], None, "dense")
+                for g, row in dense_groups[0]]
+
+    lex_hits = lex_hits or []
+    lex_groups = [_rank_groups([r for r, _ in hits], dup) for hits in lex_hits]
+    lex_scores = {}
+    for hits in reversed(lex_hits):
+        lex_scores.update(hits)
+    # 同一组优先展示词法命中的那一行（它确实包含查询中的词）
+    shown = {}
+    for groups in dense_groups + lex_groups:
+        shown.update(groups)
+    rankings = [[g for g, _ in groups] for groups in dense_groups + lex_groups]
+    fused = rrf_fuse(rankings, RRF_K)[:top_k]
+    match = "hybrid" if lex_groups else "dense"
+    out = []
+    for g, score in fused:
+        row = _in_scope(meta, g, shown[g], scope)
+        out.append(_result(meta, row, g, score * (RRF_K + 1) / len(rankings), dense_scores.get(g),
+                           lex_scores.get(row), match))
+    return out
+
+
+def _in_scope(meta, group: int, row: int, scope) -> int:
+    """限定范围时，若展示行不在范围内，换成同组中范围内的重复块"""
+    if scope is None or scope[1][row]:
+        return row
+    for r in [group] + _duplicates(meta, group):
+        if scope[1][r]:
+            return r
+    return row
+
+
+def _rank_groups(rows: list[int], dup: np.ndarray) -> list[tuple[int, int]]:
+    """按代表块分组并去重，保持顺序，返回 [(代表块行号, 展示行号)]"""
+    seen, out = set(), []
+    for r in rows:
+        g = int(dup[r]) if dup[r] >= 0 else r
+        if g not in seen:
+            seen.add(g)
+            out.append((g, r))
+    return out
+
+
+def _literal_hits(meta, hits: list[tuple[int, float]], literal: str) -> list[int]:
+    """BM25 候选中真正包含该字面量的行：大小写一致的排在前面"""
+    exact, folded = [], []
+    low = literal.lower()
+    for r, _ in hits:
+        text = meta[r]["text"]
+        if literal in text:
+            exact.append(r)
+        elif low in text.lower():
+            folded.append(r)
+    return exact + folded
+
+
+def _result(meta, row: int, group: int, score: float, dense_score, lexical_score, match: str) -> dict:
+    m = meta[row]
+    dups = [r for r in [group] + _duplicates(meta, group) if r != row]
+    return {
+        "path": m["path"],
+        "start": m["start"],
+        "end": m.get("end"),
+        "symbol": m.get("symbol", ""),
+        "text": m["text"],
+        "score": float(score),
+        "dense_score": dense_score,
+        "lexical_score": lexical_score,
+        "match": match,
+        "duplicates": len(dups),
+        "duplicate_locations": [f"{meta[r]['path']}:{meta[r]['start']}" for r in dups[:5]],
+    }
+
+
+def _duplicates(meta, idx: int) -> list[int]:
+    """与代表块 idx 内容相同或近似的其他行"""
+    if isinstance(meta, ChunkMeta):
+        return meta.duplicates(idx)
+    return [i for i, m in enumerate(meta) if m.get("dup_of", -1) == idx]
 
 
 def build_prompt(query: str, snippets: list[dict]) -> str:
@@ -358,57 +1448,129 @@ def build_prompt(query: str, snippets: list[dict]) -> str:
 
     prompt = ["\n=== 检索到的代码片段 ==="]
     for i, s in enumerate(snippets, 1):
-        prompt.append(f"\n[片段 {i}] 文件: {s['path']} 行: {s['start']} 相似度: {s['score']:.3f}\n{s['text']}")
+        symbol = f" 符号: {s['symbol']}" if s.get("symbol") else ""
+        dups = f" （另有 {s['duplicates']} 处相似代码）" if s.get("duplicates") else ""
+        prompt.append(f"\n[片段 {i}] 文件: {s['path']} 行: {s['start']}{symbol} 相似度: {s['score']:.3f}{dups}\n{s['text']}")
     return "\n".join(prompt)
 
 
-def build_vec_index(project_root: str, out_path: str):
-    """构建向量索引入口函数"""
-    global INDEX_FILE, META_FILE
-    if out_path:
-        INDEX_FILE = out_path + "/faiss.index"
-        META_FILE = out_path + "/meta.json"
+def build_vec_index(project_root: str, out_path: str, incremental: bool = False, rebuild: bool = False,
+                    source_filters: bool = True, dim: int = None) -> IndexHandle:
+    """构建向量索引入口函数，返回该索引的 IndexHandle
 
-    # 创建输出目录
-    Path(out_path).mkdir(parents=True, exist_ok=True)
-
-    if Path(INDEX_FILE).exists() and Path(META_FILE).exists():
-        print(f"[跳过] 索引已存在: {INDEX_FILE}, 如需重建请手动删除")
-        return
+    incremental=False 时索引已存在则跳过；incremental=True 时按内容哈希增量更新已有索引；
+    rebuild=True 时重新构建。新索引写完后原子替换旧索引。
+    source_filters=False 用于非代码仓库的目录（见 list_files）；dim 见 IndexHandle。
+    """
+    handle = IndexHandle(out_path, project_root, source_filters=source_filters, dim=dim)
+    handle.build(incremental=incremental, rebuild=rebuild)
+    return handle
 
-    build_index(project_root)
 
+async def build_vec_index_async(project_root: str, out_path: str, incremental: bool = False,
+                                rebuild: bool = False) -> IndexHandle:
+    """build_vec_index 的异步版本：FastAPI 等异步代码直接 await，构建期间不阻塞事件循环"""
+    handle = IndexHandle(out_path, project_root)
+    await handle.build_async(incremental=incremental, rebuild=rebuild)
+    return handle
 
-def query_code(query: str, project_root: str, top_k: int = DEFAULT_TOPK, out_path: str = None):
-    """查询代码入口函数"""
-    global INDEX_FILE, META_FILE
-    if out_path:
-        INDEX_FILE = out_path + "/faiss.index"
-        META_FILE = out_path + "/meta.json"
 
-    build_vec_index(project_root, out_path)
-    snippets = search(query, top_k)
+def query_code(query: str, project_root: str, top_k: int = DEFAULT_TOPK, out_path: str = None,
+               flt: SearchFilter = None, source_filters: bool = True):
+    """查询代码入口函数（flt 限定或提升检索范围，见 search_filter；source_filters 见 build_vec_index）"""
+    handle = build_vec_index(project_root, out_path, source_filters=source_filters)
+    snippets = handle.search(query, top_k, flt)
     answer = build_prompt(query, snippets)
     return answer
 
 
+def query_code_many(queries: list[str], project_root: str, top_k: int = DEFAULT_TOPK, out_path: str = None,
+                    filters=None, source_filters: bool = True) -> list[str]:
+    """批量查询代码：与逐条调用 query_code 结果相同，但只有一次索引加载和一批嵌入请求
+    （filters 同 search_many）"""
+    handle = build_vec_index(project_root, out_path, source_filters=source_filters)
+    return [build_prompt(q, snippets) for q, snippets in zip(queries, handle.search_many(queries, top_k, filters))]
+
+
+def _link_index_files(src: "IndexHandle", dst: "IndexHandle") -> None:
+    """把 src 一代的全部索引文件放进 dst 一代（同一文件系统上硬链接，否则复制）；
+    各代的文件只会被整体替换、不会原地修改，共用 inode 是安全的"""
+    pairs = [(src.index_file, dst.index_file), (params_file(src.index_file), params_file(dst.index_file)),
+             (src.lexical_file, dst.lexical_file)]
+    dst_meta = store_files(dst.meta_file)
+    pairs += [(f, dst_meta[k]) for k, f in store_files(src.meta_file).items()]
+    for a, b in pairs:
+        if not os.path.exists(a):
+            continue
+        try:
+            os.link(a, b)
+        except OSError:
+            shutil.copy2(a, b)
+
+
+def convert_vec_index(out_path: str, storage: str = None, report_file: str = None, dim: int = None) -> dict:
+    """把已有索引转换为指定的向量存储格式（float32 / fp16 / sq8 / pq）或截断到 dim 维，
+    不重新嵌入；打印内存节省与召回率变化"""
+    handle = IndexHandle(out_path)
+    old = handle.snapshot()
+    if not Path(old.index_file).exists():
+        raise FileNotFoundError(f"索引文件不存在: {old.index_file}")
+    # 在新一代中转换（元数据、BM25 硬链接过去，不复制），转换完成后原子切换
+    target = handle.stage()
+    try:
+        _link_index_files(old, target)
+        report = convert_index(target.index_file, storage, cfg, dim=dim)
+        if not handle.commit(target):
+            raise RuntimeError("转换期间索引已被重新构建，请重新运行转换")
+    except BaseException:
+        handle.discard(target)
+        raise
+    print(f"\n=== 索引转换: {report['from']} -> {report['to']} ===")
+    print(f"向量数: {report['vectors']}  维度: {report['dim']} -> {report['dim_after']}")
+    print(f"内存: {report['memory_before_mb']:.2f} MB -> {report['memory_after_mb']:.2f} MB "
+          f"(压缩 {report['compression']:.1f} 倍)")
+    print(f"recall@{report['k']}: {report['recall_before']:.4f} -> {report['recall_after']:.4f} "
+          f"(损失 {report['recall_lost']:.4f})")
+    if report_file:
+        with open(report_file, "w", encoding="utf-8") as g:
+            json.dump(report, g, ensure_ascii=False, indent=2)
+    return report
+
+
 def main():
     """命令行入口"""
     parser = argparse.ArgumentParser(description="代码语义检索系统")
     parser.add_argument("--build", action="store_true", help="构建向量索引")
+    parser.add_argument("--incremental", action="store_true", help="增量更新已有索引（只嵌入变化的文本块）")
+    parser.add_argument("--rebuild", action="store_true", help="重新构建已有索引（完成后原子替换，期间旧索引照常可查）")
     parser.add_argument("--root", default=".", help="项目根目录")
     parser.add_argument("--query", type=str, help="用户问题")
     parser.add_argument("--top_k", type=int, default=DEFAULT_TOPK, help="返回结果数量")
     parser.add_argument("--out_path", type=str, default=INDEX_FILE, help="索引输出路径")
-    parser.add_argument("--concurrent", type=int, default=MAX_CONCURRENT, help="最大并发数")
+    parser.add_argument("--concurrent", type=int, default=MAX_CONCURRENT, help="初始并发数（运行中自适应调整）")
+    parser.add_argument("--convert", choices=STORAGE_TYPES, help="把 out_path 下已有索引转换为指定的向量存储格式")
+    parser.add_argument("--dim", type=int, help="把 out_path 下已有索引截断到指定维度（Matryoshka，不重新嵌入）；"
+                                                "与 --build 一起使用时按该维度构建")
+    parser.add_argument("--report", type=str, help="--convert / --dim 的内存 / 召回率报告 JSON 输出路径")
+    parser.add_argument("--files", type=str, help="只在这些文件中检索（相对 root，逗号分隔）")
+    parser.add_argument("--prefix", type=str, help="只在这些目录下检索（相对 root，逗号分隔）")
+    parser.add_argument("--lang", type=str, help="只检索这些语言（python、java、md 等，逗号分隔）")
+    parser.add_argument("--boost", action="store_true", help="范围内的结果优先，但不排除范围外的结果")
 
     args = parser.parse_args()
+    EMBED_LIMITER.set_limit(args.concurrent)
 
+    if args.convert or (args.dim and not args.build):
+        convert_vec_index(args.out_path, args.convert, args.report, dim=args.dim)
+        return
     if args.build:
-        build_vec_index(args.root, args.out_path)
+        build_vec_index(args.root, args.out_path, incremental=args.incremental, rebuild=args.rebuild, dim=args.dim)
         return
     if args.query:
-        ans = query_code(args.query, args.root, args.top_k, args.out_path)
+        split = lambda v: [x for x in (v or "").split(",") if x.strip()]
+        flt = SearchFilter(split(args.files), split(args.prefix), split(args.lang), root=args.root,
+                           mode="boost" if args.boost else "restrict")
+        ans = query_code(args.query, args.root, args.top_k, args.out_path, flt)
         print("\n----- 检索结果 -----\n")
         print(ans)
         return
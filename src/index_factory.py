@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按向量规模自动选择 faiss 索引类型
+
+    ntotal <  ANN_HNSW_THRESHOLD          -> Flat（精确检索）
+    ntotal <  ANN_IVFPQ_THRESHOLD         -> HNSW（图索引，内存略大于 Flat，检索亚线性）
+    ntotal >= ANN_IVFPQ_THRESHOLD         -> IVF-PQ（倒排 + 乘积量化，内存大幅下降）
+
+选择结果及参数写入索引旁的 <index>.params 文件，load_index 读取后恢复检索参数
+（efSearch / nprobe），保证加载后的行为与构建时一致。
+
+向量存储格式（INDEX_STORAGE）作用于 Flat / HNSW：
+    float32  原始向量（默认）
+    fp16     SQfp16，内存减半，召回几乎无损
+    sq8      SQ8 标量量化，内存为 1/4
+    pq       PQ 乘积量化（PQ_M 个子空间，每条 PQ_M 字节），向量太少时退回 sq8
+IVF-PQ 本身已是量化存储，不受此项影响。
+
+索引维度可以小于嵌入维度（Matryoshka 截断）：向量只保留前 dim 维并重新归一化（truncate_vectors），
+查询向量按索引维度做同样的截断。已有索引可用 convert_index 转换存储格式或截断维度（无需重新嵌入），
+并给出内存 / 召回率报告。
+
+只有部分元数据行进入索引时（近似重复的块不单独占位），构建时传入 ids，检索返回的编号仍是
+元数据行号：Flat / HNSW 外包 IndexIDMap2，IVF 直接 add_with_ids。
+
+filtered_search 只在给定的元数据行中检索（FAISS ID 选择器），用于按路径 / 语言限定范围。
+"""
+import os
+import json
+import math
+import numpy as np
+import faiss
+
+DEFAULTS = {
+    "ANN_HNSW_THRESHOLD": "50000",
+    "ANN_IVFPQ_THRESHOLD": "1000000",
+    "HNSW_M": "32",
+    "HNSW_EF_CONSTRUCTION": "80",
+    "HNSW_EF_SEARCH": "64",
+    "IVF_NPROBE": "16",
+    "PQ_M": "64",
+    "ANN_TRAIN_SIZE": "100000",
+    "INDEX_STORAGE": "float32",
+}
+STORAGE_TYPES = ("float32", "fp16", "sq8", "pq")
+PQ_MIN_VECTORS = 256 * 39  # 8 bit PQ 每个子空间 256 个中心，每个中心至少 39 个训练样本
+_CARRIED_KEYS = ("embedder",)  # 转换存储格式时沿用的索引参数
+FILTER_EXACT_MAX = 4096  # 过滤检索时范围内向量不超过此数直接精确计算
+FILTER_MAX_EF = 1024  # 过滤检索时 HNSW efSearch 的上限
+
+
+def _opt(cfg: dict, key: str) -> int:
+    return int(cfg.get(key) or DEFAULTS[key])
+
+
+def params_file(index_file: str) -> str:
+    return str(index_file) + ".params"
+
+
+def _pq_m(dim: int, wanted: int) -> int:
+    """PQ 子空间个数必须整除维度，取不超过 wanted 的最大约数"""
+    for m in range(min(wanted, dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def _storage(cfg: dict, ntotal: int) -> str:
+    storage = (cfg.get("INDEX_STORAGE") or DEFAULTS["INDEX_STORAGE"]).lower()
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"未知的向量存储格式: {storage}（可选 {', '.join(STORAGE_TYPES)}）")
+    if storage == "pq" and ntotal < PQ_MIN_VECTORS:
+        print(f"[索引] 向量数 {ntotal} 不足以训练 PQ 码本，改用 sq8")
+        storage = "sq8"
+    return storage
+
+
+def choose_spec(ntotal: int, dim: int, cfg: dict) -> dict:
+    """根据向量数量选择索引类型及参数"""
+    if ntotal < _opt(cfg, "ANN_IVFPQ_THRESHOLD"):
+        storage = _storage(cfg, ntotal)
+        codec = {"float32": "", "fp16": "SQfp16", "sq8": "SQ8",
+                 "pq": f"PQ{_pq_m(dim, _opt(cfg, 'PQ_M'))}"}[storage]
+        if ntotal < _opt(cfg, "ANN_HNSW_THRESHOLD"):
+            spec = {"type": "flat", "factory": codec or "Flat", "dim": dim}
+        else:
+            m = _opt(cfg, "HNSW_M")
+            spec = {
+                "type": "hnsw",
+                "factory": f"HNSW{m},{codec}" if codec else f"HNSW{m}",
+                "dim": dim,
+                "efConstruction": _opt(cfg, "HNSW_EF_CONSTRUCTION"),
+                "efSearch": _opt(cfg, "HNSW_EF_SEARCH"),
+            }
+        if codec:
+            # 量化器需要训练（SQ8 统计取值范围，PQ 训练码本）
+            spec.update(storage=storage, train_size=_opt(cfg, "ANN_TRAIN_SIZE"))
+        return spec
+    # 经验值：nlist ≈ 4·sqrt(N)，每个聚类至少 39 个训练样本
+    nlist = max(16, min(65536, int(4 * math.sqrt(ntotal))))
+    pq_m = _pq_m(dim, _opt(cfg, "PQ_M"))
+    return {
+        "type": "ivfpq",
+        "factory": f"IVF{nlist},PQ{pq_m}",
+        "dim": dim,
+        "nlist": nlist,
+        "nprobe": _opt(cfg, "IVF_NPROBE"),
+        "train_size": _opt(cfg, "ANN_TRAIN_SIZE"),
+    }
+
+
+def is_lossy(spec: dict) -> bool:
+    """索引中的向量能否被还原（PQ、SQ8 等量化索引不能；SQfp16 的误差可以忽略）"""
+    factory = spec.get("factory", "")
+    return "PQ" in factory or "SQ8" in factory or "SQ4" in factory or "SQ6" in factory
+
+
+def create_index(spec: dict):
+    return faiss.index_factory(spec["dim"], spec["factory"], faiss.METRIC_INNER_PRODUCT)
+
+
+def train_index(index, spec: dict, sample: np.ndarray) -> None:
+    """需要训练的索引（IVF/PQ）用采样向量训练"""
+    if index.is_trained:
+        return
+    print(f"训练索引 {spec['factory']}，样本数: {len(sample)}")
+    index.train(np.ascontiguousarray(sample, dtype="float32"))
+
+
+def training_sample(vecs: np.ndarray, spec: dict, rows: np.ndarray = None) -> np.ndarray:
+    rows = np.arange(len(vecs)) if rows is None else rows
+    n = len(rows)
+    size = min(n, int(spec.get("train_size", n)))
+    if size < n:
+        rows = rows[np.sort(np.random.default_rng(0).choice(n, size, replace=False))]
+    elif len(rows) == len(vecs):
+        return np.asarray(vecs)
+    return np.ascontiguousarray(vecs[rows], dtype="float32")
+
+
+def truncate_vectors(vecs: np.ndarray, dim: int) -> np.ndarray:
+    """Matryoshka 截断：保留前 dim 维并重新归一化（返回新数组）"""
+    if dim > vecs.shape[1]:
+        raise ValueError(f"不能把 {vecs.shape[1]} 维向量截断为 {dim} 维")
+    out = np.ascontiguousarray(vecs[:, :dim], dtype="float32")
+    faiss.normalize_L2(out)
+    return out
+
+
+ADD_CHUNK = 65536  # 分段添加，vecs 为 memmap 时每次只需把一段读入内存
+
+
+def build_from_vectors(vecs: np.ndarray, spec: dict, ids: np.ndarray = None, compact: bool = False):
+    """
+    用（已归一化的）向量构建索引，vecs 可以是磁盘上的 memmap。
+    ids 为空时加入全部向量，编号即行号；否则只加入 vecs[ids]，并以 ids 作为检索返回的编号。
+    compact=True 表示 vecs 只包含这些向量，vecs[i] 的编号为 ids[i]。
+    """
+    index = create_index(spec)
+    if spec["type"] == "hnsw":
+        faiss.downcast_index(index).hnsw.efConstruction = spec["efConstruction"]
+    ids = None if ids is None else np.asarray(ids, dtype="int64")
+    rows = None if ids is None or compact else ids
+    train_index(index, spec, training_sample(vecs, spec, rows))
+    if ids is None:
+        for i in range(0, len(vecs), ADD_CHUNK):
+            index.add(np.ascontiguousarray(vecs[i:i + ADD_CHUNK], dtype="float32"))
+    else:
+        if spec["type"] != "ivfpq":
+            index = faiss.IndexIDMap2(index)
+        for i in range(0, len(ids), ADD_CHUNK):
+            part = ids[i:i + ADD_CHUNK]
+            chunk = vecs[i:i + ADD_CHUNK] if compact else vecs[part]
+            index.add_with_ids(np.ascontiguousarray(chunk, dtype="float32"), part)
+    apply_search_params(index, spec)
+    return index
+
+
+def _base_index(index):
+    """去掉 IndexIDMap 外壳，返回实际存放向量的索引"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def apply_search_params(index, spec: dict) -> None:
+    """恢复检索期参数（这些参数不会随 faiss.write_index 持久化）"""
+    if spec.get("efSearch"):
+        _base_index(index).hnsw.efSearch = int(spec["efSearch"])
+    if spec.get("nprobe"):
+        faiss.extract_index_ivf(index).nprobe = int(spec["nprobe"])
+
+
+def _ivf(index):
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+
+
+def _top_k(scores: np.ndarray, ids: np.ndarray, k: int):
+    """每行分数最高的 k 个 (scores, ids)，与 index.search 的返回格式相同"""
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k] if k < scores.shape[1] else \
+        np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+    part = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-part, axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    return np.take_along_axis(scores, top, axis=1), ids[top]
+
+
+def filtered_search(index, queries: np.ndarray, k: int, mask: np.ndarray):
+    """
+    只在 mask 为 True 的编号（元数据行号）中检索，返回格式同 index.search。
+
+    - 范围内向量不多（<= FILTER_EXACT_MAX）且不是 IVF：取出这些向量直接做精确内积
+    - 否则用 IDSelectorBitmap 在检索时过滤；HNSW / IVF 按范围占比放大 efSearch / nprobe，
+      避免图遍历或倒排探测在范围很小时找不满 k 条
+    - 索引类型不支持选择器（如 IndexPQ）时多取一些结果再按 mask 过滤
+    """
+    ids = np.flatnonzero(mask).astype("int64")
+    k = min(k, len(ids))
+    if not k:
+        return np.empty((len(queries), 0), dtype="float32"), np.empty((len(queries), 0), dtype="int64")
+    ivf = _ivf(index)
+    if ivf is None and len(ids) <= FILTER_EXACT_MAX:
+        vecs = index.reconstruct_batch(ids)
+        return _top_k(queries @ vecs.T, ids, k)
+
+    frac = len(ids) / max(index.ntotal, 1)
+    bitmap = np.packbits(mask, bitorder="little")
+    sel = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        ef = min(max(base.hnsw.efSearch, int(k / frac)), FILTER_MAX_EF)
+        params = faiss.SearchParametersHNSW(sel=sel, efSearch=ef)
+    elif ivf is not None:
+        params = faiss.SearchParametersIVF(sel=sel, nprobe=min(ivf.nlist, math.ceil(ivf.nprobe / max(frac, 1e-3))))
+    else:
+        params = faiss.SearchParameters(sel=sel)
+    try:
+        return index.search(queries, k, params=params)
+    except RuntimeError:
+        pass
+    n = min(index.ntotal, math.ceil(k / frac) * 2)
+    scores, found = index.search(queries, n)
+    out_s = np.full((len(queries), k), -np.inf, dtype="float32")
+    out_i = np.full((len(queries), k), -1, dtype="int64")
+    for q in range(len(queries)):
+        keep = (found[q] >= 0) & mask[np.maximum(found[q], 0)]
+        s, i = scores[q][keep][:k], found[q][keep][:k]
+        out_s[q, :len(s)], out_i[q, :len(i)] = s, i
+    return out_s, out_i
+
+
+def save_spec(index_file: str, spec: dict) -> None:
+    with open(params_file(index_file), "w", encoding="utf-8") as g:
+        json.dump(spec, g, ensure_ascii=False)
+
+
+def load_spec(index_file: str) -> dict:
+    """读取索引参数；旧索引没有 .params 文件，视为 Flat"""
+    p = params_file(index_file)
+    if not os.path.exists(p):
+        return {"type": "flat", "factory": "Flat"}
+    with open(p, encoding="utf-8") as g:
+        return json.load(g)
+
+
+def index_memory_bytes(index) -> int:
+    """索引常驻内存估算：每条向量的编码 + HNSW 邻接表 / 倒排表中的编号 + 编号映射"""
+    n = index.ntotal
+    outer = faiss.downcast_index(index)
+    per_vector = 0
+    if isinstance(outer, faiss.IndexIDMap2):
+        per_vector += 8 + 32  # 编号数组 + 反向哈希表
+    elif isinstance(outer, faiss.IndexIDMap):
+        per_vector += 8
+    base = _base_index(index)
+    if hasattr(base, "hnsw"):
+        per_vector += base.hnsw.nb_neighbors(0) * 4
+        base = faiss.downcast_index(base.storage)
+    elif isinstance(base, faiss.IndexIVF):
+        per_vector += 8
+    per_vector += getattr(base, "code_size", index.d * 4)
+    return n * per_vector
+
+
+def stored_vectors(index):
+    """取出索引中的全部向量及其编号（无编号映射时编号为 None）"""
+    outer = faiss.downcast_index(index)
+    ids = None
+    if isinstance(outer, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        ids = faiss.vector_to_array(outer.id_map).astype("int64")
+    base = _base_index(index)
+    return base.reconstruct_n(0, base.ntotal), ids
+
+
+def _recall(truth: np.ndarray, found: np.ndarray) -> float:
+    k = truth.shape[1]
+    return float(sum(len(set(t) & set(f)) for t, f in zip(truth, found)) / (len(truth) * k))
+
+
+def quantization_report(vecs: np.ndarray, ids, before, after, n_queries: int = 200, k: int = 10) -> dict:
+    """以原始向量上的精确内积检索为基准，比较转换前后的 recall@k 和内存占用（after 可以是截断后的索引）"""
+    n, dim = vecs.shape
+    k = min(k, n)
+    rng = np.random.default_rng(0)
+    # 查询取库内向量加噪声，避免与自身完全重合
+    queries = vecs[rng.choice(n, min(n_queries, n), replace=False)]
+    queries = (queries + 0.05 * rng.standard_normal(queries.shape)).astype("float32")
+    faiss.normalize_L2(queries)
+    exact = faiss.IndexFlatIP(dim)
+    exact.add(vecs)
+    _, truth = exact.search(queries, k)
+    if ids is not None:
+        truth = ids[truth]
+    mem_before, mem_after = index_memory_bytes(before), index_memory_bytes(after)
+    recall_before = _recall(truth, before.search(queries, k)[1])
+    recall_after = _recall(truth, after.search(truncate_vectors(queries, after.d), k)[1])
+    return {
+        "vectors": n,
+        "dim": dim,
+        "dim_after": after.d,
+        "k": k,
+        "memory_before_mb": round(mem_before / 1024 / 1024, 2),
+        "memory_after_mb": round(mem_after / 1024 / 1024, 2),
+        "compression": round(mem_before / max(mem_after, 1), 2),
+        "recall_before": round(recall_before, 4),
+        "recall_after": round(recall_after, 4),
+        "recall_lost": round(recall_before - recall_after, 4),
+    }
+
+
+def convert_index(index_file: str, storage: str, cfg: dict, dim: int = None, n_queries: int = 200,
+                  k: int = 10) -> dict:
+    """
+    把已有索引转换为指定的向量存储格式、截断到 dim 维（原地替换，检索编号不变），返回内存 / 召回率报告。
+    storage / dim 为空时保持原样。源索引必须能还原向量（float32 或 fp16）；已是 SQ8 / PQ 的索引需要重新构建。
+    """
+    old_spec = load_spec(index_file)
+    if is_lossy(old_spec):
+        raise ValueError(f"{index_file} 已是有损量化索引（{old_spec['factory']}），无法还原原始向量，请重新构建")
+    old = faiss.read_index(index_file)
+    apply_search_params(old, old_spec)
+    vecs, ids = stored_vectors(old)
+    faiss.normalize_L2(vecs)
+
+    storage = storage or old_spec.get("storage") or "float32"
+    dim = dim or vecs.shape[1]
+    spec = choose_spec(len(vecs), dim, dict(cfg, INDEX_STORAGE=storage))
+    for key in _CARRIED_KEYS:
+        if key in old_spec:
+            spec[key] = old_spec[key]
+    new = build_from_vectors(truncate_vectors(vecs, dim), spec, ids, compact=True)
+    report = quantization_report(vecs, ids, old, new, n_queries, k)
+    report.update({"from": old_spec.get("factory"), "to": spec["factory"]})
+
+    # 先写临时文件再替换，转换中途失败不会损坏原索引
+    faiss.write_index(new, index_file + ".tmp")
+    save_spec(index_file + ".tmp", spec)
+    os.replace(params_file(index_file + ".tmp"), params_file(index_file))
+    os.replace(index_file + ".tmp", index_file)
+    return report
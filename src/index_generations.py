@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+索引快照（代际目录）与原子切换
+
+每次构建把索引、索引参数、元数据和 BM25 写进一个新的代际目录，全部落盘后再原子地切换 CURRENT：
+
+    <out>/.ewiki-index/
+        CURRENT       当前代的目录名（写临时文件、fsync 后 os.replace）
+        g000007/      当前代：faiss.index、faiss.index.params、meta.*、faiss.index.bm25
+        g000008/      正在构建的新一代，切换前读者看不到
+        faiss.index.ckpt/   嵌入检查点（跨代共用，构建成功后删除）
+
+读者每次检索时解析 CURRENT 得到文件路径（可以复用 max_age 秒内读到的值，本进程内的切换立即可见，
+其他进程的切换最多晚 max_age 秒被看到），构建期间继续使用旧一代；已加载的索引（faiss 读入内存，
+元数据 mmap 持有文件句柄）在切换、甚至旧目录被删除后仍可继续使用。构建失败时 CURRENT 不变。
+切换后只保留最近 INDEX_KEEP_GENERATIONS 代（含当前代），更旧的和中途崩溃留下的目录被回收；
+被替换下来的一代至少保留 INDEX_GENERATION_GRACE 秒，切换前刚开始的检索仍能读到它的全部文件。
+
+正在构建的一代目录里有 BUILDING 标记（记录构建进程的 pid），回收和 clear() 都不会删除它；
+构建进程已经不存在时标记视为失效，目录按崩溃残留回收。代号小于当前代的一代不允许提交，
+耗时很长的构建不会在更新的一代之后把 CURRENT 切回旧内容。
+"""
+import os
+import re
+import time
+import shutil
+import threading
+
+STORE_DIR = ".ewiki-index"
+POINTER = "CURRENT"
+BUILDING = "BUILDING"
+STALE_MARKER = 86400  # 无法检查进程是否存在的平台（Windows）上，标记超过这么久视为失效
+
+_GEN_RE = re.compile(r"^g(\d{6,})$")
+_lock = threading.Lock()  # 同一进程内分配代号、切换和回收互斥
+ANY = object()  # commit() 不检查当前代
+_pointers = {}  # CURRENT 路径 -> (代名, 读取时间)，供 current_name(max_age) 复用
+
+
+def _fsync_dir(path: str) -> None:
+    """目录项（新建、改名）落盘；Windows 不支持打开目录，跳过"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)  # 信号 0 只检查进程是否存在
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def fsync_tree(path: str) -> None:
+    """把目录下所有文件和目录本身刷到磁盘"""
+    for dirpath, _, filenames in os.walk(path):
+        for f in filenames:
+            with open(os.path.join(dirpath, f), "rb") as g:
+                os.fsync(g.fileno())
+        _fsync_dir(dirpath)
+
+
+class GenerationStore:
+    """root 下的代际目录：new() 分配新一代，commit() 原子切换，gc() 回收旧代"""
+
+    def __init__(self, root: str, keep: int = 2, grace: float = 300):
+        self.root = str(root)
+        self.dir = os.path.join(self.root, STORE_DIR)
+        self.keep = max(1, keep)
+        self.grace = grace
+
+    def __repr__(self) -> str:
+        return f"GenerationStore({self.dir!r}, current={self.current_name()})"
+
+    @property
+    def pointer(self) -> str:
+        return os.path.join(self.dir, POINTER)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    def generations(self) -> list[str]:
+        """已有的代际目录名（按代号升序）"""
+        if not os.path.isdir(self.dir):
+            return []
+        return sorted((d for d in os.listdir(self.dir) if _GEN_RE.match(d)), key=lambda d: int(d[1:]))
+
+    def current_name(self, max_age: float = 0) -> str:
+        """当前代的目录名；max_age > 0 时允许复用这么多秒内读到的值（检索时不必每次读盘），
+        切换、回收等需要最新值的地方用默认的 0"""
+        now = time.monotonic()
+        if max_age > 0:
+            cached = _pointers.get(self.pointer)
+            if cached is not None and now - cached[1] < max_age:
+                return cached[0]
+        try:
+            with open(self.pointer, encoding="utf-8") as f:
+                name = f.read().strip()
+        except FileNotFoundError:
+            name = None
+        name = name if name and _GEN_RE.match(name) else None
+        _pointers[self.pointer] = (name, now)
+        return name
+
+    def current(self, max_age: float = 0) -> str:
+        """当前代目录的路径；还没有提交过任何一代时返回 None（max_age 见 current_name）"""
+        name = self.current_name(max_age)
+        return self.path(name) if name else None
+
+    def new(self) -> str:
+        """创建新一代的空目录（代号大于所有已有目录）并标记为正在构建，返回其路径"""
+        with _lock:
+            os.makedirs(self.dir, exist_ok=True)
+            gens = self.generations()
+            n = int(gens[-1][1:]) + 1 if gens else 1
+            while True:
+                path = self.path(f"g{n:06d}")
+                try:
+                    os.mkdir(path)
+                    break
+                except FileExistsError:  # 其他进程同时分配了同一代号
+                    n += 1
+            with open(os.path.join(path, BUILDING), "w", encoding="utf-8") as f:
+                f.write(str(os.getpid()))
+            return path
+
+    def building(self, name: str) -> bool:
+        """该代是否正在构建（标记存在且构建进程仍在运行）"""
+        marker = os.path.join(self.path(name), BUILDING)
+        try:
+            with open(marker, encoding="utf-8") as f:
+                pid = int(f.read().strip() or 0)
+            if os.name == "nt":
+                return time.time() - os.stat(marker).st_mtime < STALE_MARKER
+        except (FileNotFoundError, ValueError):
+            return False
+        return pid == os.getpid() or _pid_alive(pid)
+
+    def commit(self, gen_dir: str, expected=ANY) -> list[str]:
+        """新一代落盘后原子切换 CURRENT，回收旧代，返回被删除的目录；
+        给出 expected 时只在当前代仍是 expected（None 表示还没有任何一代）时切换；
+        当前代已经比 gen_dir 新（更晚开始的构建先完成）时同样不切换。不切换时返回 None"""
+        name = os.path.basename(gen_dir.rstrip("/\\"))
+        marker = os.path.join(gen_dir, BUILDING)
+        fsync_tree(gen_dir)
+        with _lock:
+            current = self.current_name()
+            if expected is not ANY and current != expected:
+                return None
+            if current and int(current[1:]) > int(name[1:]):
+                return None
+            if os.path.exists(marker):
+                os.remove(marker)
+                _fsync_dir(gen_dir)
+            retired = self.current()
+            if retired and os.path.isdir(retired):
+                os.utime(retired)  # 目录 mtime 记为被替换的时间，回收时据此计算保留期
+            tmp = self.pointer + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(name + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.pointer)
+            _fsync_dir(self.dir)
+            _pointers[self.pointer] = (name, time.monotonic())
+            return self._gc()
+
+    def discard(self, gen_dir: str) -> None:
+        """放弃未提交的一代（构建失败或内容没有变化）"""
+        if os.path.basename(gen_dir.rstrip("/\\")) != self.current_name():
+            shutil.rmtree(gen_dir, ignore_errors=True)
+
+    def clear(self) -> list[str]:
+        """删除 CURRENT（读者随即看到索引不存在）并立即删除全部代际目录（正在构建的除外）"""
+        with _lock:
+            if os.path.exists(self.pointer):
+                os.remove(self.pointer)
+                _fsync_dir(self.dir)
+            _pointers.pop(self.pointer, None)
+            return self._gc(force=True)
+
+    def gc(self) -> list[str]:
+        with _lock:
+            return self._gc()
+
+    def _gc(self, force: bool = False) -> list[str]:
+        """保留当前代和它之前最近的 keep-1 代，更旧的超过保留期后删除；
+        正在构建的目录和比当前代新的目录（可能刚分配、还没写入标记）不删除"""
+        current = self.current_name()
+        cur = int(current[1:]) if current else None
+        older = [g for g in self.generations() if (cur is None or int(g[1:]) < cur) and not self.building(g)]
+        doomed = older if cur is None else older[:max(0, len(older) - (self.keep - 1))]
+        now = time.time()
+        removed = []
+        for g in doomed:
+            path = self.path(g)
+            try:
+                if not force and now - os.stat(path).st_mtime < self.grace:
+                    continue
+            except FileNotFoundError:
+                continue
+            # 已加载的旧索引持有文件句柄，删除后仍可读；Windows 上删除失败时留到下次回收
+            shutil.rmtree(path, ignore_errors=True)
+            if not os.path.exists(path):
+                removed.append(path)
+        return removed
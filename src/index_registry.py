@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+已加载索引的进程内缓存
+
+以文件路径为键缓存 faiss 索引和元数据，文件的 mtime/size 变化时自动失效重新加载，
+总内存超过预算时按 LRU 淘汰，热查询不再重复读盘和解析 meta。
+被淘汰、失效或被重新加载替换的对象会调用其中元素的 close()（如 ChunkMeta 的 mmap），
+长期运行的服务不会因旧索引累积文件描述符；正在使用的对象由其自身的 acquire / release 推迟关闭。
+"""
+import os
+import threading
+from collections import OrderedDict
+
+
+def _signature(paths: tuple) -> tuple:
+    """文件签名：(mtime_ns, size) 列表，任何一个文件被改写都会变化"""
+    sig = []
+    for p in paths:
+        st = os.stat(p)
+        sig.append((st.st_mtime_ns, st.st_size))
+    return tuple(sig)
+
+
+def _close(values) -> None:
+    """关闭缓存对象（或 (索引, 元数据) 元组）中带 close() 的部分"""
+    for value in values:
+        for item in value if isinstance(value, tuple) else (value,):
+            close = getattr(item, "close", None)
+            if callable(close):
+                close()
+
+
+class IndexRegistry:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (signature, value, size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, paths, loader, size_of=None):
+        """
+        取出 paths 对应的已加载对象；未缓存或文件已变化时调用 loader(*paths) 重新加载。
+        size_of(value) 用于估算内存占用，缺省按文件大小估算。
+        """
+        key = tuple(os.path.abspath(p) for p in paths)
+        sig = _signature(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == sig:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        # 加载过程可能较慢，不持有锁；并发加载同一索引时以后写入者为准
+        value = loader(*paths)
+        size = size_of(value) if size_of else sum(s for _, s in sig)
+        with self._lock:
+            self.misses += 1
+            old = self._entries.get(key)
+            self._entries[key] = (sig, value, size)
+            self._entries.move_to_end(key)
+            dropped = self._evict()
+        if old is not None and old[1] is not value:
+            dropped.append(old[1])
+        _close(dropped)
+        return value
+
+    def cached(self, paths):
+        """已缓存的对象，不检查文件签名（只用于写完后不再改变的文件）；未缓存时返回 None"""
+        key = tuple(os.path.abspath(p) for p in paths)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def invalidate(self, paths=None) -> None:
+        """移除指定路径的缓存，paths 为空时清空全部"""
+        with self._lock:
+            if paths is None:
+                dropped = [value for _, value, _ in self._entries.values()]
+                self._entries.clear()
+            else:
+                entry = self._entries.pop(tuple(os.path.abspath(p) for p in paths), None)
+                dropped = [entry[1]] if entry else []
+        _close(dropped)
+
+    def invalidate_prefix(self, prefix: str) -> None:
+        """移除第一个路径以 prefix 开头的缓存（如某一代索引目录下的全部文件）"""
+        prefix = os.path.abspath(prefix) + (os.sep if prefix.endswith(("/", os.sep)) else "")
+        with self._lock:
+            dropped = [self._entries.pop(k)[1] for k in [k for k in self._entries if k[0].startswith(prefix)]]
+        _close(dropped)
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            return sum(size for _, _, size in self._entries.values())
+
+    def _evict(self) -> list:
+        """超过预算时淘汰最久未使用的索引，至少保留最近一个；返回被淘汰的对象，由调用方在锁外关闭"""
+        dropped = []
+        if self.max_bytes <= 0:
+            return dropped
+        total = sum(size for _, _, size in self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            key, (_, value, size) = self._entries.popitem(last=False)
+            total -= size
+            dropped.append(value)
+            print(f"[索引缓存] 淘汰 {key[0]} ({size / 1024 / 1024:.1f} MB)")
+        return dropped
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地 BM25 倒排索引（与 faiss.index 并存，文件为 <index>.bm25）
+
+类名、配置项、报错信息这类精确标识符，向量检索经常找不准，而且每次查询都要请求一次嵌入接口。
+这里在构建索引时顺带为每个文本块建立倒排表：
+
+- tokenize：标识符感知的分词。完整标识符（小写）作为一个词，驼峰 / 下划线 / 点号拆出的
+  子词也各自作为词；中文按相邻两字切分
+- LexicalIndexWriter：构建时逐行 add，save 时按词排序写成紧凑的 npz（词表、偏移、行号、词频、文档长度）
+- LexicalIndex：BM25 打分，返回 (行号, 分数)
+- merge_lexical：按文件增量更新时删除 / 重新编号旧行并追加新行，不必重新分词整个项目
+
+检索时与向量结果做倒数排名融合（reciprocal rank fusion，见 rrf_fuse）；
+查询明显是标识符查找时（looks_like_identifier）可以只用本索引回答，不发起网络请求。
+"""
+import os
+import re
+from array import array
+from collections import Counter
+import numpy as np
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+MAX_TERM_LEN = 64
+
+_WORD_RE = re.compile(r"[A-Za-z_$][A-Za-z0-9_$]*(?:(?:\.|::|#)[A-Za-z_$][A-Za-z0-9_$]*)*|\d+|[一-鿿]+")
+_PART_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+# 含下划线、驼峰、点号/::/#、全大写常量的单个词视为标识符
+_IDENT_QUERY_RE = re.compile(r"[A-Za-z_$][\w$]*(?:(?:\.|::|#)[A-Za-z_$][\w$]*)*(?:\(\))?")
+_QUOTES = ("\"\"", "''", "``")
+
+
+def tokenize(text: str) -> list[str]:
+    out = []
+    for w in _WORD_RE.findall(text):
+        if w[0] >= "一":
+            out.extend(w[i:i + 2] for i in range(max(1, len(w) - 1)))
+            continue
+        out.append(w.lower()[:MAX_TERM_LEN])
+        parts = _PART_RE.findall(w)
+        if len(parts) > 1:
+            out.extend(p.lower() for p in parts if len(p) > 1)
+    return out
+
+
+def looks_like_identifier(query: str) -> str:
+    """
+    查询是否是明确的标识符 / 字面量查找，是则返回要查找的字面量，否则返回空字符串。
+    例：UserService、MAX_CONCURRENT、spring.datasource.url、`connection refused`
+    """
+    q = query.strip()
+    if len(q) >= 3 and q[0] + q[-1] in _QUOTES:
+        return q[1:-1].strip()
+    if not _IDENT_QUERY_RE.fullmatch(q):
+        return ""
+    name = q[:-2] if q.endswith("()") else q
+    if ("_" in name.strip("_") or "." in name or "::" in name or "#" in name
+            or re.search(r"[a-z][A-Z]", name) or (name.isupper() and len(name) >= 3)):
+        return name
+    return ""
+
+
+class LexicalIndexWriter:
+    """构建期在内存中累积倒排表（每个 posting 6 字节），save 时一次写出"""
+
+    def __init__(self):
+        self._postings = {}  # term -> (array 行号, array 词频)
+        self._doc_len = array("i")
+
+    def add(self, row: int, text: str) -> None:
+        # 行号必须从 0 开始连续递增（与元数据行号一致）
+        if row != len(self._doc_len):
+            raise ValueError(f"行号不连续: {row} != {len(self._doc_len)}")
+        counts = Counter(tokenize(text))
+        self._doc_len.append(sum(counts.values()))
+        for term, tf in counts.items():
+            p = self._postings.get(term)
+            if p is None:
+                p = self._postings[term] = (array("i"), array("H"))
+            p[0].append(row)
+            p[1].append(min(tf, 65535))
+
+    def save(self, path: str) -> None:
+        terms = sorted(self._postings)
+        offsets = np.zeros(len(terms) + 1, dtype="int64")
+        for i, t in enumerate(terms):
+            offsets[i + 1] = offsets[i] + len(self._postings[t][0])
+        rows = np.empty(offsets[-1], dtype="int32")
+        tfs = np.empty(offsets[-1], dtype="uint16")
+        for i, t in enumerate(terms):
+            r, f = self._postings[t]
+            rows[offsets[i]:offsets[i + 1]] = np.frombuffer(r, dtype="int32")
+            tfs[offsets[i]:offsets[i + 1]] = np.frombuffer(f, dtype="uint16")
+        _write(path, terms, offsets, rows, tfs, np.frombuffer(self._doc_len, dtype="int32"))
+
+
+def _write(path: str, terms: list[str], offsets: np.ndarray, rows: np.ndarray, tfs: np.ndarray,
+           doc_len: np.ndarray) -> None:
+    blob = np.frombuffer("\n".join(terms).encode("utf-8"), dtype="uint8")
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, terms=blob, offsets=offsets, rows=rows, tfs=tfs, doc_len=doc_len)
+    os.replace(tmp, path)
+
+
+def merge_lexical(old: "LexicalIndex", remap: np.ndarray, added: LexicalIndexWriter, path: str) -> None:
+    """
+    增量更新倒排表并写到 path：old 中 remap 为 -1 的行被删除，其余行改用 remap 给出的新行号
+    （保留的行保持原有顺序），再追加 added 中的行（added 的行号从 0 开始，接在保留的行之后）。
+    写出的文件与对同样内容完整构建的结果相同。
+    """
+    base = int((remap >= 0).sum())
+    terms = list(old.vocab)
+    vocab = dict(old.vocab)
+    for t in added._postings:
+        if t not in vocab:
+            vocab[t] = len(terms)
+            terms.append(t)
+
+    old_rows = remap[old.rows]
+    keep = old_rows >= 0
+    term_ids = [np.repeat(np.arange(len(old.vocab), dtype="int64"), np.diff(old.offsets))[keep]]
+    rows = [old_rows[keep].astype("int32")]
+    tfs = [old.tfs[keep]]
+    for t, (r, f) in added._postings.items():
+        term_ids.append(np.full(len(r), vocab[t], dtype="int64"))
+        rows.append(np.frombuffer(r, dtype="int32") + base)
+        tfs.append(np.frombuffer(f, dtype="uint16"))
+    term_ids, rows, tfs = np.concatenate(term_ids), np.concatenate(rows), np.concatenate(tfs)
+
+    # 词表按字典序重排，去掉不再出现的词；倒排表按 (词, 行号) 排序
+    order = sorted(range(len(terms)), key=terms.__getitem__)
+    rank = np.empty(len(terms), dtype="int64")
+    rank[order] = np.arange(len(terms))
+    term_ids = rank[term_ids]
+    counts = np.bincount(term_ids, minlength=len(terms))
+    used = np.flatnonzero(counts)
+    sort = np.lexsort((rows, term_ids))
+    offsets = np.zeros(len(used) + 1, dtype="int64")
+    np.cumsum(counts[used], out=offsets[1:])
+    doc_len = np.concatenate([old.doc_len[remap >= 0], np.frombuffer(added._doc_len, dtype="int32")])
+    _write(path, [terms[order[i]] for i in used], offsets, rows[sort], tfs[sort], doc_len.astype("int32"))
+
+
+class LexicalIndex:
+    def __init__(self, path: str):
+        with np.load(path) as z:
+            blob = z["terms"].tobytes().decode("utf-8")
+            self.offsets = z["offsets"]
+            self.rows = z["rows"]
+            self.tfs = z["tfs"]
+            self.doc_len = z["doc_len"]
+        terms = blob.split("\n") if blob else []
+        self.vocab = dict(zip(terms, range(len(terms))))
+        self.n_docs = len(self.doc_len)
+        self.avgdl = float(self.doc_len.mean()) if self.n_docs else 0.0
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    def memory_bytes(self) -> int:
+        arrays = self.offsets.nbytes + self.rows.nbytes + self.tfs.nbytes + self.doc_len.nbytes
+        return arrays + len(self.vocab) * 100
+
+    def scores(self, query: str) -> np.ndarray:
+        """每一行的 BM25 分数"""
+        out = np.zeros(self.n_docs, dtype="float32")
+        if not self.n_docs:
+            return out
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len / max(self.avgdl, 1e-6))
+        for term in set(tokenize(query)):
+            t = self.vocab.get(term)
+            if t is None:
+                continue
+            s, e = self.offsets[t], self.offsets[t + 1]
+            rows = self.rows[s:e]
+            tf = self.tfs[s:e].astype("float32")
+            idf = np.log(1 + (self.n_docs - len(rows) + 0.5) / (len(rows) + 0.5))
+            out[rows] += idf * tf * (BM25_K1 + 1) / (tf + norm[rows])
+        return out
+
+    def search(self, query: str, k: int, mask: np.ndarray = None) -> list[tuple[int, float]]:
+        """分数最高的 k 行 [(行号, 分数)]，只包含至少命中一个词的行；mask 给出时只保留其中为 True 的行"""
+        scores = self.scores(query)
+        hit = np.flatnonzero((scores > 0) & mask if mask is not None else scores > 0)
+        if len(hit) > k:
+            hit = hit[np.argpartition(-scores[hit], k - 1)[:k]]
+        hit = hit[np.argsort(-scores[hit], kind="stable")]
+        return [(int(r), float(scores[r])) for r in hit]
+
+
+def rrf_fuse(rankings: list[list[int]], k: int = 60) -> list[tuple[int, float]]:
+    """倒数排名融合：score = Σ 1 / (k + rank)，rank 从 1 开始"""
+    fused = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, 1):
+            fused[key] = fused.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda x: -x[1])
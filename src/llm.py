@@ -26,6 +26,8 @@ PROXY = {
     "http": "http://xxx:80"
 }
 from .config import load_config
+from .concurrency import AdaptiveConcurrency, classify, retry_after_seconds, backoff_delay
+import time
 import logging
 from openai import OpenAI
 
@@ -41,6 +43,13 @@ META_FILE     = cfg["META_FILE"]
 MAX_LINES     = int(cfg["MAX_LINES"])
 BATCH_SIZE    = int(cfg["BATCH_SIZE"])
 DEFAULT_TOPK  = int(cfg["TOP_K"])
+LLM_MAX_CONCURRENT = int(cfg.get("LLM_MAX_CONCURRENT", "4"))
+LLM_MAX_RETRIES    = int(cfg.get("LLM_MAX_RETRIES", "5"))
+
+# LLM 调用的自适应并发窗口；生成耗时随输出长度变化很大，延迟容忍度放宽，主要依据 429/5xx 调整
+LLM_LIMITER = AdaptiveConcurrency(LLM_MAX_CONCURRENT,
+                                  max_limit=int(cfg.get("LLM_MAX_CONCURRENT_LIMIT", str(LLM_MAX_CONCURRENT * 4))),
+                                  latency_tolerance=10.0, name="llm")
 
 
 
@@ -51,6 +60,7 @@ def generate( prompt: str, temperature: float = 0.0, max_tokens: int = 20480) ->
     client = OpenAI(
         api_key=API_KEY,
         base_url=DASHSCOPE_GENERATION_URL,
+        max_retries=0,  # 重试由下方根据 429 / Retry-After 控制
     )
 
     messages = [
@@ -60,12 +70,31 @@ def generate( prompt: str, temperature: float = 0.0, max_tokens: int = 20480) ->
     logger.info("[LLM] >>> model=qwen-plus | max_tokens=%s | temperature=%s", max_tokens, temperature)
     logger.debug("[LLM] >>> messages=%s", messages)
 
-    resp = client.chat.completions.create(
-        model=LLM_NAME,
-        messages=messages,
-        temperature=temperature or 0.7,
-        max_tokens=max_tokens,
-    )
+    for attempt in range(LLM_MAX_RETRIES):
+        try:
+            with LLM_LIMITER.sync_slot():
+                started = time.monotonic()
+                resp = client.chat.completions.create(
+                    model=LLM_NAME,
+                    messages=messages,
+                    temperature=temperature or 0.7,
+                    max_tokens=max_tokens,
+                )
+            LLM_LIMITER.on_success(time.monotonic() - started)
+            break
+        except Exception as e:
+            kind = classify(e)
+            retry_after = retry_after_seconds(e)
+            if kind == "throttle":
+                LLM_LIMITER.on_throttle(retry_after)
+            elif kind == "server":
+                LLM_LIMITER.on_error()
+            if kind == "client" or attempt == LLM_MAX_RETRIES - 1:
+                raise
+            delay = backoff_delay(attempt, 2, retry_after)
+            logger.warning("[LLM] %s error, retry %s in %.1fs (window=%s): %s",
+                           kind, attempt + 1, delay, LLM_LIMITER.window, e)
+            time.sleep(delay)
 
     content = resp.choices[0].message.content.strip()
     logger.info("[LLM] <<< content(length=%s)=%.10000s...", len(content), content)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+紧凑的分列式 chunk 元数据存储（替代 meta.json）
+
+以 META_FILE（如 out/meta.json）去掉 .json 后缀为前缀，落盘三个文件：
+    meta.rows.npy   定长记录数组：路径编号、起止行、文本偏移/长度、所属符号编号、近似重复的代表行、内容 md5
+    meta.strings    字符串表（JSON）：文件路径列表、符号名列表
+    meta.blob       所有 chunk 文本按 UTF-8 顺序拼接
+    meta.manifest.json  每个文件的行范围、大小和 mtime（按文件增量更新时定位要删除的行）
+
+加载时只读取 rows 和字符串表，文本通过 mmap 按需读取，只有真正返回的命中结果才会解码。
+旧版 meta.json 仍可读取。
+"""
+import os
+import json
+import mmap
+import threading
+import hashlib
+import numpy as np
+
+ROW_DTYPE = np.dtype([
+    ("path", "<i4"),
+    ("start", "<i4"),
+    ("end", "<i4"),
+    ("offset", "<i8"),
+    ("length", "<i4"),
+    ("symbol", "<i4"),      # 所属类/函数（语法分块时记录，0 为空字符串）
+    ("dup_of", "<i4"),      # 近似/完全重复时为代表块的行号（该行不进入向量索引），否则为 -1
+    ("hash", "u1", (16,)),  # md5 原始字节（不用 S16，numpy 会截掉末尾的 \x00）
+])
+
+
+def store_prefix(meta_file: str) -> str:
+    meta_file = str(meta_file)
+    return meta_file[:-5] if meta_file.endswith(".json") else meta_file
+
+
+def store_files(meta_file: str) -> dict:
+    """元数据相关的全部文件路径（含旧版 meta.json）"""
+    prefix = store_prefix(meta_file)
+    return {
+        "rows": prefix + ".rows.npy",
+        "strings": prefix + ".strings",
+        "blob": prefix + ".blob",
+        "manifest": prefix + ".manifest.json",
+        "legacy": str(meta_file),
+    }
+
+
+def meta_exists(meta_file: str) -> bool:
+    files = store_files(meta_file)
+    return os.path.exists(files["rows"]) or os.path.exists(files["legacy"])
+
+
+def meta_marker(meta_file: str) -> str:
+    """用于判断元数据是否变化的文件（新格式为 rows，旧格式为 meta.json）"""
+    files = store_files(meta_file)
+    return files["rows"] if os.path.exists(files["rows"]) else files["legacy"]
+
+
+def remove_meta(meta_file: str) -> None:
+    for p in store_files(meta_file).values():
+        if os.path.exists(p):
+            os.remove(p)
+
+
+class MetaWriter:
+    """逐条追加 chunk 元数据，close() 时原子替换旧文件"""
+
+    def __init__(self, meta_file: str):
+        self.meta_file = str(meta_file)
+        self.files = store_files(self.meta_file)
+        self._paths = []
+        self._path_ids = {}
+        self._symbols = [""]
+        self._symbol_ids = {"": 0}
+        self._offset = 0
+        self.count = 0
+        self._blob = open(self.files["blob"] + ".tmp", "wb")
+        # 定长记录先顺序写入临时文件，close() 时再转成 .npy，内存占用与 chunk 数无关
+        self._rows = open(self.files["rows"] + ".raw.tmp", "wb")
+
+    def _path_id(self, path: str) -> int:
+        pid = self._path_ids.get(path)
+        if pid is None:
+            pid = self._path_ids[path] = len(self._paths)
+            self._paths.append(path)
+        return pid
+
+    def _symbol_id(self, symbol: str) -> int:
+        sid = self._symbol_ids.get(symbol)
+        if sid is None:
+            sid = self._symbol_ids[symbol] = len(self._symbols)
+            self._symbols.append(symbol)
+        return sid
+
+    def add(self, path: str, start: int, text: str, hash_hex: str, symbol: str = "", dup_of: int = -1) -> None:
+        pid = self._path_id(path)
+        sid = self._symbol_id(symbol)
+        data = text.encode("utf-8")
+        self._blob.write(data)
+        end = start + max(len(text.splitlines()), 1) - 1
+        row = np.array([(pid, start, end, self._offset, len(data), sid, dup_of,
+                         np.frombuffer(bytes.fromhex(hash_hex), dtype="u1"))], dtype=ROW_DTYPE)
+        self._rows.write(row.tobytes())
+        self._offset += len(data)
+        self.count += 1
+
+    def extend(self, meta: "ChunkMeta", rows: np.ndarray, dup_of: np.ndarray) -> None:
+        """批量追加 meta 中的 rows 行（文本按字节拷贝，不解码），dup_of 为这些行在新元数据中的代表行号"""
+        rows = np.asarray(rows, dtype="int64")
+        if not len(rows):
+            return
+        src = np.asarray(meta.rows[rows])
+        path_map = np.zeros(len(meta.paths), dtype="<i4")
+        for pid in np.unique(src["path"]).tolist():
+            path_map[pid] = self._path_id(meta.paths[pid])
+        out = np.zeros(len(rows), dtype=ROW_DTYPE)
+        out["path"] = path_map[src["path"]]
+        if meta._has_symbol:
+            symbol_map = np.zeros(len(meta.symbols), dtype="<i4")
+            for sid in np.unique(src["symbol"]).tolist():
+                symbol_map[sid] = self._symbol_id(meta.symbols[sid])
+            out["symbol"] = symbol_map[src["symbol"]]
+        for col in ("start", "end", "length", "hash"):
+            out[col] = src[col]
+        out["dup_of"] = dup_of
+        lengths = src["length"].astype("int64")
+        out["offset"] = self._offset + np.cumsum(lengths) - lengths
+        # 原文本在 blob 中首尾相接的行合并成一次拷贝
+        offsets = src["offset"].astype("int64")
+        breaks = np.flatnonzero(offsets[1:] != offsets[:-1] + lengths[:-1]) + 1
+        for a, b in zip(np.r_[0, breaks], np.r_[breaks, len(rows)]):
+            self._blob.write(meta._blob[offsets[a]:offsets[b - 1] + lengths[b - 1]])
+        self._rows.write(out.tobytes())
+        self._offset += int(lengths.sum())
+        self.count += len(rows)
+
+    def _write_rows(self) -> None:
+        """把原始记录分段拷贝进 .npy（np.save 需要预先知道行数）"""
+        self._rows.close()
+        raw = self.files["rows"] + ".raw.tmp"
+        out = np.lib.format.open_memmap(self.files["rows"] + ".tmp", mode="w+",
+                                        dtype=ROW_DTYPE, shape=(self.count,))
+        if self.count:
+            src = np.memmap(raw, dtype=ROW_DTYPE, mode="r", shape=(self.count,))
+            step = 1 << 20
+            for i in range(0, self.count, step):
+                out[i:i + step] = src[i:i + step]
+            del src
+        out.flush()
+        del out
+        os.remove(raw)
+
+    def close(self) -> None:
+        self._blob.close()
+        with open(self.files["strings"] + ".tmp", "w", encoding="utf-8") as g:
+            json.dump({"version": 2, "paths": self._paths, "symbols": self._symbols}, g, ensure_ascii=False)
+        self._write_rows()
+        # rows 最后替换，作为新元数据生效的标志
+        os.replace(self.files["blob"] + ".tmp", self.files["blob"])
+        os.replace(self.files["strings"] + ".tmp", self.files["strings"])
+        os.replace(self.files["rows"] + ".tmp", self.files["rows"])
+        if os.path.exists(self.files["legacy"]):
+            os.remove(self.files["legacy"])
+
+    def abort(self) -> None:
+        self._blob.close()
+        self._rows.close()
+        for tmp in (self.files["blob"] + ".tmp", self.files["strings"] + ".tmp",
+                    self.files["rows"] + ".tmp", self.files["rows"] + ".raw.tmp"):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+class ChunkMeta:
+    """只读的 chunk 元数据，支持 len() 和下标访问，文本按需从 mmap 读取"""
+
+    def __init__(self, meta_file: str):
+        files = store_files(meta_file)
+        self.rows = np.load(files["rows"], mmap_mode="r")
+        with open(files["strings"], encoding="utf-8") as g:
+            strings = json.load(g)
+        self.paths = strings["paths"]
+        # version 1 的元数据没有符号列
+        self.symbols = strings.get("symbols", [""])
+        self._has_symbol = "symbol" in self.rows.dtype.names
+        self._dups = None  # 代表行 -> 重复行列表，首次用到时构建
+        # mmap 自己持有一份文件描述符，映射完成后立即关闭原文件
+        with open(files["blob"], "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self._lock = threading.Lock()
+        self._users = 0        # acquire 之后尚未 release 的使用者
+        self._closing = False  # 已请求关闭，最后一个使用者 release 时真正关闭
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, idx: int) -> dict:
+        r = self.rows[idx]
+        return {
+            "path": self.paths[r["path"]],
+            "start": int(r["start"]),
+            "end": int(r["end"]),
+            "text": self.text(idx),
+            "symbol": self.symbols[r["symbol"]] if self._has_symbol else "",
+            "dup_of": int(r["dup_of"]) if "dup_of" in self.rows.dtype.names else -1,
+            "hash": r["hash"].tobytes().hex(),
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def text(self, idx: int) -> str:
+        r = self.rows[idx]
+        off, n = int(r["offset"]), int(r["length"])
+        return bytes(self._blob[off:off + n]).decode("utf-8", errors="ignore")
+
+    def hashes(self) -> list[str]:
+        return [h.tobytes().hex() for h in self.rows["hash"]]
+
+    def keys(self) -> list[tuple]:
+        """(path, start, hash) 列表，用于判断分块结果是否变化"""
+        paths = self.paths
+        return [(paths[p], int(s), h.tobytes().hex()) for p, s, h in
+                zip(self.rows["path"], self.rows["start"], self.rows["hash"])]
+
+    def dup_of(self) -> np.ndarray:
+        """每行的代表行号（-1 表示本身是代表块）；旧版元数据没有该列，全部为 -1"""
+        if "dup_of" in self.rows.dtype.names:
+            return self.rows["dup_of"]
+        return np.full(len(self.rows), -1, dtype="<i4")
+
+    def duplicates(self, idx: int) -> list[int]:
+        """代表块 idx 的所有重复行"""
+        if self._dups is None:
+            dup = np.asarray(self.dup_of())
+            rows = np.nonzero(dup >= 0)[0]
+            self._dups = {}
+            for r, rep in zip(rows.tolist(), dup[rows].tolist()):
+                self._dups.setdefault(rep, []).append(r)
+        return self._dups.get(idx, [])
+
+    def memory_bytes(self) -> int:
+        return self.rows.nbytes + sum(len(p) for p in self.paths + self.symbols) * 2
+
+    def acquire(self) -> bool:
+        """登记一个使用者，使用期间 close 不会释放 mmap；已关闭时返回 False，调用方应重新加载"""
+        with self._lock:
+            if self._closing:
+                return False
+            self._users += 1
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self._users -= 1
+            if not self._closing or self._users:
+                return
+        self._release_files()
+
+    def close(self) -> None:
+        """关闭 mmap 和文件描述符；仍有使用者时推迟到最后一个使用者 release，可重复调用"""
+        with self._lock:
+            if self._closing:
+                return
+            self._closing = True
+            if self._users:
+                return
+        self._release_files()
+
+    def _release_files(self) -> None:
+        if isinstance(self._blob, mmap.mmap):
+            self._blob.close()
+        # rows 的 memmap 可能还有外部视图（如 dup_of() 的返回值），只放开引用，随最后一个视图释放
+        self.rows = None
+
+
+def open_meta(meta_file: str):
+    """打开元数据：优先新格式，不存在时回退读取旧版 meta.json（返回 list[dict]）"""
+    files = store_files(meta_file)
+    if os.path.exists(files["rows"]):
+        return ChunkMeta(meta_file)
+    with open(files["legacy"], encoding="utf-8") as g:
+        return json.load(g)
+
+
+def write_manifest(meta_file: str) -> dict:
+    """按已写出的元数据生成文件清单：{路径: {"rows": [[首行, 行数], ...], "size", "mtime_ns"}}"""
+    meta = ChunkMeta(meta_file)
+    try:
+        col = np.asarray(meta.rows["path"])
+        starts = np.flatnonzero(np.r_[True, col[1:] != col[:-1]]) if len(col) else np.empty(0, dtype="int64")
+        counts = np.diff(np.r_[starts, len(col)])
+        files = {}
+        for start, n in zip(starts.tolist(), counts.tolist()):
+            path = meta.paths[col[start]]
+            entry = files.get(path)
+            if entry is None:
+                try:
+                    st = os.stat(path)
+                    size, mtime = st.st_size, st.st_mtime_ns
+                except OSError:
+                    size = mtime = None
+                entry = files[path] = {"rows": [], "size": size, "mtime_ns": mtime}
+            entry["rows"].append([start, n])
+    finally:
+        meta.close()
+    with open(store_files(meta_file)["manifest"], "w", encoding="utf-8") as g:
+        json.dump({"version": 1, "files": files}, g, ensure_ascii=False)
+    return files
+
+
+def read_manifest(meta_file: str):
+    """读取文件清单；没有清单（旧索引）时返回 None"""
+    try:
+        with open(store_files(meta_file)["manifest"], encoding="utf-8") as g:
+            return json.load(g)["files"]
+    except FileNotFoundError:
+        return None
+
+
+def chunk_hashes(meta) -> list[str]:
+    if isinstance(meta, ChunkMeta):
+        return meta.hashes()
+    return [m.get("hash") or hashlib.md5(m["text"].encode("utf-8")).hexdigest() for m in meta]
+
+
+def dup_rows(meta) -> np.ndarray:
+    """每行的代表行号（-1 表示进入向量索引的代表块）"""
+    if isinstance(meta, ChunkMeta):
+        return np.asarray(meta.dup_of())
+    return np.array([m.get("dup_of", -1) for m in meta], dtype="<i4")
+
+
+def chunk_keys(meta) -> list[tuple]:
+    if isinstance(meta, ChunkMeta):
+        return meta.keys()
+    return [(m["path"], m["start"], h) for m, h in zip(meta, chunk_hashes(meta))]
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近似重复 chunk 检测（SimHash）
+
+复制粘贴的代码、vendored 库、生成的 DTO 会产生大量几乎相同的 chunk，逐个嵌入既浪费调用，
+又会在检索 top-k 中互相挤占位置。这里在分块和嵌入之间做一遍去重：
+
+- simhash：对标识符感知的 token 做 3-gram shingle，64 位 SimHash 指纹（分块进程中计算）
+- SimHashIndex：把指纹切成 4 段 16 位分桶，海明距离 <= 3 的指纹至少有一段完全相同（抽屉原理），
+  只需和同桶的指纹比较
+
+每个簇只嵌入第一次出现的代表块，其余块在元数据中记录 dup_of 指向代表块。
+"""
+import re
+import zlib
+import numpy as np
+
+_TOKEN_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+|[^\sA-Za-z0-9_]")
+_SHIFTS = np.arange(64, dtype=np.uint64)
+_M1 = np.uint64(0xBF58476D1CE4E5B9)
+_M2 = np.uint64(0x94D049BB133111EB)
+_P = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F), np.uint64(0x165667B19E3779F9))
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    """splitmix64 混洗，让 shingle 哈希的各个比特分布均匀"""
+    x = x ^ (x >> np.uint64(30))
+    x = x * _M1
+    x = x ^ (x >> np.uint64(27))
+    x = x * _M2
+    return x ^ (x >> np.uint64(31))
+
+
+def simhash(text: str, shingle: int = 3, min_tokens: int = 32) -> int:
+    """64 位 SimHash 指纹；token 太少（短块容易误判）时返回 0，表示不参与去重"""
+    tokens = _TOKEN_RE.findall(text)
+    if len(tokens) < max(min_tokens, shingle):
+        return 0
+    t = np.fromiter((zlib.crc32(tok.encode("utf-8")) for tok in tokens), dtype=np.uint64, count=len(tokens))
+    n = len(t) - shingle + 1
+    with np.errstate(over="ignore"):
+        h = np.zeros(n, dtype=np.uint64)
+        for k in range(shingle):
+            h ^= t[k:k + n] * _P[k % len(_P)]
+        h = np.unique(_mix(h))
+        ones = ((h[:, None] >> _SHIFTS) & np.uint64(1)).sum(axis=0)
+    bits = np.packbits(ones * 2 > len(h), bitorder="little")
+    return int.from_bytes(bits.tobytes(), "little") or 1
+
+
+class SimHashIndex:
+    """按代表块登记指纹，查找海明距离不超过 max_distance 的已有代表块"""
+
+    def __init__(self, max_distance: int = 3):
+        if not 0 <= max_distance <= 3:
+            raise ValueError("max_distance 取值 0~3（4 段分桶只能保证距离 <= 3 的指纹被找到）")
+        self.max_distance = max_distance
+        self._buckets = [{} for _ in range(4)]
+        self.size = 0
+
+    def find_or_add(self, fp: int, row: int) -> int:
+        """返回近似重复的代表块行号；没有时把 (fp, row) 登记为新的代表块并返回 -1"""
+        if not fp:
+            return -1
+        keys = [(fp >> (16 * i)) & 0xFFFF for i in range(4)]
+        for bucket, key in zip(self._buckets, keys):
+            for other_fp, other_row in bucket.get(key, ()):
+                if (fp ^ other_fp).bit_count() <= self.max_distance:
+                    return other_row
+        for bucket, key in zip(self._buckets, keys):
+            bucket.setdefault(key, []).append((fp, row))
+        self.size += 1
+        return -1
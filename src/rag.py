@@ -3,7 +3,10 @@ import sys
 PROJECT_ROOT = Path(__file__).resolve().parent
 sys.path.insert(0, str(PROJECT_ROOT))
 from typing import Dict, List
-from .embedding import query_code
+from .embedding import query_code, query_code_many
+from .search_filter import SearchFilter
+from .config import load_config
+from .repo_walker import walk_files
 from .prompts import PLAN_WIKI_PROMPT,WRITE_PAGE_PROMPT
 from .llm import generate
 # -----------------------------
@@ -18,6 +21,15 @@ from typing import List
 MAX_HEAD_LINES = 300          # 只取前 200 行
 MAX_FILE_BYTES = 80 * 1024    # 单文件 50 KB 上限
 MAX_TOTAL_BYTES = 400 * 1024  # 整页 200 KB 上限
+# 页面检索范围：boost 优先 relevant_files 中的代码，restrict 只检索这些文件，off 不限定
+PAGE_FILTER_MODE = (load_config().get("PAGE_FILTER_MODE") or "boost").lower()
+
+
+def page_filter(file_paths: List[str], repo_root: Path):
+    """按页面的 relevant_files 限定 / 提升代码检索范围；PAGE_FILTER_MODE=off 或没有文件时返回 None"""
+    if PAGE_FILTER_MODE == "off" or not file_paths:
+        return None
+    return SearchFilter(files=file_paths, root=str(repo_root), mode=PAGE_FILTER_MODE)
 
 def head_text(path: Path, max_lines: int, max_bytes: int) -> str:
     """返回前 max_lines 行且不超过 max_bytes 的文本"""
@@ -46,9 +58,8 @@ def _iter_docs_under(root: Path) -> Iterable[Path]:
     CODE_EXT = {".py", ".js", ".ts", ".java", ".cpp", ".c", ".h", ".go", ".rs",
                 ".jsx", ".tsx", ".html", ".css", ".php", ".swift", ".cs",
                 ".md", ".txt", ".rst", ".json", ".yaml", ".yml"}
-    for p in root.rglob("*"):
-        if p.is_file() and p.suffix.lower() in CODE_EXT:
-            yield p
+    for p in walk_files(root, CODE_EXT):
+        yield Path(p)
 
 # ---------- 新增入口 ----------
 def write_page_from_dir(title: str,
@@ -95,10 +106,16 @@ def write_page(title: str,
                repo_root: Path,
                source_code_stone: Path,
                java_callgraph_stone: Path,
-               language: str = "zh") -> str:
-    # ---- 1. 语义代码块 ----
-    codes = query_code(query=description, project_root=str(repo_root), out_path=str(source_code_stone))
-    codes += get_java_callgraph(description, str(repo_root), str(java_callgraph_stone))
+               language: str = "zh",
+               contexts: Dict[tuple, str] = None) -> str:
+    # ---- 1. 语义代码块（已由 prefetch_page_contexts 批量取回时直接使用）----
+    key = page_context_key(description, file_paths)
+    if contexts and key in contexts:
+        codes = contexts[key]
+    else:
+        codes = query_code(query=description, project_root=str(repo_root), out_path=str(source_code_stone),
+                           flt=page_filter(file_paths, repo_root))
+        codes += get_java_callgraph(description, str(repo_root), str(java_callgraph_stone))
 
     # ---- 2. 带限制的文件内容 ----
     chunks, total = [], 0
@@ -126,9 +143,45 @@ def write_page(title: str,
                            code_contents=codes)
     log.info("[write_page] prompt=%.10000s...", prompt)
     return generate(prompt, temperature=0.1, max_tokens=20480)
+def page_context_key(description: str, file_paths: List[str] = None) -> tuple:
+    """页面检索上下文的键：描述相同但 relevant_files 不同的页面检索范围不同，上下文不能共用"""
+    return description, tuple(file_paths or ())
+
+
+def prefetch_page_contexts(queries: List[str], repo_root: Path, source_code_stone: Path,
+                           java_callgraph_stone: Path, file_paths: List[List[str]] = None) -> Dict[tuple, str]:
+    """
+    解析出 wiki 结构后一次性取回所有页面的检索上下文（代码片段 + 调用链），
+    每个索引只加载一次、查询一起嵌入并批量检索。返回 {page_context_key: 上下文}，供 write_page 使用。
+    file_paths 与 queries 一一对应，为各页面的 relevant_files（代码检索范围见 page_filter）。
+    """
+    pages = {}
+    for i, q in enumerate(queries):
+        files = file_paths[i] if file_paths else None
+        if q:
+            pages.setdefault(page_context_key(q, files), files)
+    if not pages:
+        return {}
+    keys = list(pages)
+    filters = [page_filter(pages[k], repo_root) for k in keys]
+    codes = query_code_many([q for q, _ in keys], project_root=str(repo_root), out_path=str(source_code_stone),
+                            filters=filters)
+    # 调用链检索不按文件限定，相同描述只查一次
+    descriptions = list(dict.fromkeys(q for q, _ in keys))
+    callgraphs = dict(zip(descriptions, get_java_callgraph_many(descriptions, str(repo_root), str(java_callgraph_stone))))
+    log.info("[prefetch_page_contexts] %s pages, %s queries", len(keys), len(descriptions))
+    return {k: c + callgraphs[k[0]] for k, c in zip(keys, codes)}
+
+
+def get_java_callgraph_many(queries: List[str], repo_root: str, out: str) -> List[str]:
+    """批量版 get_java_callgraph"""
+    from tools.project_parser import save_java_callgraph
+    save_java_callgraph(repo_root, out)
+    if Path(out, "java_call_chain.json").is_file():
+        # 索引的是调用链目录本身；大型项目的调用链 JSON 可能超过大小上限，不做源码过滤
+        return query_code_many(queries, project_root=out, out_path=out, source_filters=False)
+    return query_code_many(queries, project_root=repo_root, out_path=out)
+
+
 def get_java_callgraph(query:str,repo_root: str,out: str):
-    from tools.project_parser import save_java_callgraph,get_java_callgraph_from_faiss_store
-    save_java_callgraph(repo_root,out)
-    get_java_callgraph_from_faiss_store(query,out)
-    callgraph = query_code(query=query, project_root=repo_root, out_path=out)
-    return callgraph
+    return get_java_callgraph_many([query], repo_root, out)[0]
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+遵守忽略规则的仓库遍历（所有索引 / 解析阶段共用）
+
+过滤顺序：
+    1. 忽略规则：内置默认排除（node_modules、target、dist、锁文件…）< 各级目录的 .gitignore
+       < .ewikiignore，语法与 .gitignore 相同（!取反、/ 锚定、** 通配、末尾 / 仅匹配目录），
+       后出现的规则优先，因此可以在 .ewikiignore 中用 !dist/ 重新纳入默认排除的目录
+    2. 扩展名过滤
+    3. 单文件大小上限（WALK_MAX_FILE_KB）
+    4. 压缩 / 生成文件检测：只读文件开头几 KB，超长行判定为压缩产物，
+       文件头含 "@generated"、"DO NOT EDIT" 等标记判定为生成代码
+
+3、4 只用于代码仓库；知识库文档和调用图 JSON 本身就是要检索的内容，遍历时传 max_file_bytes=0、
+detect_generated=False 关闭（见 embedding.list_files）。
+
+被忽略的目录整体剪枝，不会进入遍历。输出按路径排序，多次遍历结果稳定。
+"""
+import os
+import re
+from .config import load_config
+
+cfg = load_config()
+
+WALK_MAX_FILE_BYTES = int(float(cfg.get("WALK_MAX_FILE_KB") or 1024) * 1024)
+WALK_DETECT_GENERATED = (cfg.get("WALK_DETECT_GENERATED") or "on").lower() not in ("off", "false", "0", "no")
+IGNORE_FILES = (".gitignore", ".ewikiignore")
+
+DEFAULT_EXCLUDES = [
+    # 版本控制、依赖、构建产物、缓存；build、out、vendor 也是常见的源码包名（如 Go 的 .../build 包），
+    # 只排除仓库根目录下的
+    ".git/", ".hg/", ".svn/", "node_modules/", "bower_components/", "jspm_packages/",
+    "/vendor/", "target/", "/build/", "dist/", "/out/", ".next/", ".nuxt/", ".output/",
+    "coverage/", ".gradle/", ".idea/", ".vscode/", "__pycache__/", ".venv/", "venv/",
+    ".tox/", ".mypy_cache/", ".pytest_cache/", ".ruff_cache/", ".cache/", "*.egg-info/",
+    # 锁文件、压缩产物、source map
+    "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "poetry.lock", "Pipfile.lock",
+    "Cargo.lock", "composer.lock", "Gemfile.lock", "go.sum",
+    "*.min.js", "*.min.css", "*.map", "*.bundle.js", "*.chunk.js",
+    # 常见生成代码
+    "*_pb2.py", "*_pb2_grpc.py", "*.pb.go", "*.pb.cc", "*.pb.h", "*.generated.*",
+    # 本项目的索引快照目录（知识库、调用图的索引与其源文件在同一目录）
+    ".ewiki-index/",
+]
+
+# 只对这些文本类型做压缩检测（Markdown 等文档的长段落不算）
+_MINIFY_EXT = {".js", ".mjs", ".cjs", ".jsx", ".ts", ".tsx", ".css", ".json", ".html"}
+_CODE_EXT = _MINIFY_EXT | {".py", ".java", ".go", ".rs", ".c", ".h", ".cpp", ".hpp", ".cs",
+                           ".php", ".swift", ".kt", ".scala", ".rb"}
+_GENERATED_MARKERS = (b"@generated", b"do not edit", b"code generated", b"auto-generated",
+                      b"autogenerated", b"automatically generated")
+_SNIFF_BYTES = 8192
+
+
+def _translate(pattern: str) -> str:
+    """把一条 gitignore 通配模式转换成正则（匹配相对路径，/ 分隔）"""
+    out, i, n = [], 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == n:
+            out.append("/.*")
+            i += 3
+        elif pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif c == "*":
+            out.append("[^/]*")
+            i += 1
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[":
+            j = pattern.find("]", i + 2)
+            if j < 0:
+                out.append(re.escape(c))
+                i += 1
+                continue
+            body = pattern[i + 1:j]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append("[" + body.replace("\\", "\\\\") + "]")
+            i = j + 1
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return "".join(out)
+
+
+class IgnoreRule:
+    __slots__ = ("regex", "negate", "dir_only", "anchored", "base")
+
+    def __init__(self, pattern: str, base: str = ""):
+        self.negate = pattern.startswith("!")
+        if self.negate:
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        # 含 / 的模式相对于忽略文件所在目录锚定，否则匹配任意层级的文件/目录名
+        self.anchored = "/" in pattern
+        self.regex = re.compile(_translate(pattern.lstrip("/")) + r"\Z", re.DOTALL)
+        self.base = base
+
+    def match(self, rel: str, name: str, is_dir: bool):
+        """返回 True（忽略）、False（取反纳入）或 None（不适用）"""
+        if self.dir_only and not is_dir:
+            return None
+        if self.base:
+            if not rel.startswith(self.base + "/"):
+                return None
+            rel = rel[len(self.base) + 1:]
+        target = rel if self.anchored else name
+        if self.regex.match(target):
+            return not self.negate
+        return None
+
+
+def parse_ignore_lines(lines, base: str = "") -> list[IgnoreRule]:
+    rules = []
+    for line in lines:
+        line = line.rstrip("\n").rstrip("\r")
+        if not line.endswith("\\ "):
+            line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("\\#") or line.startswith("\\!"):
+            line = line[1:]
+        rules.append(IgnoreRule(line, base))
+    return rules
+
+
+def _read_ignore_files(dirpath: str, base: str) -> list[IgnoreRule]:
+    rules = []
+    for name in IGNORE_FILES:
+        p = os.path.join(dirpath, name)
+        if os.path.isfile(p):
+            with open(p, encoding="utf-8", errors="ignore") as f:
+                rules.extend(parse_ignore_lines(f, base))
+    return rules
+
+
+def _ignored(rules: list[IgnoreRule], rel: str, name: str, is_dir: bool) -> bool:
+    result = False
+    for rule in rules:
+        m = rule.match(rel, name, is_dir)
+        if m is not None:
+            result = m
+    return result
+
+
+def looks_generated(path: str, ext: str) -> str:
+    """检测压缩 / 生成文件，返回原因（"minified" / "generated"），正常文件返回空字符串"""
+    if ext not in _CODE_EXT:
+        return ""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(_SNIFF_BYTES)
+    except OSError:
+        return ""
+    if not head:
+        return ""
+    first_lines = b"\n".join(head.split(b"\n", 5)[:5]).lower()
+    if any(m in first_lines for m in _GENERATED_MARKERS):
+        return "generated"
+    if ext in _MINIFY_EXT and len(head) >= 1024:
+        lines = head.split(b"\n")
+        longest = max(len(l) for l in lines)
+        if longest > 1000 or len(head) / len(lines) > 300:
+            return "minified"
+    return ""
+
+
+class RepoWalker:
+    def __init__(self, root: str, extensions=None, max_file_bytes: int = None,
+                 default_excludes: bool = True, detect_generated: bool = None, extra_excludes=()):
+        self.root = os.path.abspath(root)
+        self.extensions = {e.lower() for e in extensions} if extensions else None
+        self.max_file_bytes = WALK_MAX_FILE_BYTES if max_file_bytes is None else max_file_bytes
+        self.detect_generated = WALK_DETECT_GENERATED if detect_generated is None else detect_generated
+        self.base_rules = parse_ignore_lines(DEFAULT_EXCLUDES) if default_excludes else []
+        # 调用方追加的排除规则排在 .gitignore / .ewikiignore 之后，不会被其中的 ! 规则重新纳入
+        self.extra_rules = parse_ignore_lines(extra_excludes)
+        self.stats = {"files": 0, "ignored": 0, "ignored_dirs": 0, "too_large": 0, "minified": 0, "generated": 0}
+
+    def __iter__(self):
+        return self.walk()
+
+    def walk(self):
+        """按路径顺序产出未被过滤的文件绝对路径"""
+        rules_by_dir = {self.root: self.base_rules + _read_ignore_files(self.root, "")}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            rules = rules_by_dir.pop(dirpath)
+            rel_dir = os.path.relpath(dirpath, self.root).replace(os.sep, "/")
+            rel_dir = "" if rel_dir == "." else rel_dir
+
+            kept = []
+            for d in sorted(dirnames):
+                rel = f"{rel_dir}/{d}" if rel_dir else d
+                if _ignored(rules, rel, d, True) or _ignored(self.extra_rules, rel, d, True):
+                    self.stats["ignored_dirs"] += 1
+                    continue
+                sub = os.path.join(dirpath, d)
+                rules_by_dir[sub] = rules + _read_ignore_files(sub, rel)
+                kept.append(d)
+            dirnames[:] = kept  # 剪枝：被忽略的目录不再进入
+
+            for f in sorted(filenames):
+                ext = os.path.splitext(f)[1].lower()
+                if self.extensions is not None and ext not in self.extensions:
+                    continue
+                rel = f"{rel_dir}/{f}" if rel_dir else f
+                if _ignored(rules, rel, f, False) or _ignored(self.extra_rules, rel, f, False):
+                    self.stats["ignored"] += 1
+                    continue
+                path = os.path.join(dirpath, f)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                if self.max_file_bytes and size > self.max_file_bytes:
+                    self.stats["too_large"] += 1
+                    continue
+                if self.detect_generated:
+                    reason = looks_generated(path, ext)
+                    if reason:
+                        self.stats[reason] += 1
+                        continue
+                self.stats["files"] += 1
+                yield path
+
+
+def walk_files(root: str, extensions=None, **kwargs):
+    """遍历 root 下符合条件的文件（见 RepoWalker）"""
+    return RepoWalker(root, extensions, **kwargs).walk()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检索范围过滤（按路径前缀、文件集合、语言）
+
+写某一页 wiki 时，规划阶段已经给出了 relevant_files；问答时用户也可能只关心某个模块。
+先在全库 top-k 里检索再丢掉范围外的结果，范围越小越容易一条都不剩。这里把范围换算成
+元数据行的布尔掩码，交给 index_factory.filtered_search 用 FAISS 的 ID 选择器在检索时过滤，
+BM25 打分时同样只保留掩码内的行。
+
+两种模式：
+    restrict  只返回范围内的结果
+    boost     全库结果与范围内结果做倒数排名融合，范围内的块排名靠前，范围外的强相关结果仍可出现
+
+    flt = SearchFilter(files=["src/app.py"], prefixes=["src/api/"], root=repo_root, mode="boost")
+    results = search(query, top_k, flt)
+"""
+import os
+import numpy as np
+
+from .meta_store import ChunkMeta
+from .tools.project_parser import CodeParser
+
+MODES = ("restrict", "boost")
+
+_parser = CodeParser()
+
+
+def _norm(path: str) -> str:
+    return path.replace("\\", "/").strip("/")
+
+
+def path_language(path: str) -> str:
+    """代码文件的语言（与 CodeParser 一致），其他文件为扩展名（md、yaml 等）"""
+    lang = _parser.detect_language(path)
+    if lang != "unknown":
+        return lang
+    return os.path.splitext(path)[1].lower().lstrip(".") or "unknown"
+
+
+class SearchFilter:
+    """
+    files     文件路径集合（相对 root，或以其结尾）
+    prefixes  目录前缀（相对 root），如 "src/api/"
+    languages 语言名（python、java、c_cpp …）或文档扩展名（md、yaml …）
+    root      元数据中的路径相对于哪个目录；为空时 files / prefixes 按路径后缀匹配
+
+    三个条件之间是“或”的关系：命中任意一个即在范围内。
+    """
+
+    def __init__(self, files=None, prefixes=None, languages=None, root=None, mode: str = "restrict"):
+        if mode not in MODES:
+            raise ValueError(f"未知的过滤模式: {mode}（可选 {', '.join(MODES)}）")
+        self.files = frozenset(_norm(f) for f in files or () if f and f.strip())
+        self.prefixes = tuple(sorted({_norm(p) + "/" for p in prefixes or () if p and _norm(p)}))
+        self.languages = frozenset(l.strip().lower().lstrip(".") for l in languages or () if l and l.strip())
+        self.root = os.path.abspath(root) if root else None
+        self.mode = mode
+
+    def __bool__(self) -> bool:
+        return bool(self.files or self.prefixes or self.languages)
+
+    def key(self) -> tuple:
+        """同样的过滤条件得到同样的 key，用于分组批量检索和缓存掩码"""
+        return self.files, self.prefixes, self.languages, self.root, self.mode
+
+    def _relative(self, path: str) -> str:
+        if self.root:
+            rel = os.path.relpath(os.path.abspath(path), self.root)
+            if not rel.startswith(".."):
+                return _norm(rel)
+        return _norm(path)
+
+    def match(self, path: str) -> bool:
+        if self.languages and path_language(path) in self.languages:
+            return True
+        rel = self._relative(path)
+        if self.root and rel != _norm(path):
+            return rel in self.files or rel.startswith(self.prefixes)
+        # 没有 root（或路径不在 root 下）时按后缀匹配
+        slashed = "/" + rel
+        return (any(rel == f or slashed.endswith("/" + f) for f in self.files)
+                or any(slashed.find("/" + p) >= 0 for p in self.prefixes))
+
+    def __repr__(self) -> str:
+        return (f"SearchFilter(files={len(self.files)}, prefixes={list(self.prefixes)}, "
+                f"languages={sorted(self.languages)}, mode={self.mode})")
+
+
+def allowed_rows(meta, flt: SearchFilter) -> np.ndarray:
+    """元数据每一行是否在范围内（bool 数组）；每个文件只判断一次"""
+    if isinstance(meta, ChunkMeta):
+        path_ok = np.fromiter((flt.match(p) for p in meta.paths), dtype=bool, count=len(meta.paths))
+        return path_ok[np.asarray(meta.rows["path"])] if len(meta.paths) else np.zeros(len(meta), dtype=bool)
+    cache = {}
+    out = np.zeros(len(meta), dtype=bool)
+    for i, m in enumerate(meta):
+        p = m["path"]
+        if p not in cache:
+            cache[p] = flt.match(p)
+        out[i] = cache[p]
+    return out
+
+
+def allowed_groups(allowed: np.ndarray, dup: np.ndarray) -> np.ndarray:
+    """
+    向量索引中可以命中的行：范围内的代表块，以及有重复块落在范围内的代表块
+    （近似重复块不在索引中，只能通过代表块找到）
+    """
+    out = allowed & (dup < 0)
+    members = np.flatnonzero(allowed & (dup >= 0))
+    out[dup[members]] = True
+    return out
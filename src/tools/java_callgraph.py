@@ -116,13 +116,8 @@ class JavaCallChainAnalyzer:
 
     def find_all_java_files(self):
         """查找项目中的所有Java文件"""
-        java_files = []
-        for root, dirs, files in os.walk(self.project_path):
-            for file in files:
-                if file.endswith('.java'):
-                    full_path = os.path.join(root, file)
-                    java_files.append(full_path)
-        return java_files
+        from src.repo_walker import walk_files
+        return list(walk_files(self.project_path, {'.java'}))
 
     def analyze_project(self):
         """分析整个Java项目"""
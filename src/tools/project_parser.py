@@ -1206,7 +1206,8 @@ def get_java_callgraph_from_faiss_store(query: str,data_path):
             return {}
     else:
         from src.embedding import query_code
-        answer = query_code(query=query,project_root=data_path,out_path=data_path)
+        # 调用链 JSON 可能超过源码遍历的大小上限，不做源码过滤
+        answer = query_code(query=query,project_root=data_path,out_path=data_path,source_filters=False)
         print("---------------------answer------------------------"+answer)
         return answer
 
@@ -1326,53 +1327,49 @@ def parse_project(project_directory):
         "files": []
     }
 
-    # 遍历目录下的所有文件
-    for root, dirs, files in os.walk(project_directory):
-        for file in files:
-            # 获取文件扩展名
-            _, ext = os.path.splitext(file)
-
-            # 检查是否是支持的文件类型
-            if ext.lower() in supported_extensions:
-                file_path = os.path.join(root, file)
-                project_data["total_files"] += 1
-
-                try:
-                    print("=" * 50)
-                    print(f"Processing: {file_path}")
-                    result = code_parser.parse_code(file_path)
-                    file_json = code_parser.print_results(result)
-
-                    # 将文件信息添加到项目数据中
-                    file_data = {
-                        "file_path": file_path,
-                        "file_name": file,
-                        "relative_path": os.path.relpath(file_path, project_directory),
-                        "file_type": ext.lower(),
-                        "language": language_map.get(ext.lower(), "unknown"),
-                        "analysis_result": file_json  # 假设file_json已经是字典格式
-                    }
+    # 遍历目录下的所有支持的文件（遵守 .gitignore/.ewikiignore，跳过依赖目录、超大和生成文件）
+    from src.repo_walker import walk_files
+    for file_path in walk_files(project_directory, supported_extensions):
+        file = os.path.basename(file_path)
+        _, ext = os.path.splitext(file)
+        project_data["total_files"] += 1
 
-                    project_data["files"].append(file_data)
-                    project_data["processed_files"] += 1
-
-                    print(f"Successfully processed: {file_path}")
-                    print()
-
-                except Exception as e:
-                    error_data = {
-                        "file_path": file_path,
-                        "file_name": file,
-                        "relative_path": os.path.relpath(file_path, project_directory),
-                        "file_type": ext.lower(),
-                        "language": language_map.get(ext.lower(), "unknown"),
-                        "error": str(e),
-                        "status": "failed"
-                    }
-                    project_data["files"].append(error_data)
-                    print(f"Error processing file {file_path}: {str(e)}")
-                    print("Continuing with next file...\n")
-                    continue
+        try:
+            print("=" * 50)
+            print(f"Processing: {file_path}")
+            result = code_parser.parse_code(file_path)
+            file_json = code_parser.print_results(result)
+
+            # 将文件信息添加到项目数据中
+            file_data = {
+                "file_path": file_path,
+                "file_name": file,
+                "relative_path": os.path.relpath(file_path, project_directory),
+                "file_type": ext.lower(),
+                "language": language_map.get(ext.lower(), "unknown"),
+                "analysis_result": file_json  # 假设file_json已经是字典格式
+            }
+
+            project_data["files"].append(file_data)
+            project_data["processed_files"] += 1
+
+            print(f"Successfully processed: {file_path}")
+            print()
+
+        except Exception as e:
+            error_data = {
+                "file_path": file_path,
+                "file_name": file,
+                "relative_path": os.path.relpath(file_path, project_directory),
+                "file_type": ext.lower(),
+                "language": language_map.get(ext.lower(), "unknown"),
+                "error": str(e),
+                "status": "failed"
+            }
+            project_data["files"].append(error_data)
+            print(f"Error processing file {file_path}: {str(e)}")
+            print("Continuing with next file...\n")
+            continue
 
     # 保存项目级JSON到文件
     output_filename = f"{os.path.basename(project_directory)}_project_analysis.json"
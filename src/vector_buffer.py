@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+构建索引时的磁盘向量缓冲
+
+嵌入结果按完成顺序到达，但必须按 chunk 行号排列。向量直接按行号写入临时文件
+（行号 × 维度 × 4 字节的偏移），全部写完后以 memmap 方式交给索引构建，
+进程内不再同时持有 list + vstack 两份完整的向量矩阵。
+"""
+import os
+import threading
+import numpy as np
+
+
+class VectorBuffer:
+    def __init__(self, path: str, dim: int):
+        self.path = str(path)
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self._f = open(self.path, "w+b")
+        self._lock = threading.Lock()
+
+    def write(self, rows: list[int], vecs: np.ndarray) -> None:
+        """把 vecs[i] 写到第 rows[i] 行，连续的行合并为一次写入"""
+        vecs = np.ascontiguousarray(vecs, dtype="float32")
+        if vecs.shape[1] != self.dim:
+            raise ValueError(f"向量维度 {vecs.shape[1]} 与索引维度 {self.dim} 不一致")
+        with self._lock:
+            i = 0
+            while i < len(rows):
+                j = i + 1
+                while j < len(rows) and rows[j] == rows[j - 1] + 1:
+                    j += 1
+                self._f.seek(rows[i] * self.row_bytes)
+                self._f.write(vecs[i:j].tobytes())
+                i = j
+
+    def finish(self, n: int) -> np.ndarray:
+        """结束写入，返回 (n, dim) 的可写 memmap"""
+        with self._lock:
+            self._f.truncate(n * self.row_bytes)
+            self._f.flush()
+        if n == 0:
+            return np.empty((0, self.dim), dtype="float32")
+        return np.memmap(self.path, dtype="float32", mode="r+", shape=(n, self.dim))
+
+    def close(self) -> None:
+        self._f.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
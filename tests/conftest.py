@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.fixture
+def emb(monkeypatch):
+    """使用本地 hashing 嵌入后端（名为 ewiki-test 的目录下的项目），不访问网络、不读写共享的嵌入缓存"""
+    import src.embedding as emb
+    monkeypatch.setitem(emb.cfg, "EMBED_BACKEND_BY_PROJECT", "ewiki-test=hashing")
+    monkeypatch.setattr(emb, "EMBED_CACHE", None)
+    monkeypatch.setattr(emb, "CHUNK_WORKERS", 1)
+    # 测试会直接改动磁盘上的索引目录（模拟其他进程），不复用缓存的 CURRENT
+    monkeypatch.setattr(emb, "INDEX_POINTER_TTL", 0)
+    yield emb
+    emb.INDEX_REGISTRY.invalidate()
+
+
+@pytest.fixture
+def kb_dir(tmp_path):
+    d = tmp_path / "ewiki-test" / "kb"
+    d.mkdir(parents=True)
+    return d
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""EMBED_TOKENIZER 为空时默认使用本地能找到的嵌入模型分词器"""
+from src.batching import TokenCounter, local_tokenizer
+
+
+def _save_tokenizer(model_dir):
+    from tokenizers import Tokenizer
+    from tokenizers.models import WordLevel
+    from tokenizers.pre_tokenizers import Whitespace
+
+    tok = Tokenizer(WordLevel({"[UNK]": 0, "def": 1, "return": 2}, unk_token="[UNK]"))
+    tok.pre_tokenizer = Whitespace()
+    model_dir.mkdir()
+    tok.save(str(model_dir / "tokenizer.json"))
+
+
+def test_local_tokenizer_from_model_dir(tmp_path):
+    _save_tokenizer(tmp_path / "model")
+    path = local_tokenizer(str(tmp_path / "model"))
+    assert path == str(tmp_path / "model" / "tokenizer.json")
+
+    counter = TokenCounter(path)
+    assert not counter.approximate
+    assert counter.count(["def f ( x ) : return x"]) == [8]
+
+
+def test_local_tokenizer_missing_falls_back(tmp_path):
+    assert local_tokenizer("") is None
+    assert local_tokenizer(str(tmp_path / "missing")) is None
+    assert local_tokenizer("ewiki-test/no-such-model") is None
+    assert TokenCounter(None).approximate
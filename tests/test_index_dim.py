@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""--convert --dim 截断后的索引维度在增量构建中保持不变"""
+
+
+def _project(tmp_path):
+    root = tmp_path / "ewiki-test" / "src"
+    root.mkdir(parents=True)
+    for i in range(4):
+        (root / f"m{i}.py").write_text("\n".join(f"def f{i}_{j}(x):\n    return x + {j}" for j in range(20)),
+                                       encoding="utf-8")
+    return root, tmp_path / "ewiki-test" / "out"
+
+
+def _dim(emb, out):
+    return emb.load_spec(emb.IndexHandle(str(out)).index_file)["dim"]
+
+
+def test_incremental_build_keeps_converted_dim(emb, tmp_path, capsys):
+    root, out = _project(tmp_path)
+    handle = emb.build_vec_index(str(root), str(out))
+    full = _dim(emb, out)
+    emb.convert_vec_index(str(out), dim=full // 2)
+    assert _dim(emb, out) == full // 2
+
+    (root / "m0.py").write_text("def changed():\n    return 1\n" * 5, encoding="utf-8")
+    capsys.readouterr()
+    emb.build_vec_index(str(root), str(out), incremental=True)
+    assert _dim(emb, out) == full // 2
+    assert "放弃复用" not in capsys.readouterr().out
+    assert handle.search("changed", 3)
+
+    emb.build_vec_index(str(root), str(out), incremental=True, dim=full // 4)
+    assert _dim(emb, out) == full // 4
+    emb.build_vec_index(str(root), str(out), rebuild=True)
+    assert _dim(emb, out) == full
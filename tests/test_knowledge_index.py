@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""知识库索引：索引文件与文档在同一目录，从旧版平铺布局迁移到按代存放"""
+import os
+import shutil
+
+
+def _write(path, text):
+    path.write_text("\n".join(f"{text} line {i}" for i in range(30)), encoding="utf-8")
+    return str(path)
+
+
+def _kb_handle(emb, kb_dir):
+    return emb.IndexHandle(str(kb_dir), str(kb_dir), id_mapped=True, source_filters=False)
+
+
+def _indexed(handle):
+    with handle.loaded() as (_, meta):
+        return sorted({os.path.basename(m["path"]) for m in meta})
+
+
+def _to_legacy_layout(handle, kb_dir):
+    """把当前一代的文件搬回 kb_dir 根目录，模拟按代存放之前构建的知识库"""
+    gen = handle.store.current()
+    for f in os.listdir(gen):
+        shutil.move(os.path.join(gen, f), kb_dir)
+    shutil.rmtree(handle.store.dir)
+
+
+def _legacy_kb(emb, kb_dir):
+    _write(kb_dir / "guide.md", "installation guide")
+    handle = _kb_handle(emb, kb_dir)
+    handle.build()
+    _to_legacy_layout(handle, kb_dir)
+    emb.INDEX_REGISTRY.invalidate()
+    handle = _kb_handle(emb, kb_dir)
+    assert handle.index_file == os.path.join(str(kb_dir), "faiss.index")
+    assert (kb_dir / "meta.json").exists() or (kb_dir / "meta.rows.npy").exists()
+    return handle
+
+
+def test_build_skips_legacy_index_files(emb, kb_dir):
+    handle = _legacy_kb(emb, kb_dir)
+    handle.build(rebuild=True)
+    assert os.path.dirname(handle.index_file) == handle.store.current()
+    assert _indexed(handle) == ["guide.md"]
+
+
+def test_migration_then_add_and_remove(emb, kb_dir):
+    handle = _legacy_kb(emb, kb_dir)
+    new = _write(kb_dir / "new.md", "release notes")
+    assert handle.update_files(added=[new]) == []
+    assert _indexed(handle) == ["guide.md", "new.md"]
+
+    os.remove(kb_dir / "guide.md")
+    handle.update_files(removed=[str(kb_dir / "guide.md")])
+    assert _indexed(handle) == ["new.md"]
+
+
+def test_update_drops_previously_indexed_legacy_metadata(emb, kb_dir, monkeypatch):
+    handle = _legacy_kb(emb, kb_dir)
+    (kb_dir / "meta.json").write_text('{"rows": "old metadata"}\n' * 20, encoding="utf-8")
+    # 修复前的遍历会把旧版元数据当成文档收录
+    with monkeypatch.context() as m:
+        m.setattr(emb.IndexHandle, "list_files",
+                  lambda self: emb.list_files(self.project_root, self.source_filters))
+        handle.build(rebuild=True)
+    assert "meta.json" in _indexed(handle)
+
+    new = _write(kb_dir / "new.md", "release notes")
+    handle.update_files(added=[new])
+    assert _indexed(handle) == ["guide.md", "new.md"]
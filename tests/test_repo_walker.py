@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""默认排除的 build / out / vendor 只锚定在仓库根目录"""
+import os
+
+from src.repo_walker import RepoWalker
+
+
+def test_root_only_build_dirs(tmp_path):
+    for rel in ["build/a.py", "out/b.py", "vendor/c.go", "node_modules/x/d.js",
+                "pkg/build/e.go", "src/out/f.py", "lib/vendor/g.go", "main.py"]:
+        path = tmp_path / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("x = 1\n", encoding="utf-8")
+
+    walked = [os.path.relpath(p, tmp_path).replace(os.sep, "/") for p in RepoWalker(str(tmp_path)).walk()]
+    assert sorted(walked) == ["lib/vendor/g.go", "main.py", "pkg/build/e.go", "src/out/f.py"]